@@ -1,17 +1,105 @@
 #!/usr/bin/env python
 """This module implements functions for prediction bound computation."""
 
+import sys
+from multiprocessing import Pool, cpu_count
+from warnings import warn
+
 import numpy as np
 from scipy.stats import nanmean
 
 from ocupy import measures
-from ocupy.fixmat import compute_fdm
+from ocupy.fixmat import (compute_fdm, fdm_shape, fixation_histogram,
+                          gaussian_kernel, smooth_histogram, pixel_index)
 from ocupy.utils import ismember
 
 
+class LeaveOneOutFDM(object):
+    """
+    Computes fixation density maps of a fixmat from which the fixations of
+    some subjects are left out.
+
+    Smoothing is linear, so the fdm without the fixations of a subject is
+    the smoothed histogram of all fixations minus the smoothed histogram of
+    the subject. The smoothed histogram of all fixations is computed once.
+    The smoothed histogram of the left out fixations is computed from the
+    few pixels they fall into, which is much cheaper than smoothing a full
+    image.
+
+    Example:
+
+    >>> loo = LeaveOneOutFDM(fm_image)
+    >>> fdm = loo.fdm(sub) # same as compute_fdm(fm_image[fm_image.SUBJECTINDEX != sub])
+    """
+
+    def __init__(self, fm, fwhm = 2, scale_factor = 1, field = 'SUBJECTINDEX'):
+        """
+        Parameters:
+            fm : fixmat
+                The fixations, usually of one image.
+            fwhm, scale_factor : see fixmat.compute_fdm
+            field : string
+                Fixations are left out by their value in this field. 
+                Default is 'SUBJECTINDEX'.
+        """
+        assert (len(fm.image_size) == 2 and (fm.image_size[0] > 0) and
+            (fm.image_size[1] > 0)), 'The image_size is either 0, or not 2D'
+        assert not scale_factor <= 0, "scale_factor has to be > 0"
+        self.shape = fdm_shape(fm.image_size, scale_factor)
+        self.kernel = gaussian_kernel(fwhm, fm.pixels_per_degree, scale_factor)
+        (valid, self.pixels) = pixel_index(scale_factor * np.asarray(fm.y),
+                                           scale_factor * np.asarray(fm.x),
+                                           self.shape)
+        self.values = np.asarray(fm.field(field))
+        self.valid = valid
+        self.total = smooth_histogram(fixation_histogram(
+            scale_factor * np.asarray(fm.y), scale_factor * np.asarray(fm.x),
+            self.shape), self.kernel)
+
+    def fdm(self, left_out):
+        """
+        Returns the fdm of all fixations except those whose value in field 
+        is in left_out.
+
+        Parameters:
+            left_out : value or list of values of field
+        Raises:
+            RuntimeError if no fixations remain.
+        """
+        excluded = ismember(self.values, np.atleast_1d(left_out))
+        if excluded.all():
+            raise RuntimeError('There are no fixations in the fixmat.')
+        fdm = self.total - self.smoothed_histogram(excluded[self.valid])
+        # Remove round off errors where the fdm is zero
+        np.maximum(fdm, 0, out = fdm)
+        return fdm / fdm.sum()
+
+    def smoothed_histogram(self, index):
+        """
+        Returns the smoothed histogram of the valid fixations selected by
+        index.
+        """
+        (pixels, counts) = np.unique(self.pixels[index], return_counts = True)
+        width = self.shape[1]
+        rows = self._kernel_columns(pixels // width, self.shape[0])
+        cols = self._kernel_columns(pixels % width, width)
+        return np.dot(rows * counts, cols.T)
+
+    def _kernel_columns(self, centers, length):
+        # Column j contains the kernel centered on centers[j], i.e. the
+        # smoothed indicator vector of centers[j].
+        if self.kernel is None:
+            return (np.arange(length).reshape(-1, 1) == centers).astype(float)
+        radius = (len(self.kernel) - 1) // 2
+        offset = np.arange(length).reshape(-1, 1) - centers + radius
+        inside = (offset >= 0) & (offset < len(self.kernel))
+        return np.where(inside, self.kernel[np.clip(offset, 0, 2 * radius)], 0)
+
+
 def intersubject_scores(fm, category, predicting_filenumbers,
                         predicting_subjects, predicted_filenumbers,
-                        predicted_subjects, controls = True, scale_factor = 1):
+                        predicted_subjects, controls = True, scale_factor = 1,
+                        loo_fdm = None):
     """
     Calculates how well the fixations from a set of subjects on a set of
     images can be predicted with the fixations from another set of subjects
@@ -42,6 +130,11 @@ def intersubject_scores(fm, category, predicting_filenumbers,
             testing.
         scale_factor : int, optional
             specifies the scaling of the fdm. Default is 1.
+        loo_fdm : LeaveOneOutFDM, optional
+            A LeaveOneOutFDM of the fixations on predicting_filenumbers in
+            category. If given, the predicting fdm is derived from it by
+            leaving out all subjects that are not in predicting_subjects
+            instead of being computed from scratch.
 
     Returns
         auc : area under the roc curve for sets of actuals and controls
@@ -53,24 +146,31 @@ def intersubject_scores(fm, category, predicting_filenumbers,
             See true_pos_rate but for false positives.
 
     """
-    predicting_fm = fm[
+    # Only a few fields of the fixmat are used, filter lazily
+    predicting_fm = fm.filter(
         (ismember(fm.SUBJECTINDEX, predicting_subjects)) &
         (ismember(fm.filenumber, predicting_filenumbers)) &
-        (fm.category == category)]
-    predicted_fm = fm[
+        (fm.category == category), lazy = True)
+    predicted_fm = fm.filter(
         (ismember(fm.SUBJECTINDEX,predicted_subjects)) &
         (ismember(fm.filenumber,predicted_filenumbers))&
-        (fm.category == category)]
+        (fm.category == category), lazy = True)
     try:
-        predicting_fdm = compute_fdm(predicting_fm, scale_factor = scale_factor)
+        if loo_fdm is not None:
+            left_out = np.setdiff1d(np.unique(loo_fdm.values),
+                                    predicting_subjects)
+            predicting_fdm = loo_fdm.fdm(left_out)
+        else:
+            predicting_fdm = compute_fdm(predicting_fm,
+                                         scale_factor = scale_factor)
     except RuntimeError:
         predicting_fdm = None
 
     if controls == True:
-        fm_controls = fm[
+        fm_controls = fm.filter(
             (ismember(fm.SUBJECTINDEX, predicted_subjects)) &
             ((ismember(fm.filenumber, predicted_filenumbers)) != True) &
-            (fm.category == category)]
+            (fm.category == category), lazy = True)
         return measures.prediction_scores(predicting_fdm, predicted_fm,
             controls = (fm_controls.y, fm_controls.x))
     return measures.prediction_scores(predicting_fdm, predicted_fm, controls = None)
@@ -120,7 +220,8 @@ def intersubject_scores_random_subjects(fm, category, filenumber, n_train,
         [filenumber], predicted_subjects,
         controls, scale_factor)
 
-def upper_bound(fm, nr_subs = None, scale_factor = 1):
+def upper_bound(fm, nr_subs = None, scale_factor = 1, incremental = True,
+                n_jobs = 1, seed = None):
     """
     compute the inter-subject consistency upper bound for a fixmat.
 
@@ -129,6 +230,16 @@ def upper_bound(fm, nr_subs = None, scale_factor = 1):
         nr_subs : the number of subjects used for the prediction. Defaults
                   to the total number of subjects in the fixmat minus 1
         scale_factor : the scale factor of the FDMs. Default is 1.
+        incremental : if True (default) and all other subjects are used 
+                  for the prediction, the predicting FDMs are computed
+                  with a LeaveOneOutFDM per image. This gives the same
+                  result but is much faster.
+        n_jobs : the number of processes to use, see run_tasks. Default is 1.
+        seed : if given, random subject selections and the control 
+                  locations of the AUC are drawn from a random number 
+                  generator that is seeded per task (category and subject,
+                  or category and image if incremental), such that results
+                  are reproducible and do not depend on n_jobs.
     Returns:
         A list of scores; the list contains one dictionary for each measure.
         Each dictionary contains one key for each category and corresponding
@@ -138,6 +249,9 @@ def upper_bound(fm, nr_subs = None, scale_factor = 1):
     if not nr_subs:
         nr_subs = nr_subs_total - 1
     assert (nr_subs < nr_subs_total)
+    if seed is None and n_jobs != 1:
+        # Forked workers would all continue the same random sequence
+        seed = np.random.randint(2 ** 31 - 1)
     # initialize output structure; every measure gets one dict with
     # category numbers as keys and numpy-arrays as values
     intersub_scores = []
@@ -149,30 +263,90 @@ def upper_bound(fm, nr_subs = None, scale_factor = 1):
         intersub_scores.append(res_dict)
     #compute inter-subject scores for every stimulus, with leave-one-out
     #over subjects
-    for fm_cat in fm.by_field('category'):
-        cat = fm_cat.category[0]
-        for (sub_counter, sub) in enumerate(np.unique(fm_cat.SUBJECTINDEX)):
-            image_scores = []
-            for fm_single in fm_cat.by_field('filenumber'):
-                predicting_subs = (np.setdiff1d(np.unique(
-                    fm_single.SUBJECTINDEX),[sub]))
-                np.random.shuffle(predicting_subs)
-                predicting_subs = predicting_subs[0:nr_subs]
-                predicting_fm = fm_single[
-                    (ismember(fm_single.SUBJECTINDEX, predicting_subs))]
-                predicted_fm = fm_single[fm_single.SUBJECTINDEX == sub]
-                try:
-                    predicting_fdm = compute_fdm(predicting_fm,
-                        scale_factor = scale_factor)
-                except RuntimeError:
-                    predicting_fdm = None
-                image_scores.append(measures.prediction_scores(
-                                        predicting_fdm, predicted_fm))
-            for (measure, score) in enumerate(nanmean(image_scores, 0)):
-                intersub_scores[measure][cat][sub_counter] = score
+    categories = dict((fm_cat.category[0], fm_cat)
+                      for fm_cat in fm.by_field('category'))
+    if incremental and nr_subs >= nr_subs_total - 1:
+        # Every subject is predicted by all other subjects. The fdm of all
+        # fixations on an image is shared by all subjects, so tasks are 
+        # split by image instead of by subject.
+        tasks = [(cat, fn, scale_factor, 
+                  _task_seed(seed, cat_counter, fn_counter))
+                 for (cat_counter, (cat, fm_cat)) in
+                 enumerate(sorted(categories.items()))
+                 for (fn_counter, fn) in
+                 enumerate(np.unique(fm_cat.filenumber))]
+        results = run_tasks(_upper_bound_image_task, categories, tasks, n_jobs)
+        for cat in categories.keys():
+            # image_scores has shape images x subjects x measures
+            image_scores = [scores for ((task_cat, _, _, _), scores) in 
+                            zip(tasks, results) if task_cat == cat]
+            for (sub_counter, scores) in enumerate(
+                    nanmean(np.array(image_scores, dtype = float), 0)):
+                for (measure, score) in enumerate(scores):
+                    intersub_scores[measure][cat][sub_counter] = score
+        return intersub_scores
+    tasks = [(cat, sub_counter, sub, nr_subs, scale_factor, 
+              _task_seed(seed, cat_counter, sub_counter))
+             for (cat_counter, (cat, fm_cat)) in
+             enumerate(sorted(categories.items()))
+             for (sub_counter, sub) in 
+             enumerate(np.unique(fm_cat.SUBJECTINDEX))]
+    results = run_tasks(_upper_bound_task, categories, tasks, n_jobs)
+    for (task, scores) in zip(tasks, results):
+        (cat, sub_counter) = task[:2]
+        for (measure, score) in enumerate(scores):
+            intersub_scores[measure][cat][sub_counter] = score
     return intersub_scores
 
-def lower_bound(fm, nr_subs = None, nr_imgs = None, scale_factor = 1):
+def _upper_bound_task(categories, cat, sub_counter, sub, nr_subs, 
+                      scale_factor, seed):
+    """
+    Computes the mean upper bound scores of one subject in one category.
+    """
+    rng = _task_rng(seed)
+    fm_cat = categories[cat]
+    image_scores = []
+    for fm_single in fm_cat.by_field('filenumber'):
+        predicting_subs = (np.setdiff1d(np.unique(
+            fm_single.SUBJECTINDEX),[sub]))
+        rng.shuffle(predicting_subs)
+        predicting_subs = predicting_subs[0:nr_subs]
+        predicting_fm = fm_single[
+            (ismember(fm_single.SUBJECTINDEX, predicting_subs))]
+        predicted_fm = fm_single[fm_single.SUBJECTINDEX == sub]
+        try:
+            predicting_fdm = compute_fdm(predicting_fm,
+                scale_factor = scale_factor)
+        except RuntimeError:
+            predicting_fdm = None
+        image_scores.append(measures.prediction_scores(
+                                predicting_fdm, predicted_fm, rng = rng))
+    return nanmean(image_scores, 0)
+
+def _upper_bound_image_task(categories, cat, filenumber, scale_factor,
+                            seed):
+    """
+    Computes the scores of all subjects in a category on one image when
+    they are predicted by all other subjects.
+    """
+    rng = _task_rng(seed)
+    fm_cat = categories[cat]
+    fm_single = fm_cat.filter(fm_cat.filenumber == filenumber, lazy = True)
+    loo_fdm = LeaveOneOutFDM(fm_single, scale_factor = scale_factor)
+    sub_scores = []
+    for sub in np.unique(fm_cat.SUBJECTINDEX):
+        try:
+            predicting_fdm = loo_fdm.fdm(sub)
+        except RuntimeError:
+            predicting_fdm = None
+        predicted_fm = fm_single.filter(
+            fm_single.SUBJECTINDEX == sub, lazy = True)
+        sub_scores.append(measures.prediction_scores(
+                            predicting_fdm, predicted_fm, rng = rng))
+    return sub_scores
+
+def lower_bound(fm, nr_subs = None, nr_imgs = None, scale_factor = 1,
+                n_jobs = 1, seed = None):
     """
     Compute the spatial bias lower bound for a fixmat.
 
@@ -184,6 +358,12 @@ def lower_bound(fm, nr_subs = None, nr_imgs = None, scale_factor = 1):
                   same number will be used for every category. If not given,
                   leave-one-out will be used in all categories.
         scale_factor : the scale factor of the FDMs. Default is 1.
+        n_jobs : the number of processes to use, see run_tasks. Default is 1.
+        seed : if given, random subject and image selections and the
+                  control locations of the AUC are drawn from a random 
+                  number generator that is seeded per category and subject,
+                  such that results are reproducible and do not depend on
+                  n_jobs.
     Returns:
         A list of spatial bias scores; the list contains one dictionary for each
          measure. Each dictionary contains one key for each category and
@@ -193,6 +373,9 @@ def lower_bound(fm, nr_subs = None, nr_imgs = None, scale_factor = 1):
     if nr_subs is None:
         nr_subs = nr_subs_total - 1
     assert (nr_subs < nr_subs_total)
+    if seed is None and n_jobs != 1:
+        # Forked workers would all continue the same random sequence
+        seed = np.random.randint(2 ** 31 - 1)
     # initialize output structure; every measure gets one dict with
     # category numbers as keys and numpy-arrays as values
     sb_scores = []
@@ -204,8 +387,10 @@ def lower_bound(fm, nr_subs = None, nr_imgs = None, scale_factor = 1):
         sb_scores.append(res_dict)
     # compute mean spatial bias predictive power for all subjects in all
     # categories
-    for fm_cat in fm.by_field('category'):
-        cat = fm_cat.category[0]
+    categories = dict((fm_cat.category[0], fm_cat)
+                      for fm_cat in fm.by_field('category'))
+    tasks = []
+    for (cat_counter, (cat, fm_cat)) in enumerate(sorted(categories.items())):
         nr_imgs_cat = len(np.unique(fm_cat.filenumber))
         if not nr_imgs:
             nr_imgs_current = nr_imgs_cat - 1
@@ -213,31 +398,115 @@ def lower_bound(fm, nr_subs = None, nr_imgs = None, scale_factor = 1):
             nr_imgs_current = nr_imgs
         assert(nr_imgs_current < nr_imgs_cat)
         for (sub_counter, sub) in enumerate(np.unique(fm.SUBJECTINDEX)):
-            image_scores = []
-            for fm_single in fm_cat.by_field('filenumber'):
-                # Iterating by field filenumber makes filenumbers
-                # in fm_single unique: Just take the first one to get the
-                # filenumber for this fixmat
-                fn = fm_single.filenumber[0]
-                predicting_subs = (np.setdiff1d(np.unique(
-                    fm_cat.SUBJECTINDEX), [sub]))
-                np.random.shuffle(predicting_subs)
-                predicting_subs = predicting_subs[0:nr_subs]
-                predicting_fns = (np.setdiff1d(np.unique(
-                    fm_cat.filenumber), [fn]))
-                np.random.shuffle(predicting_fns)
-                predicting_fns = predicting_fns[0:nr_imgs_current]
-                predicting_fm = fm_cat[
-                    (ismember(fm_cat.SUBJECTINDEX, predicting_subs)) &
-                    (ismember(fm_cat.filenumber, predicting_fns))]
-                predicted_fm = fm_single[fm_single.SUBJECTINDEX == sub]
-                try:
-                    predicting_fdm = compute_fdm(predicting_fm,
-                        scale_factor = scale_factor)
-                except RuntimeError:
-                    predicting_fdm = None
-                image_scores.append(measures.prediction_scores(predicting_fdm,
-                     predicted_fm))
-            for (measure, score) in enumerate(nanmean(image_scores, 0)):
-                sb_scores[measure][cat][sub_counter] = score
+            tasks.append((cat, sub, nr_subs, nr_imgs_current, scale_factor,
+                          _task_seed(seed, cat_counter, sub_counter)))
+    results = run_tasks(_lower_bound_task, categories, tasks, n_jobs)
+    subjects = list(np.unique(fm.SUBJECTINDEX))
+    for (task, scores) in zip(tasks, results):
+        (cat, sub) = task[:2]
+        for (measure, score) in enumerate(scores):
+            sb_scores[measure][cat][subjects.index(sub)] = score
     return sb_scores
+
+def _lower_bound_task(categories, cat, sub, nr_subs, nr_imgs, scale_factor,
+                      seed):
+    """
+    Computes the mean spatial bias scores of one subject in one category.
+    """
+    rng = _task_rng(seed)
+    fm_cat = categories[cat]
+    image_scores = []
+    for fm_single in fm_cat.by_field('filenumber'):
+        # Iterating by field filenumber makes filenumbers
+        # in fm_single unique: Just take the first one to get the
+        # filenumber for this fixmat
+        fn = fm_single.filenumber[0]
+        predicting_subs = (np.setdiff1d(np.unique(
+            fm_cat.SUBJECTINDEX), [sub]))
+        rng.shuffle(predicting_subs)
+        predicting_subs = predicting_subs[0:nr_subs]
+        predicting_fns = (np.setdiff1d(np.unique(
+            fm_cat.filenumber), [fn]))
+        rng.shuffle(predicting_fns)
+        predicting_fns = predicting_fns[0:nr_imgs]
+        predicting_fm = fm_cat.filter(
+            (ismember(fm_cat.SUBJECTINDEX, predicting_subs)) &
+            (ismember(fm_cat.filenumber, predicting_fns)), lazy = True)
+        predicted_fm = fm_single[fm_single.SUBJECTINDEX == sub]
+        try:
+            predicting_fdm = compute_fdm(predicting_fm,
+                scale_factor = scale_factor)
+        except RuntimeError:
+            predicting_fdm = None
+        image_scores.append(measures.prediction_scores(predicting_fdm,
+             predicted_fm, rng = rng))
+    return nanmean(image_scores, 0)
+
+def _task_seed(seed, *task):
+    # Seeds for the RandomState of a task, None keeps the global state
+    if seed is None:
+        return None
+    return [seed] + list(task)
+
+def _task_rng(seed):
+    if seed is None:
+        return np.random
+    return np.random.RandomState(seed)
+
+# The data shared with worker processes by run_tasks
+_shared = None
+
+def run_tasks(function, shared, tasks, n_jobs = 1):
+    """
+    Computes [function(shared, *task) for task in tasks], optionally in 
+    parallel.
+
+    The worker processes are forked after shared has been stored in a 
+    module variable, so they access the parent's copy of it (which is not
+    copied unless it is written to) instead of receiving it pickled with 
+    every task. Only tasks and results are sent between processes. The
+    module state of the parent, e.g. the list of measures, is inherited
+    by the workers as well. This requires that processes are started by
+    forking; where they are not (e.g. on Windows), the tasks are computed
+    serially in this process and a warning is issued.
+
+    Parameters:
+        function : module level function
+        shared : object passed as first argument to every call
+        tasks : list of tuples
+        n_jobs : number of processes. 1 computes everything in this 
+            process, None or values < 1 use all cores.
+    Returns:
+        list of results, in the order of tasks
+    """
+    global _shared
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = cpu_count()
+    n_jobs = min(n_jobs, len(tasks))
+    if n_jobs > 1 and not _forks():
+        warn('Worker processes are not forked on this platform, computing '
+             'tasks serially')
+        n_jobs = 1
+    if n_jobs <= 1:
+        return [function(shared, *task) for task in tasks]
+    _shared = shared
+    pool = Pool(processes = n_jobs)
+    try:
+        return pool.map(_run_shared, [(function, task) for task in tasks],
+                        chunksize = 1)
+    finally:
+        pool.terminate()
+        _shared = None
+
+def _forks():
+    # True if multiprocessing starts processes by forking
+    try:
+        from multiprocessing import get_start_method
+    except ImportError:
+        # Python 2 forks everywhere except on Windows
+        return sys.platform != 'win32'
+    return get_start_method() == 'fork'
+
+def _run_shared(args):
+    (function, task) = args
+    return function(_shared, *task)
@@ -7,6 +7,8 @@ import numpy as np
 from numpy import ma
 from warnings import warn
 from utils import snip_string_middle, isiterable, all_same, ma_nans
+from utils import _update_digest
+import hashlib
 import inspect
 
 try:
@@ -27,6 +29,247 @@ def set_dbg_lvl(new_dbg_lvl):
     global dbg_lvl
     dbg_lvl = new_dbg_lvl
 
+# Number of elements that chunked operations on out-of-core datamats read
+# at once, see Datamat.iter_chunks
+CHUNK_SIZE = 2**20
+
+class Grouping(object):
+    """
+    Groups the elements of one or more fields by their unique values.
+
+    The grouping is computed once with a single sort: 'keys' holds the
+    unique values (or, if several fields are grouped, the unique
+    combinations of values as tuples), 'order' is a stable permutation that
+    sorts the fields by these keys and 'offsets' marks where in 'order' the
+    elements of every key start and end. The elements that carry keys[i]
+    are therefore order[offsets[i]:offsets[i+1]], in their original order.
+
+    Groupings are cached by Datamat.grouping(); they are not meant to be
+    created directly.
+    """
+
+    def __init__(self, columns):
+        """
+        Parameters:
+            columns : list of arrays
+                The fields that should be grouped, all of the same length.
+        """
+        self.sources = columns
+        self.fingerprint = _fingerprint(columns)
+        inverse = None
+        uniques = []
+        column_inverses = []
+        for values in columns:
+            (unique, column_inverse) = np.unique(values, return_inverse=True)
+            uniques.append(unique)
+            column_inverses.append(column_inverse)
+            if inverse is None:
+                inverse = column_inverse
+            else:
+                # Combine with the previous columns and compress the codes
+                # again such that they never exceed the number of elements.
+                inverse = np.unique(inverse * len(unique) + column_inverse,
+                                    return_inverse=True)[1]
+        self.inverse = inverse
+        # mergesort is stable, so elements keep their order within a group
+        self.order = np.argsort(self.inverse, kind='mergesort')
+        counts = np.bincount(self.inverse)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        first = self.order[self.offsets[:-1]]
+        self.group_keys = [unique[column_inverse[first]] for (unique,
+                            column_inverse) in zip(uniques, column_inverses)]
+        if len(columns) == 1:
+            self.keys = self.group_keys[0]
+        else:
+            self.keys = zip(*self.group_keys)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        """
+        Yields (key, index) tuples, where index is a view into 'order'
+        that selects all elements with this key.
+        """
+        for i, key in enumerate(self.keys):
+            yield key, self.order[self.offsets[i]:self.offsets[i+1]]
+
+    def is_current(self, columns):
+        """
+        Returns True if the grouping was computed from exactly these arrays
+        and their values have not been changed since.
+        """
+        return (len(columns) == len(self.sources) and
+                all(a is b for (a, b) in zip(columns, self.sources)) and
+                _fingerprint(columns) == self.fingerprint)
+
+    def counts(self):
+        """
+        Returns the number of elements in every group.
+        """
+        return np.diff(self.offsets)
+
+    def mask(self, i):
+        """
+        Returns a boolean array that is True for all elements of group i.
+        """
+        idx = np.zeros(len(self.inverse), dtype=bool)
+        idx[self.order[self.offsets[i]:self.offsets[i+1]]] = True
+        return idx
+
+    def reduce(self, values, how):
+        """
+        Reduces values (aligned with the grouped fields) to one value per
+        group.
+
+        Parameters:
+            values : array
+                Data to reduce, its first dimension is aligned to the
+                grouped fields. Masked elements are ignored by 'sum', 'mean',
+                'nanmean', 'min' and 'max'. Groups without unmasked elements
+                are masked in the results of 'min' and 'max'.
+            how : string, numpy.ufunc or function
+                'count', 'sum', 'mean', 'nanmean', 'min', 'max', 'first' and
+                'last' are computed with segment reductions over the sorted
+                values. A ufunc (e.g. np.maximum) is applied with its reduceat
+                method. Any other function is called once per group with the
+                values of this group and must return a single value.
+        Returns:
+            array with one entry per group.
+        """
+        starts = self.offsets[:-1]
+        counts = self.counts()
+        if how == 'count':
+            return counts
+        svalues = values[self.order]
+        # shape counts such that they broadcast against multi-dim. fields
+        counts = counts.reshape((-1,) + (1,)*(np.ndim(svalues)-1))
+        if how in ('sum', 'mean', 'nanmean'):
+            valid = ~ma.getmaskarray(svalues)
+            data = ma.getdata(svalues)
+            if how == 'nanmean':
+                valid = valid & ~np.isnan(data)
+            if not valid.all():
+                data = np.where(valid, data, 0)
+                counts = np.add.reduceat(valid, starts).astype(int)
+            total = np.add.reduceat(data, starts)
+            if how == 'sum':
+                return total
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return total / counts.astype(float)
+        elif how in ('min', 'max'):
+            ufunc = np.minimum if how == 'min' else np.maximum
+            if ma.getmask(svalues) is ma.nomask:
+                return ufunc.reduceat(svalues, starts)
+            valid = ~ma.getmaskarray(svalues)
+            data = ma.getdata(svalues)
+            # Masked elements are replaced by a value that never wins
+            data = np.where(valid, data, _extreme(data.dtype, how == 'min'))
+            return ma.array(ufunc.reduceat(data, starts),
+                            mask=~np.logical_or.reduceat(valid, starts))
+        elif how == 'first':
+            return svalues[starts]
+        elif how == 'last':
+            return svalues[self.offsets[1:]-1]
+        elif isinstance(how, np.ufunc):
+            return how.reduceat(svalues, starts)
+        elif hasattr(how, '__call__'):
+            return np.array([how(svalues[start:end]) for (start, end)
+                                in zip(self.offsets[:-1], self.offsets[1:])])
+        raise ValueError('Unknown reduction: %s' % str(how))
+
+def _extreme(dtype, largest):
+    # The largest or smallest value of dtype
+    if np.issubdtype(dtype, np.floating):
+        return np.inf if largest else -np.inf
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return info.max if largest else info.min
+    if dtype == np.bool_:
+        return largest
+    raise ValueError('Masked %s values can not be reduced with min or max' 
+                     % dtype)
+
+def _fingerprint(columns):
+    # Digest of the values (and masks) of columns
+    digest = hashlib.sha1()
+    for values in columns:
+        _update_digest(digest, ma.getdata(values))
+        if isinstance(values, ma.MaskedArray):
+            _update_digest(digest, ma.getmaskarray(values))
+    return digest.digest()
+
+class GroupBy(object):
+    """
+    Gives access to the groups of a Datamat that are formed by the unique
+    combinations of values in a list of fields.
+
+    Returned by Datamat.groupby():
+
+        >> by_img = fm.groupby(['category', 'filenumber'])
+        >> means = by_img.agg({'x':'mean', 'y':'mean'})
+        >> means.mean_x  # one entry per category/filenumber combination
+    """
+
+    def __init__(self, datamat, fields):
+        self.datamat = datamat
+        self.fields = fields
+        self.grouping = datamat.grouping(fields)
+
+    def __len__(self):
+        return len(self.grouping)
+
+    def __iter__(self):
+        """
+        Yields (key, datamat) tuples, one for every group. If only one
+        field is grouped the key is a value, otherwise a tuple of values.
+        """
+        # Sort all fields once, every group is then a contiguous slice
+        # (i.e. a view) of the sorted datamat.
+        sorted_dm = self.datamat.filter(self.grouping.order)
+        for (i, key) in enumerate(self.grouping.keys):
+            yield key, sorted_dm.filter(
+                slice(self.grouping.offsets[i], self.grouping.offsets[i+1]))
+
+    def count(self):
+        """
+        Returns the number of elements in every group.
+        """
+        return self.grouping.counts()
+
+    def agg(self, how):
+        """
+        Aggregates fields for every group.
+
+        Parameters:
+            how : dictionary
+                Maps field names to a reduction or a list of reductions.
+                See Grouping.reduce for the reductions that are available.
+        Returns:
+            datamat : Datamat with one element per group. It contains the
+                grouping fields and one field named <reduction>_<field> for
+                every requested reduction (a leading 'nan' is stripped from
+                the reduction name, as in add_average_field). The parameters
+                of the grouped datamat are retained.
+        """
+        fields = dict(zip(self.fields, self.grouping.group_keys))
+        for (field, reductions) in how.iteritems():
+            if isinstance(reductions, str) or not isiterable(reductions):
+                reductions = [reductions]
+            for reduction in reductions:
+                if isinstance(reduction, str):
+                    name = reduction
+                    if name.startswith('nan'):
+                        name = name[3:]
+                else:
+                    name = get_short_function_name(reduction)
+                name = name + '_' + field
+                if name in fields:
+                    raise ValueError('Aggregation %s is ambiguous' % name)
+                fields[name] = self.grouping.reduce(
+                                    self.datamat.field(field), reduction)
+        return VectorFactory(fields, self.datamat.parameters().copy())
+
 class Datamat(object):
     """
     Represents grouped data.
@@ -51,9 +294,14 @@ class Datamat(object):
 
     .. note:: It is never necessary to create a Datamat object directly. 
         This is handled by Datamat factories.
+
+    Datamats that are too large for memory can be loaded with memory 
+    mapped fields (see load_npy and load). Such out-of-core datamats filter
+    lazily by default and by_field, fixmat.compute_fdm and 
+    simulator.anglendiff process them in chunks of CHUNK_SIZE elements.
     """ 
     
-    def __init__(self, datamat = None, index = None):
+    def __init__(self, datamat = None, index = None, lazy = False):
         """
         Creates a new Datamat from an existing one
 
@@ -66,6 +314,15 @@ class Datamat(object):
                 which should be ignored. If index is iterable it indexes all fields
                 as if you would index a numpy array with index. The only exception is 
                 that a datamat always holds arrays, never scalar values, as fields.
+            lazy : boolean, optional
+                If True, fields are not copied immediately. Instead, the index
+                is stored (as a slice if it selects a contiguous block) and a
+                field is copied from the existing Datamat when it is accessed
+                for the first time. Lazily filtered fields are always copies,
+                but they are copied from the current values of the existing
+                Datamat: changing a field of it in place changes the fields
+                of the new Datamat that have not been accessed yet. Call
+                materialize() before such changes to prevent this.
 
         TODO: thoroughly test that all indices work as expected (including slicing etc)
 
@@ -83,19 +340,77 @@ class Datamat(object):
         self._fields = []
         self._parameters = {}
         self._num_fix = 0
+        self._groupings = {}
+        # Maps names of fields that are not yet copied to (source, index)
+        self._lazy = {}
         if datamat is not None and index is not None:
-            if not isiterable(index):
+            if not (isiterable(index) or isinstance(index, slice)):
                 index = [index]
             self._fields = datamat._fields[:]
-            for  field in self._fields:
-                newfield = datamat.__dict__[field][index]
-                num_fix = len(newfield)
-                self.__dict__[field] = newfield
+            if lazy:
+                (index, num_fix) = compress_index(index, len(datamat))
+                # Fields that are lazy in datamat are filtered directly
+                # from their source, compose the indices once per source index.
+                composed = {}
+                for field in self._fields:
+                    if (field in datamat._lazy and
+                            field not in datamat.__dict__):
+                        (source, source_index) = datamat._lazy[field]
+                        key = id(source_index)
+                        if key not in composed:
+                            composed[key] = compose_index(source_index, index)
+                        self._lazy[field] = (source, composed[key])
+                    else:
+                        self._lazy[field] = (datamat.__dict__[field], index)
+            else:
+                num_fix = 0
+                for  field in self._fields:
+                    newfield = datamat.field(field)[index]
+                    num_fix = len(newfield)
+                    self.__dict__[field] = newfield
             self._parameters = datamat._parameters.copy()
             for (param, value) in datamat._parameters.iteritems():
                 self.__dict__[param] = value
             self._num_fix = num_fix
     
+    def __getattr__(self, name):
+        # Only called if name is not found in the instance dictionary, i.e.
+        # for fields that have not been materialized yet.
+        lazy = self.__dict__.get('_lazy')
+        if lazy and name in lazy:
+            return self._materialize_field(name)
+        raise AttributeError("'%s' object has no attribute '%s'" % (
+                                type(self).__name__, name))
+
+    def _materialize_field(self, name):
+        (source, index) = self._lazy.pop(name)
+        data = source[index]
+        if isinstance(index, slice):
+            data = data.copy()
+        self.__dict__[name] = data
+        return data
+
+    def materialize(self, fields=None):
+        """
+        Copies lazily filtered fields into the datamat.
+
+        Parameters:
+            fields : list of strings, optional
+                Fields to materialize. Defaults to all fields.
+        Returns:
+            The datamat itself.
+        """
+        if fields is None:
+            fields = self._lazy.keys()
+        for field in fields:
+            if field in self._lazy:
+                if field in self.__dict__:
+                    # The field has been replaced in the meantime
+                    del self._lazy[field]
+                else:
+                    self._materialize_field(field)
+        return self
+
     def __len__(self):
         return self._num_fix
 
@@ -115,10 +430,16 @@ class Datamat(object):
         max_field_val_len = 40
         for field in tmp_fieldnames:
             value_str = '?'
-            dat = self.__dict__[field]
             if len(self) >= 100000:
-                value_str = 'N/A'
-            elif not dat.dtype == np.object:
+                # Avoid reading large (possibly lazy or mapped) fields
+                dtype = self._field_source(field).dtype
+                desc += "%s | %s | %s | %s\n" % (
+                                snip_string_middle(field, 20).rjust(20), 
+                                str(len(self)).center(13),
+                                str(dtype).center(10), 'N/A'.center(20))
+                continue
+            dat = self.field(field)
+            if not dat.dtype == np.object:
                 unique_vals = np.unique(dat)
                 if len(unique_vals) > 5:
                     value_str = '%d unique'%(len(unique_vals))
@@ -168,7 +489,7 @@ class Datamat(object):
         """
         return self.filter(key)
             
-    def filter(self, index): #@ReservedAssignment
+    def filter(self, index, lazy=None): #@ReservedAssignment
         """
         Filters a datamat by different aspects.
         
@@ -188,19 +509,68 @@ class Datamat(object):
             index : array
                 Array-like that contains True for every element that
                 passes the filter; else contains False
+            lazy : boolean, optional
+                If True, the filtered datamat only stores the index and
+                copies a field when it is first accessed. This is much
+                cheaper if only a few fields of a wide datamat are used.
+                Fields are copied from this datamat as it is at the time
+                of the access, so in-place changes of this datamat made 
+                before the access are visible in the filtered one; call
+                materialize() on it first if that is not wanted.
+                Defaults to True for out-of-core datamats and to False
+                otherwise.
         Returns:
             datamat : Datamat Instance
             
             NB: rmuil: should be using type(self) so that subclasses can use this function
             and don't get returned a bare Datamat. Tricky though.
         """
-        return Datamat(datamat=self, index=index)
+        if lazy is None:
+            lazy = self.out_of_core()
+        return Datamat(datamat=self, index=index, lazy=lazy)
 
     def copy(self):
         """
         Returns a copy of the datamat.
         """
-        return self.filter(np.ones(self._num_fix).astype(bool))
+        return self.filter(np.ones(self._num_fix).astype(bool), lazy=False)
+
+    def out_of_core(self):
+        """
+        Returns True if any field of the datamat is (a lazy view of) a 
+        memory mapped array.
+        """
+        return any(is_mapped(self._field_source(field)) 
+                   for field in self._fields)
+
+    def _field_source(self, field):
+        # The array that holds the data of field, without copying lazy fields
+        if field in self.__dict__:
+            return self.__dict__[field]
+        return self._lazy[field][0]
+
+    def iter_chunks(self, chunk_size=None, fields=None):
+        """
+        Iterates over consecutive blocks of elements.
+
+        Only the elements of the current block are read from memory 
+        mapped or lazily filtered fields, such that datamats of any size
+        can be processed with memory proportional to the chunk size.
+
+        Parameters:
+            chunk_size : int, optional
+                Number of elements per block, defaults to CHUNK_SIZE.
+            fields : list of strings, optional
+                Fields that are read, defaults to all fields. Other fields
+                of the yielded datamats are read on access.
+        Returns:
+            iterator over datamats with at most chunk_size elements
+        """
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+        for start in xrange(0, len(self), chunk_size):
+            chunk = self.filter(slice(start, start + chunk_size), lazy=True)
+            yield chunk.materialize(fields)
 
     def copy_empty(self):
         """
@@ -230,33 +600,113 @@ class Datamat(object):
         try:
             return self.__dict__[fieldname]
         except KeyError:
+            if fieldname in self._lazy:
+                return self._materialize_field(fieldname)
             raise ValueError('%s is not a field or parameter of the Datamat'
                     % fieldname)
             
-    def save(self, path):
+    def save(self, path, compression = None, chunk_size = 2**16):
         """
         Saves Datamat to path.
+
+        Fields are stored as chunked datasets that can be extended with
+        append(). Masked arrays keep their masks, fields of strings and
+        fields that contain one sequence per element are stored as 
+        variable length datasets.
         
         Parameters:
             path : string   
                 Absolute path of the file to save to.
+            compression : string or int, optional
+                HDF5 filter used to compress the fields, e.g. 'gzip', 'lzf' 
+                or the id of a registered filter plugin. Default is no 
+                compression.
+            chunk_size : int, optional
+                Number of elements per chunk, also for data appended
+                later. Small datamats that are extended by many appends
+                should keep the default. If None, fields are stored
+                contiguously, which allows to memory map them when they
+                are loaded but not to append to them.
         """
         import h5py
         f = h5py.File(path, 'w')
-        fm_group = f.create_group('Datamat')
-        for field in self.fieldnames():
-            fm_group.create_dataset(field, data = self.__dict__[field])
-        for param in self.parameters():
-            fm_group.attrs[param]=self.__dict__[param]
-        f.close()
+        try:
+            self.tohdf5(f, 'Datamat', compression, chunk_size)
+        finally:
+            f.close()
     
-    def tohdf5(self, h5obj, name):
+    def tohdf5(self, h5obj, name, compression = None, chunk_size = 2**16):
+        """
+        Stores the Datamat in a new group of the h5py file or group h5obj.
+        See save for a description of the parameters.
+        """
         fm_group = h5obj.create_group(name)
+        fm_group.attrs[SCHEMA_VERSION_ATTR] = SCHEMA_VERSION
         for field in self.fieldnames():
-            fm_group.create_dataset(field, data = self.__dict__[field])
+            _create_hdf5_field(fm_group, field, self.field(field), 
+                               compression, chunk_size)
         for param in self.parameters():
             fm_group.attrs[param]=self.__dict__[param]
 
+    def save_npy(self, directory, chunk_size=None):
+        """
+        Saves the Datamat as a directory with one .npy file per field, 
+        which can be memory mapped by load_npy.
+
+        Fields are written chunk by chunk, out-of-core datamats are never
+        read into memory as a whole.
+
+        Parameters:
+            directory : string
+                Path of the directory, it is created if necessary.
+            chunk_size : int, optional
+                Number of elements written at once, defaults to CHUNK_SIZE.
+        """
+        import os, cPickle
+        from numpy.lib.format import open_memmap
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fields = self.fieldnames()
+        outputs = {}
+        for field in fields:
+            source = self._field_source(field)
+            shape = (len(self),) + source.shape[1:]
+            if source.dtype == np.object:
+                # Object arrays can not be mapped, they are pickled at once
+                values = self.field(field)
+                np.save(os.path.join(directory, field + '.npy'), 
+                        ma.getdata(values))
+                if ma.getmask(values) is not ma.nomask:
+                    np.save(os.path.join(directory, field + '.mask.npy'),
+                            ma.getmaskarray(values))
+                continue
+            outputs[field] = [open_memmap(os.path.join(directory, 
+                                          field + '.npy'), mode='w+',
+                                          dtype=source.dtype, shape=shape)]
+            if ma.getmask(source) is not ma.nomask:
+                outputs[field].append(open_memmap(os.path.join(directory,
+                                      field + '.mask.npy'), mode='w+', 
+                                      dtype=bool, shape=shape))
+        offset = 0
+        for chunk in self.iter_chunks(chunk_size, outputs.keys()):
+            for (field, output) in outputs.iteritems():
+                values = chunk.field(field)
+                output[0][offset:offset+len(chunk)] = ma.getdata(values)
+                if len(output) > 1:
+                    output[1][offset:offset+len(chunk)] = \
+                            ma.getmaskarray(values)
+            offset += len(chunk)
+        for output in outputs.itervalues():
+            for array in output:
+                array.flush()
+        f = open(os.path.join(directory, _NPY_MANIFEST), 'wb')
+        try:
+            cPickle.dump({'fields': fields, 'length': len(self),
+                          'parameters': self.parameters()}, f, 
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
                 
     def fieldnames(self):
         """
@@ -299,13 +749,89 @@ class Datamat(object):
             overall_idx : boolean array - the index into the original DataMat
                 used to retrieve this DataMat (only returned if
                  return_overall_idx==True)
+
+        Out-of-core datamats are grouped chunk by chunk and the yielded
+        datamats are lazy views.
         """
-        for value in np.unique(self.__dict__[field]):
-            overall_idx = self.__dict__[field] == value
+        if self.out_of_core():
+            for (group, index) in self._by_field_chunked(field):
+                if return_overall_idx:
+                    overall_idx = np.zeros(len(self), dtype=bool)
+                    overall_idx[index] = True
+                    yield (group, overall_idx)
+                else:
+                    yield group
+            return
+        groups = self.groupby([field])
+        for (i, (_, group)) in enumerate(groups):
             if return_overall_idx:
-                yield (self.filter(overall_idx), overall_idx)
+                yield (group, groups.grouping.mask(i))
             else:
-                yield self.filter(overall_idx)
+                yield group
+
+    def _by_field_chunked(self, field):
+        # Collects the positions of every value chunk by chunk, only the
+        # positions (not the data) of all elements are held in memory.
+        positions = {}
+        offset = 0
+        for chunk in self.iter_chunks(fields=[field]):
+            for (key, index) in Grouping([chunk.field(field)]):
+                positions.setdefault(key, []).append(index + offset)
+            offset += len(chunk)
+        for key in sorted(positions.keys()):
+            index = np.concatenate(positions.pop(key))
+            yield self.filter(index, lazy=True), index
+
+    def groupby(self, fields):
+        """
+        Groups the datamat by the unique combinations of values in fields.
+
+        Parameters:
+            fields : string or list of strings
+                Names of the fields to group by.
+        Returns:
+            groups : instance of GroupBy, which can be iterated over
+                (yielding key, datamat pairs) or aggregated with its agg
+                method.
+        """
+        if isinstance(fields, str):
+            fields = [fields]
+        return GroupBy(self, list(fields))
+
+    def grouping(self, fields):
+        """
+        Returns a Grouping of the unique values in fields.
+
+        The grouping is computed on first use and cached until one of the
+        fields is replaced, removed or renamed, or the datamat is joined
+        with another one. Values that are changed in place are detected
+        by a digest of the fields, which is much cheaper than grouping
+        them again.
+
+        Parameters:
+            fields : string or list of strings
+                Name(s) of the field(s) to group by.
+        Returns:
+            grouping : instance of Grouping
+        """
+        if isinstance(fields, str):
+            fields = [fields]
+        fields = tuple(fields)
+        columns = [self.field(field) for field in fields]
+        grouping = self._groupings.get(fields)
+        if grouping is None or not grouping.is_current(columns):
+            grouping = Grouping(columns)
+            self._groupings[fields] = grouping
+        return grouping
+
+    def invalidate_groupings(self, field=None):
+        """
+        Drops cached groupings that involve field, or all cached groupings
+        if field is None.
+        """
+        for fields in self._groupings.keys():
+            if field is None or field in fields:
+                del self._groupings[fields]
     
     def add_field(self, name, data):
         """
@@ -441,14 +967,20 @@ class Datamat(object):
             raise (ValueError(
                 'Cannot delete field %s. No such field exists'%name))
         self._fields.remove(name)
-        del self.__dict__[name]
+        if name in self._lazy:
+            del self._lazy[name]
+        if name in self.__dict__:
+            del self.__dict__[name]
+        self.invalidate_groupings(name)
 
     def rename_field(self, field, new_name):
         """
         Simply renames a field of the Datamat.
         """
-        self.__dict__[new_name] = self.__dict__.pop(field)
+        self.__dict__[new_name] = self.field(field)
+        del self.__dict__[field]
         self._fields[self._fields.index(field)] = new_name
+        self.invalidate_groupings(field)
 
     def add_parameter(self, name, value):
         """
@@ -523,13 +1055,18 @@ class Datamat(object):
                 raise ValueError("Required field '%s' not in Datamat." % (
                             fieldname))
         avg = []
-        for dmi in self:
-            dat = dmi.field(field_to_avg)[0]
+        # Index the fields directly, creating a filtered datamat for every
+        # element would copy all fields once per element.
+        field_data = self.field(field_to_avg)
+        span_start_idx = self.field('span_start_idx')
+        span_end_idx = self.field('span_end_idx')
+        for idx in xrange(len(self)):
+            dat = field_data[idx]
             if dat is not None:
-                sidx = dmi.span_start_idx[0]
+                sidx = span_start_idx[idx]
                 if ma.is_masked(sidx):
                     sidx = 0
-                eidx = dmi.span_end_idx[0]
+                eidx = span_end_idx[idx]
                 if ma.is_masked(eidx):
                     eidx = -1
                 spandat = dat[sidx:eidx]
@@ -589,11 +1126,12 @@ class Datamat(object):
                 warn("field '%s' doesn't exist in source DataMat, removing." % field)
         # Concatenate fields
         for field in self._fields:
-            self.__dict__[field] = ma.hstack((self.__dict__[field], 
-                fm_new.__dict__[field]))
+            self.__dict__[field] = ma.hstack((self.field(field), 
+                fm_new.field(field)))
 
         # Update _num_fix
         self._num_fix += fm_new._num_fix
+        self.invalidate_groupings()
         
     def join_full(self, dm_new):
         """
@@ -641,11 +1179,12 @@ class Datamat(object):
 
         # Concatenate fields
         for field in self._fields:
-            self.__dict__[field] = ma.hstack((self.__dict__[field], 
-                dm_new.__dict__[field]))
+            self.__dict__[field] = ma.hstack((self.field(field), 
+                dm_new.field(field)))
 
         # Update _num_fix
         self._num_fix += dm_new._num_fix 
+        self.invalidate_groupings()
 
 #def merge (dm_l, dm_r, data_field, key_field):
 #    """
@@ -739,6 +1278,58 @@ class Datamat(object):
 #
 #    self.add_field(data_field, new_data)
 
+def compress_index(index, length):
+    """
+    Converts an index into an array of the given length to the most compact
+    equivalent form: a slice with a positive step if the index is such a
+    slice or selects a contiguous block, otherwise an array of positions.
+
+    Returns:
+        (index, num) : the converted index and the number of selected elements
+    """
+    if isinstance(index, slice):
+        (start, stop, step) = index.indices(length)
+        if step > 0:
+            return slice(start, stop, step), len(xrange(start, stop, step))
+        # The normalized stop of a reversed slice can be -1, which would
+        # select nothing when the slice is used again
+        index = np.arange(start, stop, step)
+    index = np.asarray(index)
+    if index.dtype == np.bool:
+        if len(index) != length:
+            raise IndexError('Boolean index has wrong length: %d instead of %d'
+                                % (len(index), length))
+        positions = np.flatnonzero(index)
+    else:
+        positions = index.astype(int).ravel()
+        if len(positions) > 0 and (positions.max() >= length or
+                                   positions.min() < -length):
+            raise IndexError('Index out of bounds')
+        positions[positions < 0] += length
+    num = len(positions)
+    if num == 0:
+        return slice(0, 0, 1), 0
+    if (positions[-1] - positions[0] + 1 == num and
+            (num == 1 or (np.diff(positions) == 1).all())):
+        return slice(positions[0], positions[-1] + 1, 1), num
+    return positions, num
+
+def compose_index(outer, inner):
+    """
+    Given an index 'outer' (as returned by compress_index) into some array
+    and an index 'inner' into the result of indexing with outer, returns
+    the index that selects the same elements directly from the array.
+    """
+    if isinstance(outer, slice):
+        if isinstance(inner, slice):
+            if outer.step > 0 and inner.step > 0:
+                start = outer.start + inner.start * outer.step
+                stop = outer.start + inner.stop * outer.step
+                return slice(start, stop, outer.step * inner.step)
+            inner = np.arange(inner.start, inner.stop, inner.step)
+        return outer.start + inner * outer.step
+    return outer[inner]
+
 def  get_short_function_name(func):
     """
     Bit of a kludge, to allow automatic determination of field name
@@ -767,11 +1358,11 @@ def flatten(dm):
     #Step 1. Determine which fields need flattening.
     # TODO: a better test for the sequence fields is needed here.
     for f in dm.fieldnames():
-        if (dm.__dict__[f].dtype == np.object) and isiterable(dm.__dict__[f][0]):
+        if (dm.field(f).dtype == np.object) and isiterable(dm.field(f)[0]):
             seqfields += [f]
             dbg(3, "seqfield: %s, %s, %s" % (f, 
-                    type(dm.__dict__[f][0]),
-                    dm.__dict__[f][0].dtype))
+                    type(dm.field(f)[0]),
+                    dm.field(f)[0].dtype))
 
     #Step 2. Determine the amount of elements in the fields to be flattened.
     nelements = []
@@ -833,28 +1424,405 @@ def flatten(dm):
 
     return newdm #newdata, newmask
 
-def load(path):
+# Version of the layout written by Datamat.save. Files without a version
+# attribute were written with one contiguous dataset per field, version 2
+# added the per-chunk statistics.
+SCHEMA_VERSION = 2
+SCHEMA_VERSION_ATTR = '_schema_version'
+# Group that holds the masks of masked fields
+_MASK_GROUP = '_masks'
+# Group that holds the minimum and maximum of every chunk of numeric fields
+_STATS_GROUP = '_stats'
+# File that lists the fields and parameters of a datamat saved by save_npy
+_NPY_MANIFEST = 'datamat.pkl'
+
+def load(path, mmap=False, fields=None, where=None):
     """
     Load datamat at path.
     
     Parameters:
         path : string
             Absolute path of the file to load from.
+        mmap : boolean, optional
+            If True, fields that are stored contiguously and uncompressed
+            (see the chunk_size argument of Datamat.save) are memory mapped
+            instead of read into memory. Ignored if where is given.
+        fields : list of strings, optional
+            Only these fields are read. Defaults to all fields.
+        where : dictionary, optional
+            Maps field names to a value or a list of values. Only elements
+            whose values are among the given ones in all of these fields 
+            are read, e.g. {'category': [7, 9], 'SUBJECTINDEX': range(10)}.
+            Chunks that can not contain matching elements (according to the
+            minimum and maximum stored for every chunk) are skipped.
     """
     import h5py
     f = h5py.File(path,'r')
-    dm = fromhdf5(f['Datamat'])
-    f.close()
+    try:
+        dm = fromhdf5(f['Datamat'], mmap, fields, where)
+    finally:
+        f.close()
     return dm
 
-def fromhdf5(fm_group):
-    dm = {}
+def load_npy(directory, mmap_mode='r'):
+    """
+    Loads a datamat saved by Datamat.save_npy.
+
+    Parameters:
+        directory : string
+            Directory the datamat was saved to.
+        mmap_mode : string or None, optional
+            Mode in which the fields are memory mapped (see np.load). 
+            Defaults to read only, None reads all fields into memory. 
+            Fields of Python objects are always read into memory.
+    Returns:
+        datamat : Datamat
+    """
+    import os, cPickle
+    f = open(os.path.join(directory, _NPY_MANIFEST), 'rb')
+    try:
+        manifest = cPickle.load(f)
+    finally:
+        f.close()
+    fields = {}
+    for field in manifest['fields']:
+        path = os.path.join(directory, field + '.npy')
+        try:
+            values = np.load(path, mmap_mode=mmap_mode)
+        except ValueError:
+            # Object arrays can not be memory mapped
+            values = np.load(path, allow_pickle=True)
+        mask_path = os.path.join(directory, field + '.mask.npy')
+        if os.path.exists(mask_path):
+            values = ma.array(values, mask=np.load(mask_path, 
+                                                   mmap_mode=mmap_mode))
+        fields[field] = values
+    dm = VectorFactory(fields, manifest['parameters'])
+    # Keep the order of the fields and the length of datamats without fields
+    dm._fields = manifest['fields']
+    dm._num_fix = manifest['length']
+    return dm
+
+def fromhdf5(fm_group, mmap=False, fields=None, where=None):
+    """
+    Reads a Datamat from a group written by Datamat.tohdf5.
+    """
+    return VectorFactory(*read_hdf5(fm_group, mmap, fields, where))
+
+def read_hdf5(fm_group, mmap=False, fields=None, where=None):
+    """
+    Reads fields and parameters from a group written by Datamat.tohdf5.
+
+    If mmap is True, fields (and masks) that are stored contiguously are 
+    memory mapped. fields and where select columns and rows as described
+    in load.
+
+    Returns:
+        fields, parameters : dictionaries
+    """
+    version = fm_group.attrs.get(SCHEMA_VERSION_ATTR, 0)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError('Datamat was saved with a newer schema version '+
+                           '(%d), this version reads up to %d' % 
+                           (version, SCHEMA_VERSION))
+    saved = _hdf5_fieldnames(fm_group)
+    if fields is None:
+        fields = saved
+    unknown = set(fields).union(where or {}).difference(saved)
+    if unknown:
+        raise ValueError('%s are not fields of the saved datamat' % 
+                         sorted(unknown))
+    rows = None
+    if where:
+        rows = _select_rows(fm_group, where)
+    values = {}
     params = {}
-    for key, value in fm_group.iteritems():
-        dm[key] = value
+    for key in fields:
+        values[key] = _read_hdf5_field(fm_group, key, mmap, rows)
     for key, value in fm_group.attrs.iteritems():
-        params[key] = value
-    return VectorFactory(dm, params)
+        if key != SCHEMA_VERSION_ATTR:
+            params[key] = value
+    return values, params
+
+def where_mask(fields, where):
+    """
+    Returns a boolean array that is True for all elements whose values
+    are among the allowed ones in every field listed in where. Masked
+    elements never match.
+
+    Parameters:
+        fields : dictionary
+            Maps field names to arrays of the same length.
+        where : dictionary
+            Maps field names to a value or a list of allowed values.
+    """
+    match = None
+    for (field, allowed) in where.iteritems():
+        values = fields[field]
+        field_match = np.in1d(ma.getdata(values), _allowed_values(allowed))
+        field_match &= ~ma.getmaskarray(values)
+        match = field_match if match is None else match & field_match
+    return match
+
+def _allowed_values(allowed):
+    if isinstance(allowed, basestring) or not isiterable(allowed):
+        allowed = [allowed]
+    return np.unique(np.asarray(list(allowed)))
+
+def _hdf5_fieldnames(fm_group):
+    return [k for k in fm_group.keys() if k not in (_MASK_GROUP, 
+                                                     _STATS_GROUP)]
+
+def _select_rows(fm_group, where):
+    """
+    Finds the elements that match where, see load.
+
+    Returns:
+        rows : list of (start, stop, index) tuples, index selects the 
+            matching elements among the elements start to stop.
+    """
+    saved = _hdf5_fieldnames(fm_group)
+    length = fm_group[saved[0]].shape[0] if saved else 0
+    stats = fm_group.get(_STATS_GROUP)
+    chunk_size = max(length, 1)
+    if stats is not None:
+        chunk_size = stats.attrs['chunk_size']
+    num_chunks = -(-length // chunk_size)
+    candidates = np.ones(num_chunks, dtype=bool)
+    for (field, allowed) in where.iteritems():
+        if stats is None or field not in stats:
+            continue
+        field_stats = stats[field][...]
+        if len(field_stats) != num_chunks:
+            # Statistics do not cover the field, e.g. due to an interrupted
+            # append
+            continue
+        allowed = _allowed_values(allowed)
+        # Chunks contain an allowed value if the smallest allowed value 
+        # that is not below their minimum does not exceed their maximum.
+        # Chunks of NaNs have NaN statistics and never match.
+        first = np.searchsorted(allowed, field_stats[:, 0])
+        overlaps = first < len(allowed)
+        overlaps[overlaps] = (allowed[first[overlaps]] <= 
+                              field_stats[overlaps, 1])
+        candidates &= overlaps
+    # Read consecutive candidate chunks at once
+    edges = np.diff(np.concatenate(([0], candidates.view(np.int8), [0])))
+    rows = []
+    for (first, last) in zip(np.flatnonzero(edges == 1), 
+                             np.flatnonzero(edges == -1)):
+        (start, stop) = (first * chunk_size, min(last * chunk_size, length))
+        run = [(start, stop, slice(None))]
+        values = dict((field, _read_hdf5_field(fm_group, field, 
+                                               rows=run)) for field in where)
+        index = np.flatnonzero(where_mask(values, where))
+        if len(index) > 0:
+            rows.append((start, stop, index))
+    return rows
+
+def _chunk_stats(values, chunk_size):
+    """
+    Returns the minimum and maximum (ignoring NaNs) of every chunk of 
+    values as an array with one row per chunk.
+    """
+    starts = np.arange(0, len(values), chunk_size)
+    if len(starts) == 0:
+        return np.empty((0, 2), dtype=values.dtype)
+    return np.column_stack((np.fmin.reduceat(values, starts),
+                            np.fmax.reduceat(values, starts)))
+
+def _has_stats(values):
+    return values.ndim == 1 and values.dtype.kind in 'biuf'
+
+def append(path, dm):
+    """
+    Appends the elements of dm to the datamat saved at path. The datasets
+    in the file are extended in place. If path does not exist, dm is saved
+    to it.
+
+    dm needs to have the same fields as the saved datamat, its parameters
+    are ignored.
+    
+    Parameters:
+        path : string
+            Absolute path of the file to append to.
+        dm : Datamat
+    """
+    import h5py, os
+    if not os.path.exists(path):
+        dm.save(path)
+        return
+    f = h5py.File(path, 'r+')
+    try:
+        fm_group = f['Datamat']
+        if fm_group.attrs.get(SCHEMA_VERSION_ATTR, 0) < 1:
+            raise RuntimeError('Datamats can only be appended to files that'+
+                               ' were saved with schema version 1 or later')
+        saved = _hdf5_fieldnames(fm_group)
+        if sorted(saved) != sorted(dm.fieldnames()):
+            raise ValueError('Fields of the datamat (%s) do not match the '
+                             'saved fields (%s)' % (sorted(dm.fieldnames()),
+                                                    sorted(saved)))
+        # Convert all fields before anything is written, so that a field 
+        # that can not be stored does not leave a partially appended file
+        data = dict((field, _hdf5_data(dm.field(field))) 
+                    for field in saved)
+        stats = fm_group.get(_STATS_GROUP)
+        for field in saved:
+            (values, mask, _, _) = data[field]
+            dataset = fm_group[field]
+            if stats is not None and field in stats:
+                _append_stats(stats[field], values, dataset.shape[0], 
+                              stats.attrs['chunk_size'])
+            masks = fm_group.require_group(_MASK_GROUP)
+            if mask is not None and field not in masks:
+                # The saved elements are not masked
+                _create_dataset(masks, field, 
+                                np.zeros(dataset.shape, dtype=bool),
+                                None, dataset.chunks[0])
+            _append_dataset(dataset, values)
+            if field in masks:
+                if mask is None:
+                    mask = np.zeros(values.shape, dtype=bool)
+                _append_dataset(masks[field], mask)
+    finally:
+        f.close()
+
+def _create_hdf5_field(fm_group, field, values, compression, chunk_size):
+    (values, mask, dtype, kind) = _hdf5_data(values)
+    dataset = _create_dataset(fm_group, field, values, compression, 
+                              chunk_size, dtype)
+    if kind is not None:
+        dataset.attrs['kind'] = kind
+    if mask is not None:
+        _create_dataset(fm_group.require_group(_MASK_GROUP), field, mask, 
+                        compression, chunk_size)
+    if chunk_size is not None and _has_stats(values):
+        stats = fm_group.require_group(_STATS_GROUP)
+        stats.attrs['chunk_size'] = chunk_size
+        _create_dataset(stats, field, _chunk_stats(values, chunk_size), 
+                        None, 1024)
+
+def _append_stats(stats, values, old_length, chunk_size):
+    # The last saved chunk is filled up first
+    fill = -old_length % chunk_size
+    if fill > 0 and len(values) > 0:
+        head = values[:fill]
+        last = stats[-1]
+        stats[-1] = (np.fmin(last[0], np.fmin.reduce(head)),
+                     np.fmax(last[1], np.fmax.reduce(head)))
+    _append_dataset(stats, _chunk_stats(values[fill:], chunk_size))
+
+def _create_dataset(group, name, values, compression, chunk_size, 
+                    dtype = None):
+    if dtype is None:
+        dtype = values.dtype
+    if chunk_size is None:
+        dataset = group.create_dataset(name, shape = values.shape, 
+                                       dtype = dtype, 
+                                       compression = compression)
+    else:
+        # The chunk shape must not depend on the length of the first
+        # save, later appends are stored in chunks of the same shape
+        chunks = (chunk_size,) + values.shape[1:]
+        dataset = group.create_dataset(name, shape = values.shape, 
+                                   dtype = dtype, 
+                                   maxshape = (None,) + values.shape[1:], 
+                                   chunks = chunks, compression = compression)
+    if len(values) > 0:
+        dataset[...] = values
+    return dataset
+
+def _append_dataset(dataset, values):
+    if dataset.maxshape[0] is not None:
+        # Datasets of files written before schema version 1 are not chunked
+        raise RuntimeError('Dataset %s can not be extended' % dataset.name)
+    old_length = dataset.shape[0]
+    dataset.resize((old_length + len(values),) + dataset.shape[1:])
+    if len(values) > 0:
+        dataset[old_length:] = values
+
+def _hdf5_data(values):
+    """
+    Converts a field into (data, mask, dtype, kind) that can be stored in 
+    HDF5. Unicode fields and object fields that hold strings or 1D 
+    sequences are converted to variable length types, kind records the
+    original kind of these fields.
+    """
+    import h5py
+    mask = None
+    if isinstance(values, ma.MaskedArray):
+        if ma.getmask(values) is not ma.nomask:
+            mask = ma.getmaskarray(values)
+        values = ma.getdata(values)
+    values = np.asarray(values)
+    kind = values.dtype.kind
+    if kind == 'U':
+        values = values.astype(object)
+    elif kind != 'O':
+        return values, mask, None, None
+    elements = values.ravel()
+    if all(isinstance(e, basestring) for e in elements):
+        return values, mask, h5py.special_dtype(vlen = unicode), kind
+    try:
+        sequences = [np.asarray(e) for e in elements]
+        if any(s.ndim != 1 or s.dtype.kind not in 'biuf' 
+               for s in sequences):
+            raise TypeError
+    except TypeError:
+        raise ValueError('Only object fields of strings or of 1D numeric '+
+                         'sequences can be saved')
+    dtype = np.result_type(*sequences) if sequences else np.float64
+    converted = np.empty(values.shape, dtype = object)
+    flat = converted.ravel()
+    for (i, sequence) in enumerate(sequences):
+        flat[i] = sequence.astype(dtype)
+    return converted, mask, h5py.special_dtype(vlen = dtype), kind
+
+def _read_hdf5_field(fm_group, field, mmap=False, rows=None):
+    """
+    Reads a field (and its mask) from fm_group. If rows is given (see
+    _select_rows), only the selected elements are read.
+    """
+    dataset = fm_group[field]
+    kind = dataset.attrs.get('kind')
+    values = _read_dataset(dataset, mmap and kind is None, rows)
+    if kind == 'U':
+        values = values.astype(unicode)
+    masks = fm_group.get(_MASK_GROUP)
+    if masks is not None and field in masks:
+        mask = _read_dataset(masks[field], mmap, rows)
+        values = ma.array(values, mask = mask)
+    return values
+
+def _read_dataset(dataset, mmap, rows):
+    if rows is not None:
+        parts = [dataset[start:stop][index] for (start, stop, index) in rows]
+        if len(parts) == 0:
+            return dataset[0:0]
+        return np.concatenate(parts)
+    if mmap:
+        return memmap_dataset(dataset)
+    return dataset[...]
+
+def memmap_dataset(dataset):
+    """
+    Returns a read-only memory map of an HDF5 dataset. Datasets that are
+    not stored contiguously (or are empty) are read into memory.
+    """
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.size == 0:
+        return dataset[...]
+    return np.memmap(dataset.file.filename, mode = 'r', 
+                     dtype = dataset.dtype, shape = dataset.shape, 
+                     offset = offset)
+
+def is_mapped(values):
+    """
+    Returns True if values (or the data of a masked array) is a memory 
+    mapped array.
+    """
+    return isinstance(ma.getdata(values), np.memmap)
  
 def VectorFactory(fields, parameters={}):
     """
@@ -899,59 +1867,212 @@ def VectorFactory(fields, parameters={}):
     fm._num_fix = len(fm.__dict__[fields.keys()[0]])
     return fm
 
+class ColumnBuffer(object):
+    """
+    Growable array that collects the values of one field.
+
+    The buffer grows geometrically, such that appending n elements takes
+    O(n) time. Its dtype is taken from the first value and promoted (as 
+    np.array would) if later values need it. If the values have different
+    shapes, the buffer falls back to dtype object. Missing elements are 
+    masked (and NaN in floating point buffers).
+    """
+
+    def __init__(self):
+        self.data = None
+        self.mask = None
+        self.length = 0
+        # Type of the last appended scalar, values of this type can be
+        # stored without checking the dtype again
+        self.scalar_type = None
+
+    def __len__(self):
+        return self.length
+
+    def append(self, value):
+        """
+        Appends a single element.
+        """
+        if type(value) is not self.scalar_type:
+            self._prepare(np.asarray(value), 1)
+            if isinstance(value, (bool, int, long, float, np.number, 
+                                  np.bool_)):
+                self.scalar_type = type(value)
+        elif self.length == len(self.data):
+            self._reserve(self.length + 1)
+        self.data[self.length] = value
+        self.length += 1
+
+    def extend(self, values):
+        """
+        Appends all elements of an array, masked elements stay masked.
+        """
+        self._prepare(np.asanyarray(values), len(values), element=False)
+        end = self.length + len(values)
+        if self.data.ndim < np.ndim(values):
+            # Rows are stored as objects
+            for (i, row) in enumerate(ma.getdata(values)):
+                self.data[self.length + i] = row
+        else:
+            self.data[self.length:end] = ma.getdata(values)
+        if ma.getmask(values) is not ma.nomask:
+            self._require_mask()
+        if self.mask is not None:
+            mask = ma.getmaskarray(values)
+            if self.mask.ndim < mask.ndim:
+                mask = mask.reshape(len(mask), -1).all(1)
+            self.mask[self.length:end] = mask
+        self.length = end
+
+    def pad(self, count):
+        """
+        Appends count missing elements.
+        """
+        self._require_mask()
+        if self.data is None:
+            # Created once the first value determines the dtype
+            self.length += count
+            return
+        self._reserve(self.length + count)
+        self._fill_missing(self.length, self.length + count)
+        self.length += count
+
+    def finalize(self):
+        """
+        Returns the collected elements as an array (or a masked array if
+        elements are missing) of the exact size.
+        """
+        data = self.data[:self.length].copy()
+        if self.mask is None:
+            return data
+        return ma.array(data, mask = self.mask[:self.length].copy())
+
+    def _prepare(self, values, count, element=True):
+        # Makes room for count values, promoting the dtype or shape of the 
+        # buffer if necessary
+        shape = values.shape if element else values.shape[1:]
+        if self.data is None:
+            padded = self.length
+            self.length = 0
+            self.data = np.empty((max(padded + count, 16),) + shape,
+                                 dtype = values.dtype)
+            if self.mask is not None:
+                self.mask = np.zeros(self.data.shape, dtype = bool)
+                self.pad(padded)
+            return
+        dtype = np.result_type(self.data.dtype, values.dtype)
+        if shape != self.data.shape[1:] and self.data.dtype != np.object:
+            dtype = np.dtype(np.object)
+        if dtype == np.object and self.data.ndim > 1:
+            # Elements of different shape are stored as objects
+            old = self.data[:self.length]
+            self.data = np.empty(len(self.data), dtype = dtype)
+            for (i, row) in enumerate(old):
+                self.data[i] = row
+            if self.mask is not None:
+                self.mask = self.mask.reshape(len(self.mask), -1).all(1)
+        elif dtype != self.data.dtype:
+            # Only the filled part is converted
+            data = np.empty(self.data.shape, dtype = dtype)
+            data[:self.length] = self.data[:self.length]
+            self.data = data
+            self.scalar_type = None
+        self._reserve(self.length + count)
+
+    def _reserve(self, capacity):
+        if capacity <= len(self.data):
+            return
+        capacity = max(capacity, 2 * len(self.data))
+        data = np.empty((capacity,) + self.data.shape[1:], 
+                        dtype = self.data.dtype)
+        data[:self.length] = self.data[:self.length]
+        self.data = data
+        if self.mask is not None:
+            mask = np.zeros(data.shape, dtype = bool)
+            mask[:self.length] = self.mask[:self.length]
+            self.mask = mask
+
+    def _require_mask(self):
+        if self.mask is None:
+            shape = self.data.shape if self.data is not None else 0
+            self.mask = np.zeros(shape, dtype = bool)
+
+    def _fill_missing(self, start, end):
+        self.mask[start:end] = True
+        if self.data.dtype.kind in 'fc':
+            self.data[start:end] = np.nan
+        elif self.data.dtype == np.object:
+            self.data[start:end] = None
+        elif self.data.dtype.kind in 'SU':
+            self.data[start:end] = ''
+        else:
+            self.data[start:end] = 0
+
+
 class AccumulatorFactory(object):
+    """
+    Accumulates single elements (dictionaries that map field names to
+    values) and creates a datamat from them.
+
+    Every field is collected in a ColumnBuffer. Elements that lack a field
+    that other elements have are masked in this field.
+    """
     
     def __init__(self):
-        self.d = {}
+        self.columns = {}
+        self.length = 0
 
     def update(self, a):
-        if len(self.d.keys()) == 0:
-            self.d = dict((k,[v]) for k,v in a.iteritems())
-        else:
-            # For all fields in a that are also in dict
-            all_keys = set(a.keys() + self.d.keys())
-            for key in all_keys:
-                if key in a.keys():
-                    value = a[key]
-                if not key in self.d.keys():
-                    # key is not yet in d. add it
-                    self.d[key] = [np.nan]*len(self.d[self.d.keys()[0]])
-                if not key in a.keys():
-                    # key is not in new data. value should be nan
-                    value = np.nan
-                self.d[key].extend([value])
+        for (key, value) in a.iteritems():
+            column = self.columns.get(key)
+            if column is None:
+                column = ColumnBuffer()
+                if self.length > 0:
+                    column.pad(self.length)
+                self.columns[key] = column
+            column.append(value)
+        self.length += 1
+        if len(a) < len(self.columns):
+            for column in self.columns.itervalues():
+                if len(column) < self.length:
+                    column.pad(1)
     
     def get_dm(self, params = None):
         if params is None:
             params = {}
-        return VectorFactory(self.d, params)
+        fields = dict((key, column.finalize()) for (key, column) 
+                      in self.columns.iteritems())
+        return VectorFactory(fields, params)
 
 class DatamatAccumulator(object):
+    """
+    Accumulates datamats and joins them into one datamat. 
+    
+    The fields of every datamat are copied into a ColumnBuffer when it
+    is added, get_dm then copies every field once more. Only fields that 
+    all datamats have are retained, the parameters are taken from the 
+    first datamat.
+    """
     def __init__(self):
-        self.l = []
+        self.columns = None
+        self.parameters = None
 
     def update(self, dm):
-        self.l.append(dm.copy())
+        if self.columns is None:
+            self.columns = dict((field, ColumnBuffer()) 
+                                for field in dm.fieldnames())
+            self.parameters = dm.parameters().copy()
+        for field in self.columns.keys():
+            if field not in dm.fieldnames():
+                del self.columns[field]
+        for (field, column) in self.columns.iteritems():
+            column.extend(dm.field(field))
 
     def get_dm(self):
-        # More efficient join
-        length=0
-        names = set(self.l[0].fieldnames())
-        for d in self.l:
-            length += len(d)
-            names = names.intersection(d.fieldnames())
-        dm_all = self.l[0].copy()
-        dm_all._num_fix = length
-        for f in names:
-            dm_all.rm_field(f)
-            dm_all.add_field(f, np.ones((length,)))
-            offset = 0
-            for d in self.l:
-                val = d.field(f)
-                dm_all.field(f)[offset:offset+len(d)] = val
-                offset = offset+len(d)
-        return dm_all
-                
+        fields = dict((field, column.finalize()) for (field, column) 
+                      in self.columns.iteritems())
+        return VectorFactory(fields, self.parameters.copy())
+
 
 def DatamatFromRecordArray(arr):
     d = dict((k, arr[k][0][0].flatten()) for k in arr.dtype.fields)
@@ -4,15 +4,23 @@
 Most importantly, it houses some Factories to create fixation data
 and the compute_fdm method.
 """
+import os
 from os.path import join
 from glob import glob
+from multiprocessing import Pool, cpu_count
+from warnings import warn
+import cPickle
+import hashlib
 import h5py
 
 import numpy as np
 from scipy.io import loadmat
-from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.filters import correlate1d
+from scipy.fftpack import next_fast_len
 
+import datamat
 from datamat import Datamat
+from utils import LRUCache
 
 class FixMat(Datamat):
 
@@ -137,30 +145,45 @@ class FixMat(Datamat):
                 all_ctrls = np.hstack((all_ctrls, controls[1:, :]))
         return (all_act[:, 1:], all_ctrls[:, 1:]) # first column was dummy 
 
-def load(path):
+def load(path, fields=None, where=None):
     """
     Load fixmat at path.
     
     Parameters:
         path : string
             Absolute path of the file to load from.
+        fields : list of strings, optional
+            Only these fields are read. Defaults to all fields.
+        where : dictionary, optional
+            Maps field names to a value or a list of values, only fixations
+            that have one of these values in every listed field are read:
+
+                >>> fm = load(path, fields=['x', 'y'], 
+                              where={'category': [7, 9]})
+
+            Chunks of the file that can not contain matching fixations are
+            not read, see datamat.load.
     """
     f = h5py.File(path,'r')
-    if 'Fixmat' in f:
-      fm_group = f['Fixmat']
-    else:
-      fm_group = f['Datamat']
-    fields = {}
-    params = {}
-    for field, value in fm_group.iteritems():
-        fields[field] = np.array(value)
-    for param, value in fm_group.attrs.iteritems():
-        params[param] = value
-    f.close()
+    try:
+        if 'Fixmat' in f:
+          fm_group = f['Fixmat']
+        else:
+          fm_group = f['Datamat']
+        fields, params = datamat.read_hdf5(fm_group, fields=fields, 
+                                           where=where)
+    finally:
+        f.close()
     return VectorFixmatFactory(fields, params)
 
 
-def compute_fdm(fixmat, fwhm=2, scale_factor=1):
+# Recently computed fdms, see compute_fdm
+fdm_cache = LRUCache(16)
+# Gaussian kernels for all (fwhm, pixels_per_degree, scale_factor) combinations
+# that have been used so far
+_kernel_cache = {}
+
+def compute_fdm(fixmat, fwhm=2, scale_factor=1, use_cache=True):
     """
     Computes a fixation density map for the calling fixmat. 
     
@@ -182,6 +205,15 @@ def compute_fdm(fixmat, fwhm=2, scale_factor=1):
         scale_factor : float
             scale factor for the resulting fdm. Default is 1. Scale_factor
             must be a float specifying the fraction of the current size.
+
+        use_cache : bool
+            If True (default), the fdm is looked up in and stored to 
+            fixmat.fdm_cache. The cache is keyed by the fixation 
+            coordinates and the parameters of the fdm, such that different
+            measures that evaluate the same fixations compute the fdm
+            only once.
+
+    Out-of-core fixmats are histogrammed chunk by chunk.
         
     Returns:
         fdm  : numpy.array 
@@ -192,19 +224,221 @@ def compute_fdm(fixmat, fwhm=2, scale_factor=1):
     assert (len(fixmat.image_size) == 2 and (fixmat.image_size[0] > 0) and
         (fixmat.image_size[1] > 0)), 'The image_size is either 0, or not 2D'
     # check whether fixmat contains fixations
-    if fixmat._num_fix == 0 or len(fixmat.x) == 0 or len(fixmat.y) == 0 :
+    if fixmat._num_fix == 0:
         raise RuntimeError('There are no fixations in the fixmat.')
     assert not scale_factor <= 0, "scale_factor has to be > 0"
-    # this specifies left edges of the histogram bins, i.e. fixations between
-    # ]0 binedge[0]] are included. --> fixations are ceiled
-    e_y = np.arange(0, np.round(scale_factor*fixmat.image_size[0]+1))
-    e_x = np.arange(0, np.round(scale_factor*fixmat.image_size[1]+1))
-    samples = np.array(zip((scale_factor*fixmat.y), (scale_factor*fixmat.x)))
-    (hist, _) = np.histogramdd(samples, (e_y, e_x))
-    kernel_sigma = fwhm * fixmat.pixels_per_degree * scale_factor
-    kernel_sigma = kernel_sigma / (2 * (2 * np.log(2)) ** .5)
-    fdm = gaussian_filter(hist, kernel_sigma, order=0, mode='constant')
-    return fdm / fdm.sum()
+    if use_cache:
+        key = _fdm_key(fixmat, fwhm, scale_factor)
+        fdm = fdm_cache.get(key)
+        if fdm is not None:
+            # Callers are allowed to modify the fdm in place
+            return fdm.copy()
+    shape = fdm_shape(fixmat.image_size, scale_factor)
+    hist = np.zeros(shape)
+    for (y, x) in _coordinate_chunks(fixmat):
+        hist += fixation_histogram(scale_factor * np.asarray(y),
+                                   scale_factor * np.asarray(x), shape)
+    kernel = gaussian_kernel(fwhm, fixmat.pixels_per_degree, scale_factor)
+    fdm = smooth_histogram(hist, kernel)
+    fdm /= fdm.sum()
+    if use_cache:
+        fdm_cache[key] = fdm.copy()
+    return fdm
+
+def _fdm_key(fixmat, fwhm, scale_factor):
+    # Hash all y coordinates before all x coordinates, chunk by chunk
+    digests = [hashlib.sha1(), hashlib.sha1()]
+    for chunk in _coordinate_chunks(fixmat):
+        for (coords, coords_digest) in zip(chunk, digests):
+            coords = np.ascontiguousarray(coords, dtype=float)
+            coords_digest.update(coords.view(np.uint8))
+    digest = hashlib.sha1()
+    for coords_digest in digests:
+        digest.update(coords_digest.digest())
+    digest.update(repr((tuple(fixmat.image_size), fixmat.pixels_per_degree,
+                        fwhm, scale_factor)))
+    return digest.digest()
+
+def _coordinate_chunks(fixmat):
+    # Yields (y, x) pairs, in chunks if the fixmat is out-of-core
+    if not fixmat.out_of_core():
+        yield fixmat.y, fixmat.x
+        return
+    for chunk in fixmat.iter_chunks(fields=['y', 'x']):
+        yield chunk.y, chunk.x
+
+def fdm_shape(image_size, scale_factor=1):
+    """
+    Returns the shape of a fdm for images of size image_size that is 
+    scaled by scale_factor.
+    """
+    return (int(np.round(scale_factor * image_size[0] + 1)) - 1,
+            int(np.round(scale_factor * image_size[1] + 1)) - 1)
+
+def fixation_histogram(y, x, shape):
+    """
+    Counts the fixations that fall into every pixel of an image.
+
+    Bins are left-closed unit intervals, except for the last bin along
+    each dimension which also includes its right edge (as in 
+    np.histogramdd). Fixations outside of the image are ignored.
+
+    Parameters:
+        y, x : arrays
+            Fixation coordinates in pixels
+        shape : tuple
+            Size of the histogram, (height, width)
+    Returns:
+        hist : float array of size shape
+    """
+    (valid, pixels) = pixel_index(y, x, shape)
+    hist = np.bincount(pixels, minlength=shape[0] * shape[1])
+    return hist.reshape(shape).astype(float)
+
+def pixel_index(y, x, shape):
+    """
+    Finds the pixel that every fixation falls into, with the same binning
+    as fixation_histogram.
+
+    Returns:
+        (valid, pixels) : valid is a boolean array that is True for all
+            fixations on the image, pixels contains the linear index 
+            (row * width + col) of the pixel for every valid fixation.
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.asarray(x, dtype=float)
+    (height, width) = shape
+    with np.errstate(invalid='ignore'):
+        valid = (y >= 0) & (y <= height) & (x >= 0) & (x <= width)
+    row = np.floor(y[valid]).astype(np.intp)
+    col = np.floor(x[valid]).astype(np.intp)
+    row[row == height] = height - 1
+    col[col == width] = width - 1
+    return valid, row * width + col
+
+def compute_fdm_stack(fm, by=['category', 'filenumber'], fwhm=2,
+                      scale_factor=1):
+    """
+    Computes one fixation density map for every unique combination of
+    values in the fields given by 'by'.
+
+    All fixations are histogrammed with a single np.bincount and the
+    Gaussian is applied along the image axes of the stack only, which is
+    much faster than calling compute_fdm for every group. 
+    
+    Parameters:
+        fm : fixmat
+        by : list of strings
+            Fields to group fixations by. Default is category and 
+            filenumber, i.e. one fdm per image.
+        fwhm, scale_factor : see compute_fdm
+
+    Returns:
+        (fdms, keys) : fdms is a float32 array of shape (len(keys), height,
+            width), fdms[i] is the fdm of the fixations with keys[i]. keys
+            has the same format as in Datamat.grouping().keys.
+    """
+    assert (len(fm.image_size) == 2 and (fm.image_size[0] > 0) and
+        (fm.image_size[1] > 0)), 'The image_size is either 0, or not 2D'
+    if len(fm) == 0:
+        raise RuntimeError('There are no fixations in the fixmat.')
+    assert not scale_factor <= 0, "scale_factor has to be > 0"
+    grouping = fm.grouping(by)
+    shape = fdm_shape(fm.image_size, scale_factor)
+    (valid, pixels) = pixel_index(scale_factor * np.asarray(fm.y),
+                                   scale_factor * np.asarray(fm.x), shape)
+    num_pixels = shape[0] * shape[1]
+    # Valid fixations sorted by group, such that the fixations of a chunk
+    # of groups are a contiguous block
+    ordered = grouping.order[valid[grouping.order]]
+    all_pixels = np.empty(len(valid), dtype=pixels.dtype)
+    all_pixels[valid] = pixels
+    (codes, pixels) = (grouping.inverse[ordered], all_pixels[ordered])
+    kernel = gaussian_kernel(fwhm, fm.pixels_per_degree, scale_factor)
+    stack = np.empty((len(grouping),) + shape, dtype=np.float32)
+    # Histogram and smooth in chunks of maps to bound the size of 
+    # temporary arrays
+    chunk = max(1, STACK_CHUNK_SIZE // num_pixels)
+    for start in xrange(0, len(stack), chunk):
+        num = min(chunk, len(stack) - start)
+        (first, last) = np.searchsorted(codes, [start, start + num])
+        hist = np.bincount((codes[first:last] - start) * num_pixels + 
+                           pixels[first:last], minlength=num * num_pixels)
+        hist = hist.astype(np.float32).reshape((num,) + shape)
+        fdms = smooth_histogram(hist, kernel, axes=(1, 2))
+        fdms /= fdms.sum(axis=2).sum(axis=1).reshape(-1, 1, 1)
+        stack[start:start + num] = fdms
+    return stack, grouping.keys
+
+# Number of pixels that compute_fdm_stack smoothes at once
+STACK_CHUNK_SIZE = 2 ** 24
+
+def gaussian_kernel(fwhm, pixels_per_degree, scale_factor=1):
+    """
+    Returns the 1D Gaussian kernel that is used to smooth fixation
+    histograms into fdms.
+
+    The kernel is truncated at 4 standard deviations and normalized to
+    sum to one, i.e. it is the kernel that gaussian_filter would use. 
+    Kernels are computed only once for every set of parameters.
+    
+    Returns:
+        kernel : array, or None if the kernel width is zero
+    """
+    key = (fwhm, pixels_per_degree, scale_factor)
+    if key not in _kernel_cache:
+        kernel_sigma = fwhm * pixels_per_degree * scale_factor
+        kernel_sigma = kernel_sigma / (2 * (2 * np.log(2)) ** .5)
+        if kernel_sigma <= 1e-15:
+            kernel = None
+        else:
+            radius = int(4.0 * kernel_sigma + 0.5)
+            kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / 
+                                    float(kernel_sigma)) ** 2)
+            kernel /= kernel.sum()
+        _kernel_cache[key] = kernel
+    return _kernel_cache[key]
+
+def smooth_histogram(hist, kernel, axes=(0, 1)):
+    """
+    Smoothes a fixation histogram by separable convolution with a
+    kernel from gaussian_kernel. Values outside of the histogram are
+    assumed to be zero.
+
+    Long kernels are applied in the frequency domain, which is 
+    considerably faster for the kernel sizes that are typical for 
+    full resolution fdms.
+    """
+    fdm = np.asarray(hist)
+    if fdm.dtype.kind != 'f':
+        fdm = fdm.astype(float)
+    if kernel is None:
+        return fdm.copy()
+    for axis in axes:
+        if len(kernel) > FFT_KERNEL_SIZE:
+            fdm = _fft_correlate1d(fdm, kernel, axis)
+        else:
+            fdm = correlate1d(fdm, kernel, axis=axis, mode='constant')
+    return fdm
+
+# Kernels longer than this are applied by smooth_histogram via the FFT
+FFT_KERNEL_SIZE = 64
+
+def _fft_correlate1d(data, kernel, axis):
+    # The kernel is symmetric, so the correlation is the central part
+    # of the full convolution.
+    length = data.shape[axis]
+    nfft = next_fast_len(length + len(kernel) - 1)
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    spectrum = (np.fft.rfft(data, nfft, axis=axis) * 
+                np.fft.rfft(kernel, nfft).reshape(shape))
+    result = np.fft.irfft(spectrum, nfft, axis=axis)
+    index = [slice(None)] * data.ndim
+    offset = (len(kernel) - 1) // 2
+    index[axis] = slice(offset, offset + length)
+    # Remove negative round off errors
+    return np.maximum(result[tuple(index)], 0).astype(data.dtype, copy=False)
 
 def relative_bias(fm,  scale_factor = 1, estimator = None):
     """
@@ -249,10 +483,17 @@ def relative_bias(fm,  scale_factor = 1, estimator = None):
     return hist
      
                                              
-def DirectoryFixmatFactory(directory, categories = None, glob_str = '*.mat', var_name = 'fixmat'):
+def DirectoryFixmatFactory(directory, categories = None, glob_str = '*.mat', 
+                           var_name = 'fixmat', multiproc = False, 
+                           n_jobs = None, cache_dir = None):
     """
     Concatenates all fixmats in dir and returns the resulting single
     fixmat.
+
+    All files are parsed first and then copied once into fields that are
+    allocated for the total number of fixations. Fields that do not exist
+    in all files are removed (with a warning). The parameters are taken
+    from the first file.
     
     Parameters:
         directory : string
@@ -264,6 +505,15 @@ def DirectoryFixmatFactory(directory, categories = None, glob_str = '*.mat', var
             A regular expression that defines which mat files are picked up.
         var_name : string
             The variable to load from the mat file.
+        multiproc : boolean, optional
+            If True, the mat files are parsed by n_jobs processes.
+        n_jobs : int, optional
+            Number of processes, defaults to the number of CPUs.
+        cache_dir : string, optional
+            If given, the fields of every parsed file are stored as an 
+            HDF5 shard in this directory. Files whose path, size and
+            modification time did not change are read from their shard
+            instead of being parsed again.
     Returns:
         f_all : instance of FixMat
             Contains all fixmats that were found in given directory
@@ -273,14 +523,144 @@ def DirectoryFixmatFactory(directory, categories = None, glob_str = '*.mat', var
     if len(files) == 0:
         raise ValueError("Could not find any fixmats in " + 
             join(directory, glob_str))
-    f_all = FixmatFactory(files.pop(), categories, var_name)
-    for fname in files:
-        f_current = FixmatFactory(fname, categories, var_name)
-        f_all.join(f_current)
-    return f_all
+    # The last file found comes first
+    files.insert(0, files.pop())
+    cache = None
+    if cache_dir is not None:
+        cache = _ShardCache(cache_dir)
+    parsed = [None] * len(files)
+    if cache is not None:
+        parsed = [cache.get(fname, var_name) for fname in files]
+    missing = [i for (i, result) in enumerate(parsed) if result is None]
+    tasks = [(files[i], var_name) for i in missing]
+    if multiproc and len(tasks) > 1:
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = cpu_count()
+        pool = Pool(processes = min(n_jobs, len(tasks)))
+        try:
+            results = pool.map(_parse_fixmat_task, tasks, chunksize = 1)
+        finally:
+            pool.terminate()
+    else:
+        results = map(_parse_fixmat_task, tasks)
+    for (i, result) in zip(missing, results):
+        parsed[i] = result
+        if cache is not None:
+            cache.put(files[i], var_name, result)
+    if cache is not None:
+        cache.save()
+    return _concatenate_fixmats(parsed, categories)
+
+def _parse_fixmat_task(task):
+    (fixmatfile, var_name) = task
+    return _read_fixmat_file(fixmatfile, var_name)
+
+def _concatenate_fixmats(parsed, categories):
+    """
+    Joins (fields, parameters, num_fix) tuples into one fixmat with one 
+    copy per field.
+    """
+    (first, parameters, _) = parsed[0]
+    names = [name for name in first.keys() 
+             if all(name in columns for (columns, _, _) in parsed)]
+    dropped = set().union(*[columns.keys() for (columns, _, _) in parsed])
+    for name in sorted(dropped.difference(names)):
+        warn("field '%s' doesn't exist in all fixmats, removing." % name)
+    num_fix = sum(length for (_, _, length) in parsed)
+    fields = {}
+    for name in names:
+        parts = [columns[name] for (columns, _, _) in parsed]
+        values = np.empty((num_fix,) + parts[0].shape[1:], 
+                          dtype = np.result_type(*parts))
+        offset = 0
+        for part in parts:
+            values[offset:offset + len(part)] = part
+            offset += len(part)
+        fields[name] = values
+    return _fixmat_from_columns(fields, parameters, num_fix, categories)
+
+class _ShardCache(object):
+    """
+    Stores the fields of parsed mat files as HDF5 shards in a directory.
+
+    A manifest maps (file path, variable name) to the size and 
+    modification time of the file when it was parsed, the name of its
+    shard and its parameters (which are kept as they are, i.e. pickled).
+    """
 
+    manifest_name = 'manifest.pkl'
 
-def FixmatFactory(fixmatfile, categories = None, var_name = 'fixmat', field_name='x'):
+    def __init__(self, cache_dir):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.manifest = {}
+        self.stamps = {}
+        self.changed = False
+        path = join(cache_dir, self.manifest_name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.manifest = cPickle.load(f)
+
+    def get(self, fixmatfile, var_name):
+        """
+        Returns (fields, parameters, num_fix) of fixmatfile if its shard
+        is current, otherwise None.
+        """
+        key = (os.path.abspath(fixmatfile), var_name)
+        stat = os.stat(fixmatfile)
+        # Remember the state of the file before it is parsed
+        self.stamps[key] = (stat.st_size, stat.st_mtime)
+        entry = self.manifest.get(key)
+        if entry is None or entry['stamp'] != self.stamps[key]:
+            return None
+        path = join(self.cache_dir, entry['shard'])
+        if not os.path.exists(path):
+            return None
+        f = h5py.File(path, 'r')
+        try:
+            (columns, _) = datamat.read_hdf5(f['Datamat'])
+        finally:
+            f.close()
+        return columns, entry['parameters'], entry['num_fix']
+
+    def put(self, fixmatfile, var_name, parsed):
+        """
+        Stores the result of parsing fixmatfile. Files whose fields can not
+        be stored in HDF5 are not cached.
+        """
+        (columns, parameters, num_fix) = parsed
+        key = (os.path.abspath(fixmatfile), var_name)
+        if len(columns) == 0 or key not in self.stamps:
+            return
+        shard = hashlib.sha1(repr(key)).hexdigest() + '.hdf5'
+        path = join(self.cache_dir, shard)
+        try:
+            datamat.VectorFactory(columns, {}).save(path + '.tmp', 
+                                                    chunk_size = None)
+            os.rename(path + '.tmp', path)
+        except (ValueError, TypeError):
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            return
+        self.manifest[key] = {'stamp': self.stamps[key], 'shard': shard,
+                              'parameters': parameters, 'num_fix': num_fix}
+        self.changed = True
+
+    def save(self):
+        """
+        Writes the manifest if it changed.
+        """
+        if not self.changed:
+            return
+        path = join(self.cache_dir, self.manifest_name)
+        with open(path + '.tmp', 'wb') as f:
+            cPickle.dump(self.manifest, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+        self.changed = False
+
+def FixmatFactory(fixmatfile, categories = None, var_name = 'fixmat', 
+                  field_name='x', fields = None, where = None):
     """
     Loads a single fixmat (fixmatfile).
     
@@ -289,6 +669,36 @@ def FixmatFactory(fixmatfile, categories = None, var_name = 'fixmat', field_name
             The matlab fixmat that should be loaded.
         categories : instance of stimuli.Categories, optional
             Links data in categories to data in fixmat.
+        fields : list of strings, optional
+            Fields to keep, defaults to all fields.
+        where : dictionary, optional
+            Keeps only fixations that match, see load. 
+
+    The mat file is always parsed as a whole, fields and where only reduce
+    the memory held by the resulting fixmat.
+    """
+    (columns, parameters, num_fix) = _read_fixmat_file(fixmatfile, var_name,
+                                                       field_name)
+    if where:
+        index = datamat.where_mask(columns, where)
+        num_fix = index.sum()
+        columns = dict((field, value[index]) for (field, value) 
+                       in columns.iteritems())
+    if fields is not None:
+        unknown = set(fields).difference(columns)
+        if unknown:
+            raise ValueError('%s are not fields of the fixmat' % 
+                             sorted(unknown))
+        columns = dict((field, columns[field]) for field in fields)
+    return _fixmat_from_columns(columns, parameters, num_fix, categories)
+
+def _read_fixmat_file(fixmatfile, var_name = 'fixmat', field_name = 'x'):
+    """
+    Parses a matlab fixmat.
+
+    Returns:
+        (fields, parameters, num_fix) : fields maps field names to 1D 
+            arrays, parameters maps names to values
     """
     try:
         data = loadmat(fixmatfile, struct_as_record = False)
@@ -301,21 +711,23 @@ def FixmatFactory(fixmatfile, categories = None, var_name = 'fixmat', field_name
     num_fix = data.__getattribute__(field_name).size
     
     # Get a list with fieldnames and a list with parameters
-    fields = {}
+    columns = {}
     parameters = {}
     for field in data._fieldnames:
         if data.__getattribute__(field).size == num_fix:
-            fields[field] = data.__getattribute__(field)
+            columns[field] = data.__getattribute__(field).reshape(-1,)
         else:            
             parameters[field] = data.__getattribute__(field)[0].tolist()
             if len(parameters[field]) == 1:
                 parameters[field] = parameters[field][0]
-    
-    # Generate FixMat
-    fixmat = FixMat(categories = categories)
-    fixmat._fields = fields.keys()
-    for (field, value) in fields.iteritems():
-        fixmat.__dict__[field] = value.reshape(-1,) 
+    return columns, parameters, num_fix
+
+def _fixmat_from_columns(columns, parameters, num_fix, categories):
+    fixmat = FixMat()
+    fixmat._categories = categories
+    fixmat._fields = columns.keys()
+    for (field, value) in columns.iteritems():
+        fixmat.__dict__[field] = value
 
     fixmat._parameters = parameters
     fixmat._subjects = None
@@ -347,7 +759,8 @@ def TestFixmatFactory(points = None, categories = [1],
 
     """
     default_parameters = {'image_size':[922, 1272], 'pixels_per_degree':36}
-    fixmat = FixMat(categories=categories_obj)
+    fixmat = FixMat()
+    fixmat._categories = categories_obj
     fixmat.x = [] 
     fixmat.y = []
     fixmat.SUBJECTINDEX = []
@@ -381,7 +794,8 @@ def TestFixmatFactory(points = None, categories = [1],
     return fixmat
 
 def VectorFixmatFactory(fields, parameters, categories = None):
-    fm = FixMat(categories = categories)
+    fm = FixMat()
+    fm._categories = categories
     fm._fields = fields.keys()
     for (field, value) in fields.iteritems(): 
         fm.__dict__[field] = value 
@@ -2,8 +2,11 @@
 """This module implements different model evaluation measures."""
 
 import inspect
+import warnings
+from distutils.version import LooseVersion
 
 import numpy as np
+import scipy
 
 from ocupy import fixmat
 from ocupy.fixmat import compute_fdm
@@ -14,12 +17,174 @@ from ocupy.utils import calc_resize_factor
 scores = []
 
 
+# Arguments of measures, see measure_args
+_measure_args = {}
+
+
 def set_scores(score_list):
     """
     Changes list of measures that are used by prediction_scores.
     """
     global scores
     scores = score_list
+    for measure in scores:
+        measure_args(measure)
+
+
+def measure_args(measure):
+    """
+    Returns the names of the arguments of a measure. Signatures are 
+    inspected only once per measure.
+    """
+    try:
+        return _measure_args[measure]
+    except KeyError:
+        (args, _, _, _) = inspect.getargspec(measure)
+        _measure_args[measure] = args
+        return args
+
+
+def _measure_kwargs(measure, kw, context=None, prediction=None):
+    # Filter dictionary, such that only the keys that are
+    # expected by the measure are in it. Intermediates the measure
+    # requires are taken from the context.
+    args = measure_args(measure)
+    mdict = dict((key, value) for (key, value) in kw.iteritems()
+                 if key in args[2:])
+    if context is not None:
+        for name in requirements.get(measure, ()):
+            if name not in mdict:
+                value = context.get(name, prediction)
+                if value is not None:
+                    mdict[name] = value
+    return mdict
+
+
+# Intermediates that measures can declare as requirements and batch
+# implementations of measures, see register_measure
+requirements = {}
+intermediates = {}
+batch_measures = {}
+
+
+def register_measure(measure, requires=(), batch=None):
+    """
+    Declares which intermediate results a measure needs.
+
+    prediction_scores computes every intermediate only once per evaluation
+    and passes it to all measures that require it as keyword argument of
+    the same name, so a measure that requires 'fdm' is called as
+    measure(prediction, fm, fdm=...). Available intermediates are the
+    keys of measures.intermediates:
+
+        fix_idx : (y, x) indices of the fixations in the prediction
+        ctr_idx : (y, x) indices of control locations in the prediction,
+            random or from the ctr_loc and ctr_size arguments
+        fdm : the fdm of the fixations at the size of the prediction
+
+    Intermediates that depend on the size of the prediction are cached
+    per size. Measures have to compute an intermediate themselves if it
+    is not passed, which happens if it can not be computed.
+
+    Parameters:
+        measure : function
+        requires : list of strings
+            Names of the intermediates
+        batch : function, optional
+            Implementation of the measure for batch_prediction_scores,
+            called as batch(predictions, fm, context, **kw) with the 
+            arguments of the evaluation that it takes by name. It should
+            take intermediates from context.get, which also returns
+            intermediates that were passed as arguments.
+    """
+    for name in requires:
+        if name not in intermediates:
+            raise ValueError('Unknown intermediate: %s' % name)
+    requirements[measure] = tuple(requires)
+    if batch is not None:
+        batch_measures[measure] = batch
+    measure_args(measure)
+
+
+def register_intermediate(name, function):
+    """
+    Makes a new intermediate available to measures.
+
+    Parameters:
+        name : string
+        function : function
+            Called as function(context, prediction) to compute the
+            intermediate. context.fm and context.kw hold the fixmat and the
+            keyword arguments of the evaluation. Raising a RuntimeError
+            marks the intermediate as not available.
+    """
+    intermediates[name] = function
+
+
+class EvaluationContext(object):
+    """
+    Memoizes intermediate results during the evaluation of predictions
+    against one fixmat.
+
+    Random control locations are drawn from rng, which defaults to the
+    global numpy random state. Pass a seeded np.random.RandomState to make
+    them reproducible.
+    """
+
+    def __init__(self, fm, rng=None, **kw):
+        self.fm = fm
+        self.rng = np.random if rng is None else rng
+        self.kw = kw
+        self.memory = {}
+
+    def get(self, name, prediction):
+        """
+        Returns the intermediate 'name' for predictions with the shape of
+        prediction, or None if it can not be computed. Intermediates that
+        were passed as keyword arguments are returned as they are.
+        """
+        if name in self.kw:
+            return self.kw[name]
+        key = (name, prediction.shape[-2:])
+        if key not in self.memory:
+            # Intermediates are computed for a single prediction
+            while prediction.ndim > 2:
+                prediction = prediction[0]
+            try:
+                self.memory[key] = intermediates[name](self, prediction)
+            except RuntimeError:
+                self.memory[key] = None
+        return self.memory[key]
+
+
+def _fix_idx(context, prediction):
+    (r_y, r_x) = calc_resize_factor(prediction, context.fm.image_size)
+    return ((r_y * np.array(context.fm.y - 1)).astype(int),
+            (r_x * np.array(context.fm.x - 1)).astype(int))
+
+
+def _ctr_idx(context, prediction):
+    ctr_loc = context.kw.get('ctr_loc')
+    ctr_size = context.kw.get('ctr_size')
+    if not ctr_loc:
+        xc = context.rng.randint(0, prediction.shape[-1], 1000)
+        yc = context.rng.randint(0, prediction.shape[-2], 1000)
+        return (yc.astype(int), xc.astype(int))
+    (r_y, r_x) = calc_resize_factor(prediction, context.fm.image_size)
+    if ctr_size:
+        (r_y, r_x) = calc_resize_factor(prediction, ctr_size)
+    return ((r_y * np.array(ctr_loc[0])).astype(int),
+            (r_x * np.array(ctr_loc[1])).astype(int))
+
+
+def _fdm(context, prediction):
+    (_, r_x) = calc_resize_factor(prediction, context.fm.image_size)
+    return compute_fdm(context.fm, scale_factor=r_x)
+
+
+register_intermediate('fix_idx', _fix_idx)
+register_intermediate('ctr_idx', _ctr_idx)
+register_intermediate('fdm', _fdm)
 
 
 def prediction_scores(prediction, fm, **kw):
@@ -40,33 +205,115 @@ def prediction_scores(prediction, fm, **kw):
     In this case the AUC will be computed with control points (y,x), because
     the measure 'roc_model' has 'ctr_loc' as named argument.
 
+    Intermediate results that several measures need (e.g. the fdm of fm)
+    are computed only once, see register_measure.
+
     Input:
         prediction  :   2D numpy array
             The prediction that should be evaluated
         fm  :   Fixmat
             The eyetracking data to evaluate against
+        context : EvaluationContext, optional
+            Context to take intermediates from. Pass the same context to 
+            share intermediates between evaluations against the same fm.
+        rng : np.random.RandomState, optional
+            Random state for drawing control locations, see 
+            EvaluationContext. Ignored if context is given.
     Output:
         Tuple of prediction scores. The order of the scores is determined
         by order of measures.scores.
     """
-    if prediction == None:
+    if prediction is None:
         return [np.NaN for measure in scores]
+    context = kw.pop('context', None)
+    if context is None:
+        context = EvaluationContext(fm, **kw)
     results = []
     for measure in scores:
-        (args, _, _, _) = inspect.getargspec(measure)
-        if len(args) > 2:
-            # Filter dictionary, such that only the keys that are
-            # expected by the measure are in it
-            mdict = {}
-            [mdict.update({key:value}) for (key, value) in kw.iteritems()
-                if key in args]
-            score = measure(prediction, fm, **mdict)
-        else:
-            score = measure(prediction, fm)
+        score = measure(prediction, fm, 
+                        **_measure_kwargs(measure, kw, context, prediction))
         results.append(score)
     return results
 
 
+def batch_prediction_scores(predictions, fm, **kw):
+    """
+    Evaluates a stack of predictions against the fixations in a fixmat.
+
+    The result is the same as calling prediction_scores for every
+    prediction, except that roc_model draws its random control locations
+    only once for all predictions. Everything that does not depend on the
+    prediction (fixation indices, control locations and the fdm of fm) is
+    computed once, and roc_model, nss_model, kldiv_model and 
+    correlation_model are evaluated for all predictions at once. Other 
+    measures are called for every prediction.
+
+    Input:
+        predictions : 3D numpy array
+            Predictions of shape (N, height, width)
+        fm  :   Fixmat
+            The eyetracking data to evaluate against
+        kw : arguments for the measures, see prediction_scores
+    Output:
+        Array of shape (N, len(measures.scores)), the scores of 
+        predictions[i] are in row i. Measures have to return scalars.
+    """
+    predictions = np.asarray(predictions)
+    if predictions.ndim == 2:
+        predictions = predictions[np.newaxis]
+    context = EvaluationContext(fm, **kw)
+    results = np.empty((len(predictions), len(scores)))
+    for (i, measure) in enumerate(scores):
+        if measure in batch_measures:
+            batch = batch_measures[measure]
+            results[:, i] = batch(predictions, fm, context, 
+                                  **_measure_kwargs(batch, kw))
+        else:
+            results[:, i] = [measure(prediction, fm, **_measure_kwargs(
+                                measure, kw, context, prediction))
+                             for prediction in predictions]
+    return results
+
+
+def _batch_roc_model(predictions, fm, context):
+    (y_index, x_index) = context.get('fix_idx', predictions)
+    (yc, xc) = context.get('ctr_idx', predictions)
+    return rank_roc(predictions[:, y_index, x_index],
+                    predictions[:, yc, xc], curves=False)
+
+
+def _batch_nss_model(predictions, fm, context):
+    (y_index, x_index) = context.get('fix_idx', predictions)
+    flat = predictions.reshape(len(predictions), -1)
+    mean = flat.mean(1)
+    std = flat.std(1)
+    return (predictions[:, y_index, x_index].mean(1) - mean) / std
+
+
+def _batch_kldiv_model(predictions, fm, context):
+    p = context.get('fdm', predictions)
+    if p is None:
+        return np.nan
+    q = np.array(predictions, dtype=float)
+    flat = q.reshape(len(q), -1)
+    flat -= flat.min(1).reshape(-1, 1)
+    flat /= flat.sum(1).reshape(-1, 1)
+    flat += np.finfo(q.dtype).eps
+    p = p.ravel() + np.finfo(p.dtype).eps
+    return np.sum(p * np.log2(p)) - np.dot(np.log2(flat), p)
+
+
+def _batch_correlation_model(predictions, fm, context):
+    fdm = context.get('fdm', predictions)
+    if fdm is None:
+        raise RuntimeError('There are no fixations in the fixmat.')
+    fdm = fdm.ravel() - fdm.mean()
+    flat = predictions.reshape(len(predictions), -1).astype(float)
+    flat = flat - flat.mean(1).reshape(-1, 1)
+    return (np.dot(flat, fdm) / 
+            np.sqrt((flat ** 2).sum(1) * np.dot(fdm, fdm)))
+
+
 def funky_test_measure(prediction, fm, arg1='bar', arg2='foo'):
     """
     Measure that can be used for testing
@@ -83,7 +330,7 @@ def evaluate_predictions(stimuli):
     return results
 
 
-def kldiv_model(prediction, fm):
+def kldiv_model(prediction, fm, fdm=None):
     """
     wraps kldiv functionality for model evaluation
 
@@ -92,11 +339,15 @@ def kldiv_model(prediction, fm):
             the model salience map
         fm : fixmat
             Should be filtered for the image corresponding to the prediction
+        fdm : 2D matrix, optional
+            The fdm of fm at the size of the prediction
     """
     (_, r_x) = calc_resize_factor(prediction, fm.image_size)
     q = np.array(prediction, copy=True)
     q -= np.min(q.flatten())
     q /= np.sum(q.flatten())
+    if fdm is not None:
+        return kldiv(np.array(fdm, copy=True), q)
     return kldiv(None, q, distp=fm, scale_factor=r_x)
 
 
@@ -119,13 +370,13 @@ def kldiv(p, q, distp=None, distq=None, scale_factor=1):
             Determines the size of FDM computed from distq or distp.
 
     """
-    assert q != None or distq != None, "Either q or distq have to be given"
-    assert p != None or distp != None, "Either p or distp have to be given"
+    assert q is not None or distq is not None, "Either q or distq have to be given"
+    assert p is not None or distp is not None, "Either p or distp have to be given"
 
     try:
-        if p == None:
+        if p is None:
             p = compute_fdm(distp, scale_factor=scale_factor)
-        if q == None:
+        if q is None:
             q = compute_fdm(distq, scale_factor=scale_factor)
     except RuntimeError:
         return np.NaN
@@ -155,12 +406,9 @@ def kldiv_cs_model(prediction, fm):
     if len(fm.x) == 0:
         return np.NaN
     (scale_factor, _) = calc_resize_factor(prediction, fm.image_size)
-    # this specifies left edges of the histogram bins, i.e. fixations between
-    # ]0 binedge[0]] are included. --> fixations are ceiled
-    e_y = np.arange(0, np.round(scale_factor * fm.image_size[0] + 1))
-    e_x = np.arange(0, np.round(scale_factor * fm.image_size[1] + 1))
-    samples = np.array(zip((scale_factor * fm.y), (scale_factor * fm.x)))
-    (fdm, _) = np.histogramdd(samples, (e_y, e_x))
+    fdm = fixmat.fixation_histogram(scale_factor * np.asarray(fm.y),
+            scale_factor * np.asarray(fm.x),
+            fixmat.fdm_shape(fm.image_size, scale_factor))
 
     # compute ChaoShen corrected kl-div
     q = np.array(prediction, copy=True)
@@ -189,7 +437,7 @@ def chao_shen(q):
     return (H, pa, la)
 
 
-def correlation_model(prediction, fm):
+def correlation_model(prediction, fm, fdm=None):
     """
     wraps numpy.corrcoef functionality for model evaluation
 
@@ -198,13 +446,16 @@ def correlation_model(prediction, fm):
             the model salience map
         fm: fixmat
             Used to compute a FDM to which the prediction is compared.
+        fdm : 2D matrix, optional
+            The fdm of fm at the size of the prediction
     """
-    (_, r_x) = calc_resize_factor(prediction, fm.image_size)
-    fdm = compute_fdm(fm, scale_factor=r_x)
+    if fdm is None:
+        (_, r_x) = calc_resize_factor(prediction, fm.image_size)
+        fdm = compute_fdm(fm, scale_factor=r_x)
     return np.corrcoef(fdm.flatten(), prediction.flatten())[0, 1]
 
 
-def nss_model(prediction, fm):
+def nss_model(prediction, fm, fix_idx=None):
     """
     wraps nss functionality for model evaluation
 
@@ -213,11 +464,14 @@ def nss_model(prediction, fm):
             the model salience map
         fm : fixmat
             Fixations that define the actuals
+        fix_idx : tuple of (y, x) indices, optional
+            Indices of the fixations in the prediction
     """
-    (r_y, r_x) = calc_resize_factor(prediction, fm.image_size)
-    fix = ((np.array(fm.y - 1) * r_y).astype(int),
-                            (np.array(fm.x - 1) * r_x).astype(int))
-    return nss(prediction, fix)
+    if fix_idx is None:
+        (r_y, r_x) = calc_resize_factor(prediction, fm.image_size)
+        fix_idx = ((np.array(fm.y - 1) * r_y).astype(int),
+                                (np.array(fm.x - 1) * r_x).astype(int))
+    return nss(prediction, fix_idx)
 
 
 def nss(prediction, fix):
@@ -233,7 +487,8 @@ def nss(prediction, fix):
     return np.mean(prediction[fix[0], fix[1]])
 
 
-def roc_model(prediction, fm, ctr_loc=None, ctr_size=None):
+def roc_model(prediction, fm, ctr_loc=None, ctr_size=None, fix_idx=None,
+              ctr_idx=None, rng=None):
     """
     wraps roc functionality for model evaluation
 
@@ -248,6 +503,14 @@ def roc_model(prediction, fm, ctr_loc=None, ctr_size=None):
         ctr_size : two element tuple, optional
             Specifies the assumed image size of the control locations,
             defaults to fm.image_size
+        fix_idx : tuple of (y, x) indices, optional
+            Indices of the fixations in the prediction
+        ctr_idx : tuple of (y, x) indices, optional
+            Indices of the control locations in the prediction. If given,
+            ctr_loc and ctr_size are ignored.
+        rng : np.random.RandomState, optional
+            Random state to draw control locations from if neither
+            ctr_idx nor ctr_loc are given. Defaults to np.random.
      """
 
     # check if prediction is a valid numpy array
@@ -256,12 +519,18 @@ def roc_model(prediction, fm, ctr_loc=None, ctr_size=None):
     (r_y, r_x) = calc_resize_factor(prediction, fm.image_size)
     # read out values in the fdm at actual fixation locations
     # .astype(int) floors numbers in np.array
-    y_index = (r_y * np.array(fm.y - 1)).astype(int)
-    x_index = (r_x * np.array(fm.x - 1)).astype(int)
-    actuals = prediction[y_index, x_index]
+    if fix_idx is None:
+        fix_idx = ((r_y * np.array(fm.y - 1)).astype(int),
+                   (r_x * np.array(fm.x - 1)).astype(int))
+    actuals = prediction[fix_idx[0], fix_idx[1]]
+    if ctr_idx is not None:
+        return rank_roc(actuals, prediction[ctr_idx[0], ctr_idx[1]],
+                        curves=False)
     if not ctr_loc:
-        xc = np.random.randint(0, prediction.shape[1], 1000)
-        yc = np.random.randint(0, prediction.shape[0], 1000)
+        if rng is None:
+            rng = np.random
+        xc = rng.randint(0, prediction.shape[1], 1000)
+        yc = rng.randint(0, prediction.shape[0], 1000)
         ctr_loc = (yc.astype(int), xc.astype(int))
     else:
         if not ctr_size:
@@ -271,7 +540,7 @@ def roc_model(prediction, fm, ctr_loc=None, ctr_size=None):
         ctr_loc = ((r_y * np.array(ctr_loc[0])).astype(int),
                    (r_x * np.array(ctr_loc[1])).astype(int))
     controls = prediction[ctr_loc[0], ctr_loc[1]]
-    return faster_roc(actuals, controls)[0]
+    return rank_roc(actuals, controls, curves=False)
     
 def fast_roc(actuals, controls):
     """
@@ -297,14 +566,8 @@ def fast_roc(actuals, controls):
         raise RuntimeError('NaN found in controls')
 
     thresholds = np.hstack([-np.inf, np.unique(actuals), np.inf])[::-1]
-    true_pos_rate = np.empty(thresholds.size)
-    false_pos_rate = np.empty(thresholds.size)
-    num_act = float(len(actuals))
-    num_ctr = float(len(controls))
-
-    for i, value in enumerate(thresholds):
-        true_pos_rate[i] = (actuals >= value).sum() / num_act
-        false_pos_rate[i] = (controls >= value).sum() / num_ctr
+    true_pos_rate = _rate_above(actuals, thresholds)
+    false_pos_rate = _rate_above(controls, thresholds)
     auc = np.dot(np.diff(false_pos_rate), true_pos_rate[0:-1])
     # treat cases where TPR of one is not reached before FPR of one
     # by using trapezoidal integration for the last segment
@@ -315,47 +578,18 @@ def fast_roc(actuals, controls):
 
 def faster_roc(actuals, controls):
     """
-    Histogram based implementation of AUC unde ROC curve.  
+    Computes the area under the roc curve for sets of actuals and controls.
+
+    This used to be a histogram based approximation, it now computes the
+    exact AUC with rank_roc, which is fast for any number of actuals.
+
     Parameters:
         actuals : list
             A list of numeric values for positive observations.
         controls : list
             A list of numeric values for negative observations.
     """
-    assert(type(actuals) is np.ndarray)
-    assert(type(controls) is np.ndarray)
-    
-    if len(actuals)<500:
-        raise RuntimeError('This method might be incorrect when '+
-                'not enough actuals are present. Needs to be checked before '+
-                'proceeding. Stopping here for you to do so.')
-
-    actuals = np.ravel(actuals)
-    controls = np.ravel(controls)
-    if np.isnan(actuals).any():
-        raise RuntimeError('NaN found in actuals')
-    if np.isnan(controls).any():
-        raise RuntimeError('NaN found in controls')
-
-    thresholds = np.hstack([-np.inf, np.unique(actuals), np.inf])+np.finfo(float).eps
-    true_pos_rate = np.nan*np.empty(thresholds.size-1)
-    false_pos_rate = np.nan*np.empty(thresholds.size-1)
-    num_act = float(len(actuals))
-    num_ctr = float(len(controls))
-
-    actuals = 1-(np.cumsum(np.histogram(actuals, thresholds)[0])/num_act)
-    controls = 1-(np.cumsum(np.histogram(controls, thresholds)[0])/num_ctr)
-    true_pos_rate = actuals
-    false_pos_rate = controls
-    #true_pos_rate = np.concatenate(([0], true_pos_rate, [1]))
-    false_pos_rate = false_pos_rate
-    auc = -1*np.dot(np.diff(false_pos_rate), true_pos_rate[0:-1])
-    # treat cases where TPR of one is not reached before FPR of one
-    # by using trapezoidal integration for the last segment
-    # (add the missing triangle)
-    if false_pos_rate[-2] == 1:
-        auc += ((1-true_pos_rate[-3])*.5*(1-false_pos_rate[-3]))
-    return (auc, true_pos_rate, false_pos_rate)
+    return rank_roc(actuals, controls)
 
 def exact_roc(actuals, controls):
     """
@@ -363,72 +597,288 @@ def exact_roc(actuals, controls):
     possibl thresholds and trapezoidal interpolation. Also returns arrays of
     the true positive rate and the false positive rate.
     """
+    return rank_roc(actuals, controls)
 
-    actuals = np.ravel(actuals)
-    controls = np.ravel(controls)
+def rank_roc(actuals, controls, curves=True):
+    """
+    Computes the exact area under the roc curve via the Mann-Whitney U
+    statistic, i.e. from the ranks of the actuals among all values. Ties
+    get the average of their ranks, which is equivalent to trapezoidal 
+    interpolation of the roc curve over all possible thresholds. The 
+    computation takes O(n log n) time.
+
+    Several roc analyses can be carried out at once by passing 2D arrays,
+    for example the values of a stack of prediction maps at the fixated
+    and at the control locations.
+
+    Parameters:
+        actuals : array
+            Values for positive observations. If 2D, every row is one
+            set of actuals.
+        controls : array
+            Values for negative observations. If actuals is 2D, controls 
+            must either have the same number of rows or be 1D, in which 
+            case the controls are used for all rows of actuals.
+        curves : bool, optional
+            If False, only the auc is computed and returned. This avoids
+            building the roc curves, which takes a loop over all rows for
+            2D input. Default is True.
+    Returns:
+        (auc, true_pos_rate, false_pos_rate) : for 1D input, the rates are 
+            arrays over all thresholds in descending order, as in the 
+            earlier exact_roc. For 2D input, auc is an array with one 
+            value per row and the rates are lists of arrays.
+        auc : if curves is False
+    """
+    actuals = np.asarray(actuals, dtype=float)
+    controls = np.asarray(controls, dtype=float)
     if np.isnan(actuals).any():
         raise RuntimeError('NaN found in actuals')
     if np.isnan(controls).any():
         raise RuntimeError('NaN found in controls')
-
+    if actuals.ndim <= 1:
+        actuals = np.ravel(actuals)
+        controls = np.ravel(controls)
+        auc = _rank_auc(actuals.reshape(1, -1), controls.reshape(1, -1))[0]
+        if not curves:
+            return auc
+        (true_pos_rate, false_pos_rate) = _roc_curve(actuals, controls)
+        return (auc, true_pos_rate, false_pos_rate)
+    if controls.ndim == 1:
+        controls = np.tile(controls, (len(actuals), 1))
+    if len(controls) != len(actuals):
+        raise ValueError('actuals and controls must have the same number ' +
+                         'of rows')
+    auc = _rank_auc(actuals, controls)
+    if not curves:
+        return auc
+    rates = [_roc_curve(act, ctr) for (act, ctr) in zip(actuals, controls)]
+    return (auc, [r[0] for r in rates], [r[1] for r in rates])
+
+def _rank_auc(actuals, controls):
+    # Mann-Whitney U for every row of actuals and controls
+    (num_act, num_ctr) = (actuals.shape[1], controls.shape[1])
+    if num_act == 0 or num_ctr == 0:
+        return np.nan * np.ones(len(actuals))
+    ranks = average_ranks(np.hstack((actuals, controls)))
+    u_stat = ranks[:, :num_act].sum(1) - num_act * (num_act + 1) / 2.0
+    return u_stat / (float(num_act) * num_ctr)
+
+def average_ranks(values):
+    """
+    Ranks the values in every row of a 2D array, starting at 1. Tied
+    values get the average of the ranks they span.
+    """
+    values = np.asarray(values)
+    (rows, length) = values.shape
+    order = np.argsort(values, axis=1, kind='mergesort')
+    row_index = np.arange(rows).reshape(-1, 1)
+    sorted_values = values[row_index, order]
+    # Runs of equal values, a run never spans two rows
+    new_run = np.ones((rows, length), dtype=bool)
+    new_run[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    new_run = new_run.ravel()
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], rows * length)
+    mean_rank = (starts + ends + 1) / 2.0 - (starts // length) * length
+    ranks = np.empty((rows, length))
+    ranks[row_index, order] = mean_rank[np.cumsum(new_run) - 1].reshape(
+                                                            rows, length)
+    return ranks
+
+def _roc_curve(actuals, controls):
+    # Rates over all thresholds that occur in actuals and controls
     thresholds = np.hstack([-np.inf,
         np.unique(np.concatenate((actuals, controls))), np.inf])[::-1]
-    true_pos_rate = np.empty(thresholds.size)
-    false_pos_rate = np.empty(thresholds.size)
-    num_act = float(len(actuals))
-    num_ctr = float(len(controls))
-
-    for i, value in enumerate(thresholds):
-        true_pos_rate[i] = (actuals >= value).sum() / num_act
-        false_pos_rate[i] = (controls >= value).sum() / num_ctr
-    auc = np.dot(np.diff(false_pos_rate),
-            (true_pos_rate[0:-1] + true_pos_rate[1:]) / 2)
-    return(auc, true_pos_rate, false_pos_rate)
+    return _rate_above(actuals, thresholds), _rate_above(controls, thresholds)
 
+def _rate_above(values, thresholds):
+    # Fraction of values that are >= every threshold
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((len(values) - np.searchsorted(np.sort(values), thresholds))
+                / float(len(values)))
 
-def emd_model(prediction, fm):
+def emd_model(prediction, fm, fdm=None, signature_size=16, emd_mode='exact'):
     """
     wraps emd functionality for model evaluation
 
-    requires:
-        OpenCV python bindings
+    The prediction is normalized to sum to one like the fdm.
 
     input:
         prediction: the model salience map
         fm : fixmat filtered for the image corresponding to the prediction
+        fdm : the fdm of fm at the size of the prediction, optional
+        signature_size, emd_mode : see emd
     """
-    (_, r_x) = calc_resize_factor(prediction, fm.image_size)
-    gt = fixmat.compute_fdm(fm, scale_factor=r_x)
-    return emd(prediction, gt)
+    if fdm is None:
+        (_, r_x) = calc_resize_factor(prediction, fm.image_size)
+        fdm = fixmat.compute_fdm(fm, scale_factor=r_x)
+    prediction = np.asarray(prediction, dtype=float)
+    return emd(prediction / prediction.sum(), fdm, 
+               signature_size=signature_size, mode=emd_mode)
 
 
-def emd(prediction, ground_truth):
+def emd(prediction, ground_truth, signature_size=16, mode='exact', 
+        reg=0.005, max_iter=100000):
     """
     Compute the Earth Mover's Distance between prediction and model.
 
-    This implementation uses opencv for doing the actual work.
-    Unfortunately, at the time of implementation only the SWIG
-    bindings were available and the numpy arrays have to be
-    converted by hand. This changes with opencv 2.1.
-    """
-    import opencv
+    Both maps are summarized by signatures: they are divided into at most
+    signature_size x signature_size blocks, and every block is represented
+    by its total weight at its center. The distance between blocks is the 
+    euclidean distance of their centers in pixels. Larger signatures are 
+    more accurate, but the cost grows with the 4th power of 
+    signature_size.
+
+    If the total weights of the maps differ, only the smaller weight is
+    moved (as in OpenCV's EMD) and the cost is divided by the moved weight.
 
+    Parameters:
+        prediction, ground_truth : 2D arrays of the same shape
+        signature_size : int
+            Maximum number of blocks along each dimension. 
+        mode : 'exact' or 'sinkhorn'
+            'exact' solves the transportation problem as a linear program.
+            With scipy < 1.6, which has no HiGHS solver, an interior point
+            method is used instead, which takes about 10 s for a 
+            signature_size of 16.
+            'sinkhorn' approximates it with entropic regularization, which 
+            is much faster for large signatures. The result is the cost of
+            a transport plan that is close to optimal, i.e. it is slightly
+            larger than the exact EMD (by a few percent with the default
+            reg). This mode normalizes both maps to the same total weight.
+        reg : float
+            Regularization of the sinkhorn mode, relative to the largest
+            distance between blocks. Smaller values are more accurate but
+            converge more slowly.
+        max_iter : int
+            Maximum number of sinkhorn iterations. A RuntimeWarning is
+            issued if the transport plan has not converged by then.
+    """
     if not (prediction.shape == ground_truth.shape):
         raise RuntimeError('Shapes of prediction and ground truth have' +
                            ' to be equal. They are: %s, %s'
                             % (str(prediction.shape), str(ground_truth.shape)))
-    (x, y) = np.meshgrid(range(0, prediction.shape[1]),
-                        range(0, prediction.shape[0]))
-    s1 = np.array([x.flatten(), y.flatten(), prediction.flatten()]).T
-    s2 = np.array([x.flatten(), y.flatten(), ground_truth.flatten()]).T
-    s1m = opencv.cvCreateMat(s1.shape[0], s2.shape[1], opencv.CV_32FC1)
-    s2m = opencv.cvCreateMat(s1.shape[0], s2.shape[1], opencv.CV_32FC1)
-    for r in range(0, s1.shape[0]):
-        for c in range(0, s1.shape[1]):
-            s1m[r, c] = float(s1[r, c])
-            s2m[r, c] = float(s2[r, c])
-    d = opencv.cvCalcEMD2(s1m, s2m, opencv.CV_DIST_L2)
-    return d
-
-# Default list of measures
-scores = [roc_model, nss_model, kldiv_model, correlation_model]
+    (pos1, weights1) = emd_signature(prediction, signature_size)
+    (pos2, weights2) = emd_signature(ground_truth, signature_size)
+    if (weights1 < 0).any() or (weights2 < 0).any():
+        raise ValueError('EMD is not defined for negative weights')
+    if len(weights1) == 0 or len(weights2) == 0:
+        return np.nan
+    cost = np.sqrt(((pos1[:, np.newaxis, :] - 
+                     pos2[np.newaxis, :, :]) ** 2).sum(2))
+    if mode == 'exact':
+        return _exact_emd(weights1, weights2, cost)
+    elif mode == 'sinkhorn':
+        return _sinkhorn_emd(weights1 / weights1.sum(), 
+                             weights2 / weights2.sum(), cost, reg, max_iter)
+    raise ValueError('Unknown EMD mode: %s' % mode)
+
+
+def emd_signature(image, signature_size):
+    """
+    Divides an image into at most signature_size x signature_size blocks.
+
+    Returns:
+        (positions, weights) : centers (y, x) in pixels and total weights
+            of all blocks with non-zero weight.
+    """
+    image = np.asarray(image, dtype=float)
+    positions = []
+    sums = image
+    for axis in range(2):
+        length = image.shape[axis]
+        num_blocks = min(length, signature_size)
+        starts = (np.arange(num_blocks) * length) // num_blocks
+        ends = np.append(starts[1:], length)
+        sums = np.add.reduceat(sums, starts, axis=axis)
+        positions.append((starts + ends - 1) / 2.0)
+    (y, x) = np.meshgrid(positions[0], positions[1], indexing='ij')
+    nonzero = (sums != 0).ravel()
+    return (np.column_stack((y.ravel(), x.ravel()))[nonzero],
+            sums.ravel()[nonzero])
+
+
+def _exact_emd(weights1, weights2, cost):
+    from scipy.optimize import linprog
+    from scipy.sparse import kron, identity, vstack
+    (num1, num2) = cost.shape
+    flow = min(weights1.sum(), weights2.sum())
+    # Scale weights to a total flow of one for numerical stability
+    (weights1, weights2) = (weights1 / flow, weights2 / flow)
+    # The flow from block i to block j is variable i * num2 + j
+    rows = kron(identity(num1), np.ones((1, num2)))
+    cols = kron(np.ones((1, num1)), identity(num2))
+    if abs(weights1.sum() - weights2.sum()) < 1e-12:
+        a_ub, b_ub = None, None
+        # One of the constraints is implied by the others
+        a_eq = vstack((rows, cols)).tocsr()[:-1]
+        b_eq = np.concatenate((weights1, weights2))[:-1]
+    else:
+        a_ub = vstack((rows, cols)).tocsr()
+        b_ub = np.concatenate((weights1, weights2))
+        a_eq = np.ones((1, num1 * num2))
+        b_eq = [1]
+    if LooseVersion(scipy.__version__) >= LooseVersion('1.6'):
+        result = linprog(cost.ravel(), A_ub=a_ub, b_ub=b_ub, A_eq=a_eq, 
+                         b_eq=b_eq, method='highs')
+    else:
+        result = linprog(cost.ravel(), A_ub=a_ub, b_ub=b_ub, A_eq=a_eq,
+                         b_eq=b_eq, method='interior-point',
+                         options={'sparse':True, 'tol':1e-10})
+    if not result.success:
+        raise RuntimeError('EMD computation failed: %s' % result.message)
+    return result.fun
+
+
+def _sinkhorn_emd(weights1, weights2, cost, reg, max_iter, tol=1e-5):
+    # Entropically regularized transport, see Cuturi (2013). The scaling
+    # vectors are absorbed into log domain potentials before they
+    # overflow, and the regularization is decreased in steps to speed up
+    # convergence, see Schmitzer (2019).
+    scale = cost.max() if cost.max() > 0 else 1.
+    (f, g) = (np.zeros(len(weights1)), np.zeros(len(weights2)))
+    (eps, final) = (scale, False)
+    while not final:
+        eps = max(eps / 2., reg * scale)
+        final = eps == reg * scale
+        kernel = np.exp((f[:, np.newaxis] + g[np.newaxis, :] - cost) / eps)
+        (u, v) = (np.ones(len(f)), np.ones(len(g)))
+        for i in xrange(max_iter):
+            row_sums = np.dot(kernel, v)
+            if i % 10 == 0:
+                # Columns sum to weights2 after every iteration
+                error = np.abs(u * row_sums - weights1).sum()
+                if error < (tol if final else 1e-3):
+                    break
+            u = weights1 / row_sums
+            v = weights2 / np.dot(kernel.T, u)
+            if max(np.abs(np.log(u)).max(), np.abs(np.log(v)).max()) > 50:
+                f += eps * np.log(u)
+                g += eps * np.log(v)
+                kernel = np.exp((f[:, np.newaxis] + g[np.newaxis, :] - 
+                                 cost) / eps)
+                (u, v) = (np.ones(len(f)), np.ones(len(g)))
+        f += eps * np.log(u)
+        g += eps * np.log(v)
+    if error >= tol:
+        warnings.warn('Sinkhorn EMD did not converge, the marginals are off '
+                      'by %g. Increase max_iter or reg.' % error, 
+                      RuntimeWarning)
+    # Round the plan to one with the exact marginals, see Altschuler et 
+    # al. (2017), such that the result is the cost of a feasible transport
+    plan = np.exp((f[:, np.newaxis] + g[np.newaxis, :] - cost) / eps)
+    plan *= np.minimum(weights1 / plan.sum(1), 1)[:, np.newaxis]
+    plan *= np.minimum(weights2 / plan.sum(0), 1)[np.newaxis, :]
+    (missing1, missing2) = (weights1 - plan.sum(1), weights2 - plan.sum(0))
+    if missing1.sum() > 0:
+        plan += np.outer(missing1, missing2) / missing1.sum()
+    return (plan * cost).sum()
+
+
+register_measure(roc_model, ['fix_idx', 'ctr_idx'], batch=_batch_roc_model)
+register_measure(nss_model, ['fix_idx'], batch=_batch_nss_model)
+register_measure(kldiv_model, ['fdm'], batch=_batch_kldiv_model)
+register_measure(correlation_model, ['fdm'], 
+                 batch=_batch_correlation_model)
+register_measure(emd_model, ['fdm'])
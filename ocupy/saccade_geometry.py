@@ -129,8 +129,7 @@ def subject_predictions(fm, field = 'SUBJECTINDEX',
     sub_effects = []
     sub_predictions = []
     parameters = []
-    for i,fmsub in enumerate(np.unique(fma.field(field))):
-        id = fma.field(field) == fmsub
+    for i, (fmsub, id) in enumerate(fma.grouping(field)):
         #_, dur, fa, ads, lds = prepare_data(fmsub, dur_cap = 700, max_back=5)
         dur, fa, ads, lds = dura[id], faa[id], adsa[id], ldsa[id]
         params = {}
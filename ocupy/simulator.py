@@ -2,46 +2,14 @@
 """This module implements a generator of data 
 with given second-order dependencies"""
 
-from math import radians, ceil, floor, cos, sin 
-import random
+from math import ceil, sin 
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
 import ocupy
-from ocupy import fixmat
+from ocupy import datamat, fixmat
 import spline_base
 import numpy as np
-import functools  
-import simulator
-
-class memoize(object):
-    '''Decorator. Caches a function's return value each time it is called.
-    If called later with the same arguments, the cached value is returned 
-    (not reevaluated).
-    '''
-      
-    def __init__(self, func):
-        self.func = func
-        self.cache = {}
-        
-    def __call__(self,x, cumsum, r):
-        try:
-            return self.cache[cumsum][r]
-        except KeyError:
-            value = self.func(x,cumsum, r)
-            try:
-                self.cache[cumsum][r] = value
-            except KeyError:
-                self.cache[cumsum] = {r:value}
-            return value
-        except TypeError:
-            # uncachable -- for instance, passing a list as an argument.
-            # Better to not cache than to blow up entirely.
-            return self.func(cumsum,r)
-    def __repr__(self):
-        '''Return the function's docstring.'''
-        return self.func.__doc__
-    def __get__(self, obj, objtype):        
-        '''Support instance methods.'''
-        return functools.partial(self.__call__, obj)
-        
+
 class AbstractSim(object):
     """
     Abstract Object for Simulator creation
@@ -72,13 +40,16 @@ class FixGen(AbstractSim):
     parallelization.
     Data is generated upon calling the method sample_many(num_samples = X).  
     """
-    def __init__(self, fm):
+    def __init__(self, fm, seed = None):
         """
         Creates a new FixGen object upon a certain fixmat
         
         Parameters: 
             fm: ocupy.fixmat
                 The fixation data to replicate in fixmat format.
+            seed: int, optional
+                Seed for the random number generator that is used for 
+                sampling.
         """
         if type(fm)==ocupy.fixmat.FixMat or type(fm)==ocupy.datamat.Datamat:
             self.fm = fm
@@ -86,6 +57,7 @@ class FixGen(AbstractSim):
             raise TypeError("Not a valid argument, insert fixmat")
 
         self.nosamples = []
+        self.rng = random_state(seed)
         
     def initializeData(self, fit = None, full_H1=None, max_length = 40,
             in_deg = True):
@@ -142,188 +114,455 @@ class FixGen(AbstractSim):
                 self.probability_cumsum.append(np.cumsum(self.full_H1[i].flat))
                
         self.trajLen_cumsum, self.trajLen_borders = trajLenDist(self.fm)
-        
-        min_distance = 1/np.array([min((np.unique(self.probability_cumsum[i]) \
-                        -np.roll(np.unique(self.probability_cumsum[i]),1))[1:]) \
-                        for i in range(len(self.probability_cumsum))])
-        # Set a minimal resolution
-        min_distance[min_distance<10] = 10
-
-        self.linind = {}
-        for i in range(len(self.probability_cumsum)):
-            self.linind['self.probability_cumsum '+repr(i)] = np.linspace(0,1,min_distance[i])[0:-1]
-        
-        for elem in [self.firstLenAng_cumsum, self.trajLen_cumsum]:
-            self.linind[elem] = np.linspace(0, 1, 1/min((np.unique((elem))-np.roll(np.unique((elem)),1))[1:]))[0:-1]
-        
-    def _calc_xy(self, (x, y), angle, length):
+        self.pixels_per_degree = self.fm.pixels_per_degree
+        self._prepare_sampling()
+
+    def _prepare_sampling(self):
         """
-        Calculates the coordinates after a specific saccade was made.
-        
-        Parameters:
-            (x,y) : tuple of floats or ints
-                The coordinates before the saccade was made
-            angle : float or int
-                The angle that the next saccade encloses with the 
-                horizontal display border
-            length: float or int
-                The length of the next saccade
+        Compiles the empirical distributions into alias tables that are 
+        used to draw saccades for many trajectories at once.
         """
-        return (x+(cos(radians(angle))*length),
-                y+(sin(radians(angle))*length))
-                
-    def _draw(self, prev_angle = None, prev_length = None):
+        nr_dists = len(self.probability_cumsum)
+        non_empty = [len(c) > 0 and c.any() for c in self.probability_cumsum]
+        if not any(non_empty):
+            raise RuntimeError('No saccade length has a distribution of '+
+                               'length and angle differences')
+        # Saccades with lengths that have no distribution are continued 
+        # with the next shorter length that has one.
+        self._dist_index = np.zeros(nr_dists, dtype=int)
+        for i in range(nr_dists):
+            ind = i
+            while not non_empty[ind % nr_dists]:
+                ind -= 1
+            self._dist_index[i] = ind % nr_dists
+        self._dist_columns = np.array([self.full_H1[i].shape[1] 
+                                       if non_empty[i] else 1
+                                       for i in range(nr_dists)])
+        self._dist_table = AliasTable([cumsum_weights(c) if non_empty[i]
+                                       else [] for (i, c) in 
+                                       enumerate(self.probability_cumsum)])
+        self._first_table = AliasTable([cumsum_weights(
+                                            self.firstLenAng_cumsum)])
+        self._traj_table = AliasTable([cumsum_weights(self.trajLen_cumsum)])
+    
+    def parameters(self):
+        return {'fixmat':self.fm, 'sampling_dist':self.full_H1}
+
+    def save(self, path):
         """
-        Draws a new length- and angle-difference pair and calculates
-        length and angle absolutes matching the last saccade drawn.
+        Saves the distributions and sampling tables of an initialized 
+        FixGen to path (HDF5). Use load to create a FixGen from the file 
+        without calling initializeData again.
 
         Parameters:
-            prev_angle : float, optional
-                The last angle that was drawn in the current trajectory
-            prev_length : float, optional
-                The last length that was drawn in the current trajectory
-            
-            Note: Either both prev_angle and prev_length have to be given 
-            or none; if only one parameter is given, it will be neglected.
+            path : string
+                Absolute path of the file to save to.
         """
-        
-        if (prev_angle is None) or (prev_length is None):
-            (length, angle)= np.unravel_index(self.drawFrom('self.firstLenAng_cumsum', self.getrand('self.firstLenAng_cumsum')),
-                                                self.firstLenAng_shape)
-            angle = angle-((self.firstLenAng_shape[1]-1)/2) 
-            angle += 0.5
-            length += 0.5
-            length *= self.fm.pixels_per_degree
-        else:
-            ind = int(floor(prev_length/self.fm.pixels_per_degree))
-            while ind >= len(self.probability_cumsum):
-                ind -= 1
+        import h5py
+        f = h5py.File(path, 'w')
+        try:
+            group = f.create_group('FixGen')
+            group.attrs['version'] = MODEL_VERSION
+            group.attrs['pixels_per_degree'] = self.pixels_per_degree
+            group.attrs['firstLenAng_shape'] = self.firstLenAng_shape
+            group.attrs['nosamples'] = self.nosamples
+            for name in ['firstLenAng_cumsum', 'trajLen_cumsum', 
+                         'trajLen_borders', '_dist_index', '_dist_columns']:
+                group.create_dataset(name, data = getattr(self, name))
+            for name in ['full_H1', 'probability_cumsum']:
+                dists = group.create_group(name)
+                for (i, dist) in enumerate(getattr(self, name)):
+                    dists.create_dataset(str(i), data = np.asarray(dist))
+            for name in ['_dist_table', '_first_table', '_traj_table']:
+                table = group.create_group(name)
+                for field in ['prob', 'alias', 'sizes', 'offsets']:
+                    table.create_dataset(field, 
+                                         data = getattr(getattr(self, name), 
+                                                        field))
+        finally:
+            f.close()
 
-            while not(self.probability_cumsum[ind]).any():
-                ind -= 1
-                
-            J, I = np.unravel_index(self.drawFrom('self.probability_cumsum '+repr(ind),self.getrand('self.probability_cumsum '+repr(ind))), 
-                                    self.full_H1[ind].shape)
-            angle = reshift((I-self.full_H1[ind].shape[1]/2) + prev_angle)
-            angle += 0.5
-            length = J+0.5
-            length *= self.fm.pixels_per_degree
-        return angle, length
-    
-    def parameters(self):
-        return {'fixmat':self.fm, 'sampling_dist':self.full_H1}
+    def generate(self, num_samples = 10000, multiproc = False, n_jobs = None):
+        """
+        Generates a given number of trajectories, optionally in parallel. 
+        Returns a fixmat with the generated data.
 
-    def generate(self, num_samples = 10000, multiproc = False):
-        if multiproc:
-            from multiprocessing import Pool, cpu_count
-            try:
-                cores = cpu_count()
-            except NotImplementedError:
-                cores = 4
-                
-            arguments = []
-            for i in range(cores):
-                arguments.append((simulator.FixGen(self.fm),num_samples/cores))
-                
-            pool = Pool(processes = cores)
-            fms = pool.map(multiprocess, arguments)
-            out = fms[0]
-            out.SUBJECTINDEX = [0]*len(out.x) # Delete SUBJECTINDEX-stuff after update of ocupy.
-            for i in range(1,len(fms)):
-                fms[i].SUBJECTINDEX = [i]*len(fms[i].x)
-                out.join(fms[i])
-            return out
-            
-        else: 
+        In parallel mode the sampling tables are computed once (if 
+        initializeData was not called yet) and shared with forked worker
+        processes. Every worker draws from its own random stream, seeded 
+        from this generator, and writes its trajectories into shared 
+        output arrays. The field SUBJECTINDEX holds the worker that 
+        generated a trajectory, the field sample the number of the 
+        trajectory.
+
+        Parameters:
+            num_samples : int, optional
+                The number of trajectories that shall be generated.
+            multiproc : boolean, optional
+                If True, trajectories are generated by n_jobs processes.
+            n_jobs : int, optional
+                Number of processes, None uses all cores.
+        """
+        if not multiproc: 
             return self.sample_many(num_samples = num_samples)
+        if not hasattr(self, '_dist_table'):
+            self.initializeData()
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = cpu_count()
+        n_jobs = max(min(n_jobs, num_samples), 1)
+        sizes = self._draw_sizes(num_samples, self.rng)
+        ends = np.cumsum(sizes)
+        total = ends[-1] if num_samples > 0 else 0
+        # Trajectories first:last are generated by worker i
+        bounds = np.linspace(0, num_samples, n_jobs + 1).astype(int)
+        base_seed = random_seed(self.rng)
+        tasks = [(first, last, [base_seed, worker]) for (worker, (first, last)) 
+                 in enumerate(zip(bounds[:-1], bounds[1:]))]
+        global _shared_generation
+        _shared_generation = (self, sizes, ends - sizes,
+                              RawArray('d', max(total, 1)), 
+                              RawArray('d', max(total, 1)))
+        try:
+            if n_jobs == 1:
+                map(_generate_task, tasks)
+            else:
+                pool = Pool(processes = n_jobs)
+                try:
+                    pool.map(_generate_task, tasks, chunksize = 1)
+                finally:
+                    pool.terminate()
+            x = np.frombuffer(_shared_generation[3])[:total]
+            y = np.frombuffer(_shared_generation[4])[:total]
+        finally:
+            _shared_generation = None
+        (fix, sample) = trajectory_index(sizes)
+        worker = np.repeat(np.arange(n_jobs), np.diff(bounds))
+        fields = {'fix':fix, 'y':y, 'x':x, 'sample':sample, 
+                  'SUBJECTINDEX':worker[sample]}
+        param = {'pixels_per_degree':self.pixels_per_degree}
+        return fixmat.VectorFixmatFactory(fields, param)
             
     def sample_many(self, num_samples = 2000):
         """
-        Generates a given number of trajectories, using the method sample(). 
+        Generates a given number of trajectories. 
         Returns a fixmat with the generated data.
         
         Parameters:
             num_samples : int, optional
                 The number of trajectories that shall be generated.
         """     
-        x = []
-        y = []
-        fix = []
-        sample = []
-        
-        # XXX: Delete ProgressBar
-        pbar = ProgressBar(widgets=[Percentage(),Bar()], maxval=num_samples).start()
-        
-        for s in xrange(0, num_samples):
-            for i, (xs, ys) in enumerate(self.sample()):
-                x.append(xs)
-                y.append(ys)
-                fix.append(i+1)
-                sample.append(s)
-            pbar.update(s+1)
-            
-        fields = {'fix':np.array(fix), 'y':np.array(y), 'x':np.array(x)}
-        param = {'pixels_per_degree':self.fm.pixels_per_degree}
+        x, y, fix, sample = self.sample_trajectories(num_samples)
+        fields = {'fix':fix, 'y':y, 'x':x, 'sample':sample}
+        param = {'pixels_per_degree':self.pixels_per_degree}
         out =  fixmat.VectorFixmatFactory(fields, param)
         return out
     
+    def sample_chunks(self, num_samples, chunk_size = 100000):
+        """
+        Generates num_samples trajectories in chunks of chunk_size 
+        trajectories. Yields one fixmat per chunk, so that memory use does 
+        not depend on num_samples. The field sample numbers trajectories
+        across all chunks.
+
+        Parameters:
+            num_samples : int
+                The number of trajectories that shall be generated.
+            chunk_size : int, optional
+                The number of trajectories per chunk.
+        """
+        param = {'pixels_per_degree':self.pixels_per_degree}
+        for first in xrange(0, num_samples, chunk_size):
+            x, y, fix, sample = self.sample_trajectories(
+                                    min(chunk_size, num_samples - first))
+            fields = {'fix':fix, 'y':y, 'x':x, 'sample':sample + first}
+            yield fixmat.VectorFixmatFactory(fields, param)
+
+    def save_samples(self, path, num_samples, chunk_size = 100000, 
+                     compression = None):
+        """
+        Generates num_samples trajectories and streams them to an HDF5 
+        file at path, chunk by chunk. The file can be read with 
+        fixmat.load and extended with datamat.append.
+
+        Parameters:
+            path : string
+                Absolute path of the file to save to.
+            num_samples : int
+                The number of trajectories that shall be generated.
+            chunk_size : int, optional
+                The number of trajectories that are held in memory at 
+                once.
+            compression : string, optional
+                HDF5 compression filter, see Datamat.save.
+        Returns:
+            The number of fixations that were written.
+        """
+        num_fix = 0
+        for chunk in self.sample_chunks(num_samples, chunk_size):
+            if num_fix == 0:
+                chunk.save(path, compression = compression)
+            else:
+                datamat.append(path, chunk)
+            num_fix += len(chunk)
+        return num_fix
+
     def sample(self):
         """
         Draws a trajectory length, first coordinates, lengths, angles and 
         length-angle-difference pairs according to the empirical distribution. 
         Each call creates one complete trajectory.
         """
-        lenghts = []
-        angles = []
-        coordinates = []
-        fix = []
-        sample_size = int(round(self.trajLen_borders[self.drawFrom('self.trajLen_cumsum', self.getrand('self.trajLen_cumsum'))]))
-
-        coordinates.append([0, 0])
-        fix.append(1)
-        
-        while len(coordinates) < sample_size:
-            if len(lenghts) == 0 and len(angles) == 0:          
-                angle, length = self._draw(self)
-            else:
-                angle, length = self._draw(prev_angle = angles[-1], 
-                                            prev_length = lenghts[-1])  
-                        
-            x, y = self._calc_xy(coordinates[-1], angle, length) 
-            
-            coordinates.append([x, y])
-            lenghts.append(length) 
-            angles.append(angle)
-            fix.append(fix[-1]+1)
-        return coordinates
-
-    def getrand(self, name):
-        return random.choice(self.linind[name])
- 
-    @memoize    
-    def drawFrom(self, cumsum, r):
+        x, y, _, _ = self.sample_trajectories(1)
+        return [[xs, ys] for (xs, ys) in zip(x, y)]
+
+    def sample_trajectories(self, num_samples):
         """
-        Draws a value from a cumulative sum.
+        Generates num_samples trajectories at once. 
         
-        Parameters: 
-            cumsum : array
-                Cumulative sum from which shall be drawn.
+        All trajectories are advanced in lockstep: in every step one saccade
+        is drawn for every trajectory that is not yet complete. 
+
+        Parameters:
+            num_samples : int
+                The number of trajectories that shall be generated.
 
         Returns:
-            int : Index of the cumulative sum element drawn.
+            x, y : arrays
+                Coordinates of all fixations, ordered by trajectory and
+                fixation number.
+            fix : array
+                Fixation number within the trajectory (starting at 1).
+            sample : array
+                Number of the trajectory that a fixation belongs to.
+        """
+        sizes = self._draw_sizes(num_samples, self.rng)
+        (fix, sample) = trajectory_index(sizes)
+        x = np.zeros(len(fix))
+        y = np.zeros(len(fix))
+        self._sample_saccades(sizes, self.rng, x, y)
+        return x, y, fix, sample
+
+    def _draw_sizes(self, num_samples, rng):
+        """
+        Draws the number of fixations of num_samples trajectories.
         """
-        a = cumsum.rsplit()
-        if len(a)>1:
-            b = eval(a[0])[int(a[1])]
+        sizes = self.trajLen_borders[self._traj_table.draw(rng, 
+                                            np.zeros(num_samples, dtype=int))]
+        # Round as python's round, each trajectory has at least one fixation
+        sizes = np.sign(sizes) * np.floor(np.abs(sizes) + 0.5)
+        return np.maximum(sizes, 1).astype(int)
+
+    def _sample_saccades(self, sizes, rng, x, y):
+        """
+        Draws the fixations of trajectories with the given sizes and writes
+        their coordinates into x and y, which have length sizes.sum().
+        """
+        ppd = self.pixels_per_degree
+        num_samples = len(sizes)
+        starts = np.cumsum(sizes) - sizes
+        x[starts] = 0
+        y[starts] = 0
+        # Sort trajectories by size, the trajectories that are still active 
+        # in a step are then always the first ones.
+        order = np.argsort(-sizes, kind='mergesort')
+        starts = starts[order]
+        sizes = sizes[order]
+        cur_x = np.zeros(num_samples)
+        cur_y = np.zeros(num_samples)
+        angle = length = None
+        first_columns = self.firstLenAng_shape[1]
+        for step in range(1, sizes.max() if num_samples > 0 else 0):
+            num_active = np.searchsorted(-sizes, -step, side='left')
+            (cur_x, cur_y) = (cur_x[:num_active], cur_y[:num_active])
+            if step == 1:
+                idx = self._first_table.draw(rng, 
+                                             np.zeros(num_active, dtype=int))
+                (length, angle) = np.divmod(idx, first_columns)
+                angle = angle - (first_columns - 1) // 2 + 0.5
+            else:
+                prev_angle = angle[:num_active]
+                ind = np.floor(length[:num_active] / ppd).astype(int)
+                ind = np.minimum(ind, len(self._dist_index) - 1)
+                dist = self._dist_index[ind]
+                idx = self._dist_table.draw(rng, dist)
+                columns = self._dist_columns[dist]
+                (length, angle) = np.divmod(idx, columns)
+                angle = reshift((angle - columns // 2) + prev_angle) + 0.5
+            length = (length + 0.5) * ppd
+            cur_x = cur_x + np.cos(np.radians(angle)) * length
+            cur_y = cur_y + np.sin(np.radians(angle)) * length
+            x[starts[:num_active] + step] = cur_x
+            y[starts[:num_active] + step] = cur_y
+
+def random_state(seed = None):
+    """
+    Returns a seeded numpy random number generator, a np.random.Generator
+    where numpy provides it and a np.random.RandomState otherwise.
+    """
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+def random_seed(rng):
+    """
+    Draws an integer that can be used to seed another generator.
+    """
+    if isinstance(rng, np.random.RandomState):
+        return rng.randint(2**31)
+    return int(rng.integers(2**31))
+
+def uniform(rng, size):
+    """
+    Draws size uniform random numbers in [0, 1) from rng.
+    """
+    if isinstance(rng, np.random.RandomState):
+        return rng.random_sample(size)
+    return rng.random(size)
+
+def cumsum_weights(cumsum):
+    """
+    Returns the probabilities of a distribution given by its cumulative sum.
+    """
+    return np.maximum(np.diff(np.concatenate(([0], cumsum))), 0)
+
+class AliasTable(object):
+    """
+    Walker alias tables for exact O(1) draws from one or several discrete 
+    distributions.
+
+    Parameters:
+        distributions : list of arrays
+            Unnormalized probabilities of every distribution. Empty 
+            distributions are allowed but must not be drawn from.
+    """
+    def __init__(self, distributions):
+        sizes = [len(d) for d in distributions]
+        self.sizes = np.array(sizes, dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(int)
+        self.prob = np.ones(sum(sizes))
+        self.alias = np.zeros(sum(sizes), dtype=int)
+        for (offset, weights) in zip(self.offsets, distributions):
+            if len(weights) == 0:
+                continue
+            (prob, alias) = alias_table(weights)
+            self.prob[offset:offset + len(weights)] = prob
+            self.alias[offset:offset + len(weights)] = alias
+
+    def draw(self, rng, dist):
+        """
+        Draws one value for every entry of dist from the distributions
+        given by dist. Returns indices into these distributions.
+        """
+        sizes = self.sizes[dist]
+        idx = np.minimum((uniform(rng, len(dist)) * sizes).astype(int), 
+                         sizes - 1)
+        accept = uniform(rng, len(dist)) < self.prob[self.offsets[dist] + idx]
+        return np.where(accept, idx, self.alias[self.offsets[dist] + idx])
+
+def alias_table(weights):
+    """
+    Computes a Walker alias table (Vose's method) for a discrete 
+    distribution. 
+    
+    Index i is drawn by picking a bin j uniformly and returning j with 
+    probability prob[j] and alias[j] otherwise.
+
+    Parameters:
+        weights : array
+            Unnormalized probabilities.
+    Returns:
+        prob, alias : arrays
+    """
+    weights = np.asarray(weights, dtype=float)
+    scaled = (weights * (len(weights) / weights.sum())).tolist()
+    prob = [1.0] * len(weights)
+    alias = range(len(weights))
+    small = [i for (i, w) in enumerate(scaled) if w < 1]
+    large = [i for (i, w) in enumerate(scaled) if w >= 1]
+    while small and large:
+        (less, more) = (small.pop(), large.pop())
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] = (scaled[more] + scaled[less]) - 1
+        if scaled[more] < 1:
+            small.append(more)
         else:
-            b = eval(a[0])
-            
-        return np.nonzero(b>=r)[0][0]
-        
-def multiprocess(arguments):
-    (sim, numsamples) = arguments
-    sim.initializeData()
-    return sim.sample_many(num_samples = numsamples)
+            large.append(more)
+    # Bins that are left over are full up to rounding errors
+    return np.array(prob), np.array(alias, dtype=int)
+
+# Format version of files written by FixGen.save
+MODEL_VERSION = 1
+
+def load(path, fm = None, seed = None):
+    """
+    Loads a FixGen that was saved with FixGen.save. The arrays are 
+    memory-mapped from the file, so loading takes constant time and 
+    processes that load the same file share its pages.
+
+    Parameters:
+        path : string
+            Absolute path of the file to load from.
+        fm : ocupy.fixmat, optional
+            The fixation data that the model was computed from, it is 
+            only used by FixGen.parameters.
+        seed : int, optional
+            Seed for the random number generator of the FixGen.
+    """
+    import h5py
+    f = h5py.File(path, 'r')
+    try:
+        group = f['FixGen']
+        if group.attrs['version'] != MODEL_VERSION:
+            raise RuntimeError('Unsupported FixGen file version %s' % 
+                               group.attrs['version'])
+        gen = FixGen.__new__(FixGen)
+        gen.fm = fm
+        gen.rng = random_state(seed)
+        gen.pixels_per_degree = group.attrs['pixels_per_degree']
+        gen.firstLenAng_shape = tuple(group.attrs['firstLenAng_shape'])
+        gen.nosamples = list(group.attrs['nosamples'])
+        for name in ['firstLenAng_cumsum', 'trajLen_cumsum', 
+                     'trajLen_borders', '_dist_index', '_dist_columns']:
+            setattr(gen, name, datamat.memmap_dataset(group[name]))
+        for name in ['full_H1', 'probability_cumsum']:
+            dists = group[name]
+            setattr(gen, name, [datamat.memmap_dataset(dists[str(i)]) 
+                                for i in range(len(dists))])
+        for name in ['_dist_table', '_first_table', '_traj_table']:
+            table = AliasTable([])
+            for field in ['prob', 'alias', 'sizes', 'offsets']:
+                setattr(table, field,
+                        datamat.memmap_dataset(group[name][field]))
+            setattr(gen, name, table)
+    finally:
+        f.close()
+    return gen
+
+# The generator and output arrays shared with worker processes by generate
+_shared_generation = None
+
+def _generate_task(task):
+    (first, last, seed) = task
+    (gen, sizes, starts, x, y) = _shared_generation
+    if first == last:
+        return
+    begin = starts[first]
+    end = starts[last - 1] + sizes[last - 1]
+    gen._sample_saccades(sizes[first:last], random_state(seed), 
+                         np.frombuffer(x)[begin:end], 
+                         np.frombuffer(y)[begin:end])
+
+def trajectory_index(sizes):
+    """
+    Returns the fixation number (starting at 1) and the trajectory number 
+    of every fixation for trajectories with the given number of fixations.
+    """
+    sizes = np.asarray(sizes, dtype=int)
+    starts = np.cumsum(sizes) - sizes
+    sample = np.repeat(np.arange(len(sizes)), sizes)
+    fix = np.arange(sizes.sum()) - starts[sample] + 1
+    return fix, sample
 
 def makeAngLenHist(ad, ld, fm = None, collapse=True, fit=spline_base.fit2d):
     """
@@ -438,7 +677,7 @@ def shuffled_anglendiff(angles, lengths, roll = 2, return_abs = False):
     else:
         return sangle_diffs, slength_diffs
             
-def anglendiff(fm, roll = 2, return_abs=False):
+def anglendiff(fm, roll = 2, return_abs=False, chunk_size = None):
     """
     Calculates the lengths and angles of the saccades contained in the fixmat
     as well as length- and angle differences between consecutive saccades.
@@ -467,18 +706,55 @@ def anglendiff(fm, roll = 2, return_abs=False):
             
                 >>> angles, lengths, angle_diffs, length_diffs = 
                             anglendiff(fm, return_abs = True)
+        chunk_size : int, optional
+            If given, the fixmat is processed in blocks of chunk_size 
+            fixations, which bounds the memory needed for intermediate 
+            results. Out-of-core fixmats are processed in blocks of 
+            datamat.CHUNK_SIZE by default.
     """
-    
+    if chunk_size is None and fm.out_of_core():
+        chunk_size = datamat.CHUNK_SIZE
+    # Every result depends on the roll+1 preceding fixations
+    context = roll + 1
+    if chunk_size is None or len(fm) <= max(chunk_size, context):
+        results = _anglendiff(fm.x, fm.y, fm.fix, min(fm.fix), roll)
+    else:
+        results = _anglendiff_chunked(fm, roll, chunk_size)
+    (angles, lengths, angle_diffs, length_diffs) = results
+    if return_abs == True:
+        return angles, lengths, angle_diffs, length_diffs
+    else:
+        return angle_diffs, length_diffs
+
+def _anglendiff_chunked(fm, roll, chunk_size):
+    num = len(fm)
+    context = roll + 1
+    first_fix = min(chunk.fix.min() for chunk in 
+                    fm.iter_chunks(chunk_size, ['fix']))
+    results = [[np.empty(num) for _ in range(roll)] for _ in range(4)]
+    for start in xrange(0, num, chunk_size):
+        stop = min(start + chunk_size, num)
+        # Prepend the context, wrapping around at the start like np.roll
+        window = fm.filter(np.arange(start - context, stop) % num, 
+                           lazy = True)
+        chunk_results = _anglendiff(window.x, window.y, window.fix, 
+                                    first_fix, roll)
+        for (result, chunk_result) in zip(results, chunk_results):
+            for (values, chunk_values) in zip(result, chunk_result):
+                values[start:stop] = chunk_values[context:]
+    return results
+
+def _anglendiff(x, y, fix, first_fix, roll):
     angle_diffs = []
     length_diffs = []
     lengths = []
     angles  = []
     
     for r in range(1, roll+1):
-        heights = (fm.y - np.roll(fm.y, r)).astype(float)
-        widths = (fm.x - np.roll(fm.x, r)).astype(float)
-        heights[fm.fix <= min(fm.fix)+r-1]=np.nan
-        widths[fm.fix <= min(fm.fix)+r-1]=np.nan
+        heights = (y - np.roll(y, r)).astype(float)
+        widths = (x - np.roll(x, r)).astype(float)
+        heights[fix <= first_fix+r-1]=np.nan
+        widths[fix <= first_fix+r-1]=np.nan
         
         lengths.append((widths**2+heights**2)**.5)
         angles.append(np.degrees(np.arctan2(heights, widths)))
@@ -488,12 +764,7 @@ def anglendiff(fm, roll = 2, return_abs=False):
         # -360: straight saccades, -180: return saccades, 0: straight saccades,
         # 180: return saccades, 360: no return saccades
         angle_diffs.append(angles[0] - np.roll(angles[r-1], 1))
-                
-    if return_abs == True:
-        return angles, lengths, angle_diffs, length_diffs
-        
-    else:
-        return angle_diffs, length_diffs
+    return angles, lengths, angle_diffs, length_diffs
  
 def compute_cumsum(H):
     """
@@ -6,7 +6,8 @@ except ImportError:
 
 from utils import Memoize
 
-def fit3d(samples, e_x, e_y, e_z, remove_zeros = False, **kw):
+def fit3d(samples, e_x, e_y, e_z, remove_zeros = False, return_model = False,
+          **kw):
     """Fits a 3D distribution with splines.
 
     Input:
@@ -23,6 +24,8 @@ def fit3d(samples, e_x, e_y, e_z, remove_zeros = False, **kw):
             If True, events that are not observed will not 
             be part of the fitting process. If False, those 
             events will be modelled as finfo('float').eps 
+        return_model: Bool
+            If True, the fitted SplineModel is returned as well.
         **kw: Arguments that are passed on to spline_bse1d.
 
     Returns:
@@ -31,6 +34,9 @@ def fit3d(samples, e_x, e_y, e_z, remove_zeros = False, **kw):
             events defined by e.
         knots: Tuple of arrays
             Sequence of knots that were used for the spline basis (x,y) 
+        model: SplineModel
+            Only if return_model is True. The axes of the model are 
+            (x, y, z), as for distribution.
     """
     height, width, depth = len(e_y)-1, len(e_x)-1, len(e_z)-1 
     
@@ -41,14 +47,27 @@ def fit3d(samples, e_x, e_y, e_z, remove_zeros = False, **kw):
         non_zero = ~(p_est == 0)
     else:
         non_zero = (p_est >= 0)
-    basis = spline_base3d(width,height, depth, **kw)
+    basis, knots = spline_base3d(width,height, depth, **kw)
     model = linear_model.BayesianRidge()
     model.fit(basis[:, non_zero].T, p_est[:,np.newaxis][non_zero,:])
-    return (model.predict(basis.T).reshape((width, height, depth)), 
+    result = (model.predict(basis.T).reshape((width, height, depth)), 
                 p_est.reshape((width, height, depth)))
+    if return_model:
+        # spline_base3d builds its 2D part with width and height swapped:
+        # knots[1] belongs to the x axis, knots[0] to the y axis, and 
+        # basis a*nx*ny + i*ny + j is z spline a, x spline i, y spline j.
+        axes_knots = (knots[1], knots[0], knots[2])
+        nr_coeff = [len(k) - kw.get('spline_order', 3) - 1 
+                    for k in axes_knots]
+        coef = model.coef_[:np.prod(nr_coeff)].reshape(
+                    (nr_coeff[2], nr_coeff[0], nr_coeff[1]))
+        result += (SplineModel(axes_knots, kw.get('spline_order', 3), 
+                               coef.transpose((1, 2, 0)), model.intercept_),)
+    return result
        
        
-def fit2d(samples,e_x, e_y, remove_zeros = False, p_est = None,  **kw):
+def fit2d(samples,e_x, e_y, remove_zeros = False, p_est = None, 
+          return_model = False, **kw):
     """Fits a 2D distribution with splines.
 
     Input:
@@ -67,14 +86,21 @@ def fit2d(samples,e_x, e_y, remove_zeros = False, p_est = None,  **kw):
             If True, events that are not observed will not 
             be part of the fitting process. If False, those 
             events will be modelled as finfo('float').eps 
+        return_model: Bool
+            If True, the fitted SplineModel is returned as well.
         **kw: Arguments that are passed on to spline_bse1d.
 
     Returns:
         distribution: Array
             An array that gives an estimate of probability for 
             events defined by e.
+        p_est: Array
+            The histogram that was fitted.
         knots: Tuple of arrays
             Sequence of knots that were used for the spline basis (x,y) 
+        model: SplineModel
+            Only if return_model is True. The axes of the model are 
+            (y, x), as for distribution.
     """
     if p_est is None:
         height = len(e_y)-1
@@ -88,21 +114,131 @@ def fit2d(samples,e_x, e_y, remove_zeros = False, p_est = None,  **kw):
     p_est = (p_est/sum(p_est.flat)).reshape(shape)
     mx =  p_est.sum(1)
     my = p_est.sum(0)
-    # Transpose hist to have x in dim 0
-    p_est = p_est.T.flatten()
-    basis, knots = spline_base2d(width, height, marginal_x = mx, marginal_y = my, **kw)
-    model = linear_model.BayesianRidge()
+    # Transpose hist to have y in dim 0
+    p_est = p_est.T.copy()
+    spline_setx, spline_sety, knots = spline_factors2d(width, height, 
+            marginal_x = mx, marginal_y = my, **kw)
+    # The 2D basis is the Kronecker product of the 1D bases, the fit is 
+    # computed from the 1D bases without building the 2D basis.
     if remove_zeros:
         non_zero = ~(p_est == 0)
-        model.fit(basis[:, non_zero].T, p_est[non_zero])
     else:
-        non_zero = (p_est >= 0)
-        p_est[~non_zero,:] = np.finfo(float).eps
-        model.fit(basis.T, p_est)
-    return (model.predict(basis.T).reshape((height, width)), 
-            p_est.reshape((height, width)), knots)
+        non_zero = None
+        p_est[p_est == 0] = np.finfo(float).eps
+    (coef, intercept) = kron_bayesian_ridge(spline_sety, spline_setx, p_est,
+                                            non_zero)
+    prediction = np.dot(np.dot(spline_sety, coef), spline_setx.T) + intercept
+    if return_model:
+        model = SplineModel((knots[1], knots[0]), 
+                            kw.get('spline_order', 5), coef, intercept)
+        return (prediction, p_est, knots, model)
+    return (prediction, p_est, knots)
+
+def kron_bayesian_ridge(spline_sety, spline_setx, target, mask = None, 
+                        **kw):
+    """
+    Fits target with Bayesian ridge regression on the basis that is the
+    tensor product of two 1D bases, i.e. on the columns of 
+    np.kron(spline_sety, spline_setx).
+
+    The result is the same as fitting sklearn's BayesianRidge (with an 
+    intercept), but the regression is computed from the Gram matrix of the
+    basis, which is the Kronecker product of the Gram matrices of the 1D 
+    bases. Neither the 2D basis nor the full design matrix are built.
+
+    Input:
+        spline_sety: Array
+            Basis along the first dimension of target, height x ky
+        spline_setx: Array
+            Basis along the second dimension of target, width x kx
+        target: Array
+            height x width array of values to be fitted
+        mask: Array, optional
+            Boolean array of the shape of target, only values where mask is
+            True are fitted.
+        **kw: Parameters of the Bayesian ridge, see bayesian_ridge_gram.
+    Returns:
+        coef: Array
+            ky x kx array of coefficients, the prediction is
+            np.dot(np.dot(spline_sety, coef), spline_setx.T) + intercept
+        intercept: float
+    """
+    (ky, kx) = (spline_sety.shape[1], spline_setx.shape[1])
+    target = np.asarray(target, dtype=float)
+    if mask is None:
+        num = target.size
+        gram = np.kron(np.dot(spline_sety.T, spline_sety), 
+                       np.dot(spline_setx.T, spline_setx))
+        offset = np.kron(spline_sety.sum(0), spline_setx.sum(0)) / num
+    else:
+        mask = np.asarray(mask, dtype=float)
+        num = mask.sum()
+        # Gram matrix of the masked rows, built from the pairwise products
+        # of the 1D bases and summed over x first
+        prod_x = (spline_setx[:, :, np.newaxis] * 
+                  spline_setx[:, np.newaxis, :]).reshape((-1, kx * kx))
+        prod_y = (spline_sety[:, :, np.newaxis] * 
+                  spline_sety[:, np.newaxis, :]).reshape((-1, ky * ky))
+        gram = np.dot(prod_y.T, np.dot(mask, prod_x))
+        gram = gram.reshape((ky, ky, kx, kx)).transpose((0, 2, 1, 3))
+        gram = gram.reshape((ky * kx, ky * kx))
+        offset = np.dot(np.dot(spline_sety.T, mask), spline_setx).ravel() / num
+        target = target * mask
+    target_mean = target.sum() / num
+    xty = np.dot(np.dot(spline_sety.T, target), spline_setx).ravel()
+    # Center design matrix and target
+    gram = gram - num * np.outer(offset, offset)
+    xty = xty - num * offset * target_mean
+    if mask is None:
+        yty = ((target - target_mean) ** 2).sum()
+    else:
+        yty = (((target - target_mean) ** 2) * mask).sum()
+    coef = bayesian_ridge_gram(gram, xty, yty, num, **kw)
+    intercept = target_mean - np.dot(offset, coef)
+    return coef.reshape((ky, kx)), intercept
 
-def fit1d(samples, e, remove_zeros = False, **kw):
+def bayesian_ridge_gram(gram, xty, yty, num, n_iter = 300, tol = 1.e-3, 
+        alpha_1 = 1.e-6, alpha_2 = 1.e-6, lambda_1 = 1.e-6, lambda_2 = 1.e-6):
+    """
+    Bayesian ridge regression (as in sklearn's BayesianRidge) computed from
+    sufficient statistics of centered data.
+
+    Input:
+        gram: Array
+            X.T X for the centered design matrix X
+        xty: Array
+            X.T y for the centered target y
+        yty: float
+            y.T y
+        num: int
+            Number of samples
+        Remaining parameters: see sklearn.linear_model.BayesianRidge
+    Returns:
+        coef: Array
+            Coefficients of the regression.
+    """
+    eps = np.finfo(np.float64).eps
+    (eigen_vals, eigen_vecs) = np.linalg.eigh(gram)
+    eigen_vals = np.maximum(eigen_vals, 0)
+    vty = np.dot(eigen_vecs.T, xty)
+    alpha = 1. / (yty / num + eps)
+    lambda_ = 1.
+    coef_old = None
+    for iteration in range(n_iter):
+        coef = np.dot(eigen_vecs, vty / (eigen_vals + lambda_ / alpha))
+        # Residual sum of squares, computed from the sufficient statistics
+        rmse = max(yty - 2 * np.dot(coef, xty) + 
+                   np.dot(coef, np.dot(gram, coef)), 0)
+        gamma = np.sum((alpha * eigen_vals) / (lambda_ + alpha * eigen_vals))
+        lambda_ = ((gamma + 2 * lambda_1) / 
+                   (np.sum(coef ** 2) + 2 * lambda_2))
+        alpha = ((num - gamma + 2 * alpha_1) / (rmse + 2 * alpha_2))
+        if iteration != 0 and np.sum(np.abs(coef_old - coef)) < tol:
+            break
+        coef_old = coef
+    return coef
+
+def fit1d(samples, e, remove_zeros = False, return_model = False, **kw):
     """Fits a 1D distribution with splines.
 
     Input:
@@ -113,14 +249,20 @@ def fit1d(samples, e, remove_zeros = False, **kw):
             distribution. For example, e[0] < x <= e[1] is
             the range of values that are associated with the
             first event.
+        return_model: Bool
+            If True, the fitted SplineModel is returned as well.
         **kw: Arguments that are passed on to spline_bse1d.
 
     Returns:
         distribution: Array
             An array that gives an estimate of probability for 
             events defined by e.
+        hist: Array
+            The histogram that was fitted.
         knots: Array
             Sequence of knots that were used for the spline basis
+        model: SplineModel
+            Only if return_model is True.
     """
     samples = samples[~np.isnan(samples)]
     length = len(e)-1
@@ -134,8 +276,93 @@ def fit1d(samples, e, remove_zeros = False, **kw):
     else:
         hist[~non_zero] = np.finfo(float).eps
         model.fit(basis, hist[:,np.newaxis])
+    if return_model:
+        return (model.predict(basis), hist, knots, 
+                SplineModel((knots,), kw.get('spline_order', 5), 
+                            model.coef_, model.intercept_))
     return model.predict(basis), hist, knots
 
+class SplineModel(object):
+    """
+    A fitted spline model, i.e. a tensor product spline given by knots and
+    coefficients for every axis.
+
+    The model can be evaluated at any resolution, and at arbitrary points, 
+    without refitting. Coordinates are given in units of the bins of the
+    fitted distribution: bin i of an axis is located at coordinate i. 
+    Evaluating the model at np.arange(n) along every axis therefore 
+    reproduces the fitted distribution; np.linspace(-0.5, n-0.5, 2*n) gives
+    the same distribution at twice the resolution.
+    
+    Input:
+        knots: Sequence of arrays
+            Knots of the splines along every axis.
+        spline_order: int
+            Order of the splines.
+        coef: Array
+            Coefficients with one dimension per axis.
+        intercept: float
+    """
+    def __init__(self, knots, spline_order, coef, intercept = 0.0):
+        self.knots = tuple(np.asarray(k, dtype=float) for k in knots)
+        self.spline_order = spline_order
+        self.coef = np.asarray(coef, dtype=float).reshape(
+                [len(k) - spline_order - 1 for k in self.knots])
+        self.intercept = float(intercept)
+
+    @property
+    def ndim(self):
+        return len(self.knots)
+
+    def bases(self, coordinates):
+        """
+        Returns the collocation matrices of the splines along every axis
+        at coordinates (one array per axis).
+        """
+        if len(coordinates) != self.ndim:
+            raise ValueError('Model has %d axes, got coordinates for %d' % 
+                             (self.ndim, len(coordinates)))
+        # The bases of the fit are evaluated at 1..n
+        return [spcol(np.asarray(c, dtype=float).ravel() + 1, k, 
+                      self.spline_order)
+                for (c, k) in zip(coordinates, self.knots)]
+
+    def evaluate(self, coordinates, grid = True):
+        """
+        Evaluates the model.
+        
+        Input:
+            coordinates: Sequence of arrays
+                One array of coordinates per axis.
+            grid: Bool
+                If True, the model is evaluated on the grid spanned by
+                the coordinates, otherwise at the points given by the
+                coordinates (in this case all arrays need to have the same
+                length). 
+        Output:
+            values: Array
+                If grid is True, an array with one dimension per axis, 
+                otherwise an array with one value per point.
+        """
+        bases = self.bases(coordinates)
+        if grid:
+            values = self.coef
+            for basis in bases:
+                # Contract the first coefficient axis, the evaluated axis
+                # is appended at the end
+                values = np.tensordot(values, basis, axes=([0], [1]))
+            return values + self.intercept
+        if len(set(len(basis) for basis in bases)) > 1:
+            raise ValueError('Point coordinates need to have the same length')
+        values = np.dot(bases[-1], self.coef.reshape((-1, 
+                            self.coef.shape[-1])).T)
+        for (axis, basis) in reversed(list(enumerate(bases[:-1]))):
+            # values holds the contraction of the trailing axes, it has
+            # shape points x (coefficients of the leading axes)
+            values = values.reshape((len(basis), -1, basis.shape[1]))
+            values = np.einsum('pkj,pj->pk', values, basis)
+        return values.ravel() + self.intercept
+
 def knots_from_marginal(marginal, nr_knots, spline_order):
     """
     Determines knot placement based on a marginal distribution.  
@@ -228,6 +455,33 @@ def spline_base2d(width, height, nr_knots_x = 20.0, nr_knots_y = 20.0,
         knots: Tuple 
             (x,y) are knot arrays that show the placement of knots.
     """
+    spline_setx, spline_sety, (knots_x, knots_y) = spline_factors2d(width,
+            height, nr_knots_x, nr_knots_y, spline_order, marginal_x, 
+            marginal_y)
+    nr_coeff = [spline_sety.shape[1], spline_setx.shape[1]]
+    dim_bspline = [nr_coeff[0]*nr_coeff[1], width*height]
+    # construct 2D B-splines, basis IDX1*nr_coeff[1]+IDX2 is the outer 
+    # product of the IDX1th y and the IDX2th x spline
+    bspline = (spline_sety.T[:, np.newaxis, :, np.newaxis] * 
+               spline_setx.T[np.newaxis, :, np.newaxis, :])
+    return bspline.reshape(dim_bspline), (knots_x, knots_y)
+
+@Memoize
+def spline_factors2d(width, height, nr_knots_x = 20.0, nr_knots_y = 20.0, 
+        spline_order = 5, marginal_x = None, marginal_y = None):
+    """Computes the 1D spline bases whose tensor product is the basis
+    computed by spline_base2d.
+
+    For a description of the parameters see spline_base2d.
+
+    Output:
+        spline_setx: Matrix
+            width x kx collocation matrix of the x splines
+        spline_sety: Matrix
+            height x ky collocation matrix of the y splines
+        knots: Tuple 
+            (x,y) are knot arrays that show the placement of knots.
+    """
     if not (nr_knots_x<width and nr_knots_y<height):
         raise RuntimeError("Too many knots for size of the base")
     if marginal_x is None:
@@ -242,19 +496,7 @@ def spline_base2d(width, height, nr_knots_x = 20.0, nr_knots_y = 20.0,
     y_eval = np.arange(1,height+1).astype(float)    
     spline_setx = spcol(x_eval, knots_x, spline_order)
     spline_sety = spcol(y_eval, knots_y, spline_order)
-    nr_coeff = [spline_sety.shape[1], spline_setx.shape[1]]
-    dim_bspline = [nr_coeff[0]*nr_coeff[1], len(x_eval)*len(y_eval)]
-    # construct 2D B-splines 
-    nr_basis = 0
-    bspline = np.zeros(dim_bspline)
-    for IDX1 in range(0,nr_coeff[0]):
-        for IDX2 in range(0, nr_coeff[1]):
-            rand_coeff  = np.zeros((nr_coeff[0] , nr_coeff[1]))
-            rand_coeff[IDX1,IDX2] = 1
-            tmp = np.dot(spline_sety,rand_coeff)
-            bspline[nr_basis,:] = np.dot(tmp,spline_setx.T).reshape((1,-1))
-            nr_basis = nr_basis+1
-    return bspline, (knots_x, knots_y)
+    return spline_setx, spline_sety, (knots_x, knots_y)
 
 def spline_base3d( width, height, depth, nr_knots_x = 10.0, nr_knots_y = 10.0,
         nr_knots_z=10, spline_order = 3, marginal_x = None, marginal_y = None, 
@@ -274,18 +516,19 @@ def spline_base3d( width, height, depth, nr_knots_x = 10.0, nr_knots_y = 10.0,
     z_eval = np.arange(1,depth+1).astype(float)
     spline_setz = spcol(z_eval, knots_z, spline_order)
     bspline = np.zeros((basis2d.shape[0]*len(z_eval), height*width*depth))
-    basis_nr = 0
-    for spline_a in spline_setz.T:
-        for spline_b in basis2d:
-            spline_b = spline_b.reshape((height, width))
-            bspline[basis_nr, :] = (spline_b[:,:,np.newaxis] * spline_a[:]).flat
-            basis_nr +=1
+    # Basis a*len(basis2d)+b is the product of the ath z spline and the 
+    # bth 2D basis. Rows beyond the number of bases remain zero.
+    nr_basis = spline_setz.shape[1]*basis2d.shape[0]
+    basis2d = basis2d.reshape((basis2d.shape[0], height, width))
+    bspline[:nr_basis, :] = (
+            spline_setz.T[:, np.newaxis, np.newaxis, np.newaxis, :] * 
+            basis2d[np.newaxis, :, :, :, np.newaxis]).reshape((nr_basis, -1))
     return bspline, (knots_x, knots_y, knots_z)
 
 def spline(x,knots,p,i=0.0):
     """Evaluates the ith spline basis given by knots on points in x"""
     assert(p+1<len(knots))
-    return np.array([N(float(u),float(i),float(p),knots) for u in x])
+    return np.array([N(float(u),int(i),int(p),knots) for u in x])
 
 def spcol(x,knots,spline_order):
     """Computes the spline colocation matrix for knots in x.
@@ -305,10 +548,25 @@ def spcol(x,knots,spline_order):
             on and p is the spline order. The colums contain 
             the ith basis of knots evaluated on x.
     """
-    colmat = np.nan*np.ones((len(x),len(knots) - spline_order-1))
-    for i in range(0,len(knots) - spline_order -1):
-        colmat[:,i] = spline(x,knots,spline_order,i)
+    assert(spline_order+1<len(knots))
+    x = np.asarray(x, dtype=float).reshape(-1, 1)
+    knots = np.asarray(knots, dtype=float)
+    # Cox-de Boor recursion for all points and bases at once. Column i
+    # of colmat holds the basis of degree p that starts at knot i.
+    colmat = ((knots[:-1] <= x) & (x < knots[1:])).astype(float)
+    for p in range(1, spline_order+1):
+        num_bases = len(knots) - p - 1
+        left = _ratio(x - knots[:num_bases], 
+                      knots[p:p+num_bases] - knots[:num_bases])
+        right = _ratio(knots[p+1:p+1+num_bases] - x,
+                       knots[p+1:p+1+num_bases] - knots[1:1+num_bases])
+        colmat = left * colmat[:, :-1] + right * colmat[:, 1:]
     return colmat
+
+def _ratio(numerator, denominator):
+    # numerator / denominator, where terms with a zero denominator are 0
+    zero = (denominator == 0)
+    return np.where(zero, 0.0, numerator / np.where(zero, 1.0, denominator))
     
 def augknt(knots,order):
     """Augment knot sequence such that some boundary conditions 
@@ -58,7 +58,7 @@ class Categories(object):
             idx = np.zeros(self._fixations.x.shape, dtype='bool')
             for (cat, _) in self._categories.iteritems():
                 idx = idx | ((self._fixations.category == cat))
-            return self._fixations[idx]
+            return self._fixations.filter(idx, lazy = True)
 
 class Images(object):
     """
@@ -98,8 +98,10 @@ class Images(object):
         if not self._fixations:
             raise RuntimeError('This Images object does not have'
                 +' an associated fixmat')
-        return self._fixations[(self._fixations.category == self.category) &
-                ismember(self._fixations.filenumber, self._images.keys())]   
+        return self._fixations.filter(
+                (self._fixations.category == self.category) &
+                ismember(self._fixations.filenumber, self._images.keys()),
+                lazy = True)   
 
 class Image(object):
     """
@@ -170,8 +172,9 @@ class Image(object):
         if not self._fixations:
             raise RuntimeError('This Images object does not have'
                 +' an associated fixmat')
-        return self._fixations[(self._fixations.category == self.category) &
-                               (self._fixations.filenumber == self.image)]
+        return self._fixations.filter(
+                (self._fixations.category == self.category) &
+                (self._fixations.filenumber == self.image), lazy = True)
 
 
 def FixmatStimuliFactory(fm, loader):
@@ -4,7 +4,13 @@
 import unittest
 import numpy as np
 
-from ocupy import fixmat, bounds, measures
+from ocupy import fixmat, bounds, measures, datamat
+from ocupy.fixmat import compute_fdm
+from ocupy.utils import ismember
+
+
+def _add(shared, value):
+    return shared + value
 
 
 class TestBounds(unittest.TestCase):
@@ -73,8 +79,70 @@ class TestBounds(unittest.TestCase):
         self.assertRaises(AssertionError, lambda: bounds.lower_bound(self.fm, nr_imgs = 100))
         self.assertRaises(AssertionError, lambda: bounds.lower_bound(self.fm, nr_subs = 100))
 
+    def test_upper_bound_incremental(self):
+        # Both ways evaluate subjects and images in a different order, so
+        # random control locations would differ. Use fixed ones instead.
+        rng = np.random.RandomState(1)
+        ctr_loc = (rng.randint(0, 100, 1000), rng.randint(0, 500, 1000))
+        def roc_fixed_controls(prediction, fm):
+            return measures.roc_model(prediction, fm, ctr_loc = ctr_loc)
+        measures.set_scores([roc_fixed_controls,
+                             measures.kldiv_model,
+                             measures.nss_model])
+        incremental = bounds.upper_bound(self.fm)
+        direct = bounds.upper_bound(self.fm, incremental = False)
+        for (inc, dir) in zip(incremental, direct):
+            for cat in inc.keys():
+                self.assertTrue(np.allclose(inc[cat], dir[cat]))
+
+    def test_parallel(self):
+        for bound in [bounds.lower_bound, 
+                      lambda fm, **kw: bounds.upper_bound(fm, 3, **kw)]:
+            serial = bound(self.fm, seed = 3)
+            repeated = bound(self.fm, seed = 3)
+            parallel = bound(self.fm, seed = 3, n_jobs = 2)
+            for (ser, rep, par) in zip(serial, repeated, parallel):
+                for cat in ser.keys():
+                    self.assertTrue(np.array_equal(ser[cat], rep[cat]))
+                    self.assertTrue(np.allclose(ser[cat], par[cat]))
+
+    def test_run_tasks_without_fork(self):
+        # Without fork, workers would not see the shared data
+        import warnings
+        forks = bounds._forks
+        bounds._forks = lambda: False
+        try:
+            with warnings.catch_warnings(record = True) as caught:
+                warnings.simplefilter('always')
+                results = bounds.run_tasks(_add, 10, [(1,), (2,)], n_jobs = 2)
+        finally:
+            bounds._forks = forks
+        self.assertEquals(results, [11, 12])
+        self.assertEquals(len(caught), 1)
+
     def tearDown(self):
         self.fm = None
+
+
+class TestLeaveOneOutFDM(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.fm = datamat.VectorFactory({
+                'x':np.random.rand(60) * 50,
+                'y':np.random.rand(60) * 40,
+                'SUBJECTINDEX':np.random.randint(1, 5, 60)},
+                {'image_size':[40, 50], 'pixels_per_degree':3})
+
+    def test_fdm(self):
+        for sf in [1, 0.5]:
+            loo = bounds.LeaveOneOutFDM(self.fm, scale_factor = sf)
+            for left_out in [1, 2, [3, 4], 7]:
+                fdm = compute_fdm(self.fm[~ismember(self.fm.SUBJECTINDEX,
+                        np.atleast_1d(left_out))], scale_factor = sf)
+                self.assertTrue(np.allclose(loo.fdm(left_out), fdm,
+                                            atol = 1e-12 * fdm.max()))
+            self.assertRaises(RuntimeError, loo.fdm, [1, 2, 3, 4])
+
         
 if __name__ == '__main__':
     unittest.main()
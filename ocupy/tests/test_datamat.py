@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import unittest
+import numpy as np
+
+from ocupy import datamat
+
+
+class TestDatamat(unittest.TestCase):
+    def setUp(self):
+        self.dm = datamat.VectorFactory({
+                'category': np.array([2, 1, 2, 3, 1, 2, 3, 3]),
+                'filenumber': np.array([1, 1, 2, 1, 2, 1, 1, 2]),
+                'x': np.arange(8.0)},
+                {'image_size': [10, 10]})
+
+    def test_by_field(self):
+        categories = np.unique(self.dm.category)
+        for (cat, (cat_mat, idx)) in zip(categories,
+                self.dm.by_field('category', return_overall_idx=True)):
+            self.assertTrue((idx == (self.dm.category == cat)).all())
+            self.assertTrue((cat_mat.x == self.dm.x[idx]).all())
+            self.assertTrue((cat_mat.category == cat).all())
+            self.assertEquals(len(cat_mat), idx.sum())
+            self.assertEquals(cat_mat.image_size, [10, 10])
+
+    def test_grouping_cache(self):
+        grouping = self.dm.grouping('category')
+        self.assertTrue(grouping is self.dm.grouping('category'))
+        self.assertTrue((grouping.keys == np.array([1, 2, 3])).all())
+        self.assertTrue((grouping.offsets == np.array([0, 2, 5, 8])).all())
+        # Replacing the field invalidates the cached grouping
+        self.dm.category = self.dm.category + 1
+        self.assertFalse(grouping is self.dm.grouping('category'))
+        self.assertTrue((self.dm.grouping('category').keys ==
+                         np.array([2, 3, 4])).all())
+        # Changing values in place invalidates it as well
+        self.dm.category[:] = 0
+        groups = list(self.dm.by_field('category'))
+        self.assertEquals(len(groups), 1)
+        self.assertEquals(len(groups[0]), 8)
+
+    def test_groupby(self):
+        groups = self.dm.groupby(['category', 'filenumber'])
+        self.assertEquals(len(groups), 6)
+        for (key, group) in groups:
+            idx = ((self.dm.category == key[0]) &
+                   (self.dm.filenumber == key[1]))
+            self.assertTrue((group.x == self.dm.x[idx]).all())
+        means = groups.agg({'x':['mean', 'first', np.maximum, 'count']})
+        self.assertEquals(len(means), 6)
+        for i in range(len(means)):
+            idx = ((self.dm.category == means.category[i]) &
+                   (self.dm.filenumber == means.filenumber[i]))
+            self.assertEquals(means.mean_x[i], self.dm.x[idx].mean())
+            self.assertEquals(means.first_x[i], self.dm.x[idx][0])
+            self.assertEquals(means.maximum_x[i], self.dm.x[idx].max())
+            self.assertEquals(means.count_x[i], idx.sum())
+        self.assertEquals(means.image_size, [10, 10])
+
+    def test_groupby_nanmean(self):
+        self.dm.x[[0, 2]] = np.nan
+        means = self.dm.groupby('category').agg({'x':'nanmean'})
+        self.assertEquals(means.mean_x[1], 5)
+        self.assertEquals(means.mean_x[0], 2.5)
+
+    def test_groupby_masked(self):
+        # category: 2, 1, 2, 3, 1, 2, 3, 3
+        for values in [np.arange(8) * 10, np.arange(8.0) * 10]:
+            self.dm.add_field('v', np.ma.array(-values, 
+                              mask = [0, 1, 1, 1, 1, 0, 1, 1]))
+            result = self.dm.groupby(['category']).agg({'v':['min', 'max']})
+            self.assertEquals(np.ma.getmaskarray(result.min_v).tolist(),
+                              [True, False, True])
+            self.assertEquals(np.ma.getmaskarray(result.max_v).tolist(),
+                              [True, False, True])
+            self.assertEquals(result.min_v[1], -50)
+            self.assertEquals(result.max_v[1], 0)
+            self.dm.rm_field('v')
+
+    def test_lazy_filter(self):
+        for idx in [self.dm.category == 2, np.array([4, 1, 7]),
+                    slice(2, 6), np.arange(3, 6), np.array([-1, 0]),
+                    self.dm.category == 5, slice(None, None, -1),
+                    slice(6, 1, -2), slice(1, None, 3), slice(-1, -2, -1)]:
+            eager = self.dm.filter(idx)
+            lazy = self.dm.filter(idx, lazy=True)
+            self.assertEquals(len(lazy), len(eager))
+            self.assertEquals(lazy.image_size, [10, 10])
+            for field in self.dm.fieldnames():
+                self.assertTrue(field in lazy._lazy)
+                self.assertTrue((lazy.field(field) ==
+                                 eager.field(field)).all())
+                self.assertFalse(field in lazy._lazy)
+        # Contiguous blocks are stored as slices
+        lazy = self.dm.filter(np.arange(3, 6), lazy=True)
+        self.assertTrue(isinstance(lazy._lazy['x'][1], slice))
+        # Materialized fields are copies
+        lazy.x[:] = -1
+        self.assertTrue((self.dm.x == np.arange(8.0)).all())
+        # Fields that are not materialized yet see in-place changes
+        lazy = self.dm.filter(np.arange(3, 6), lazy=True)
+        copied = self.dm.filter(np.arange(3, 6), lazy=True).materialize()
+        self.dm.filenumber[:] = 0
+        self.assertTrue((lazy.filenumber == 0).all())
+        self.assertTrue((copied.filenumber == np.array([1, 2, 1])).all())
+
+    def test_lazy_filter_composition(self):
+        lazy = self.dm.filter(slice(1, 8, 2), lazy=True)
+        lazy = lazy.filter(lazy.filenumber == 1, lazy=True)
+        self.assertTrue((lazy.x == np.array([1, 3, 5])).all())
+        self.assertTrue(lazy._lazy['category'][0] is self.dm.category)
+        lazy.materialize()
+        self.assertEquals(lazy._lazy, {})
+        self.assertTrue((lazy.category == np.array([1, 3, 2])).all())
+        # Replacing a field of a lazy datamat is respected by its children
+        lazy = self.dm.filter(self.dm.category > 1, lazy=True)
+        lazy.x = lazy.filenumber * 10
+        self.assertTrue((lazy.filter([0, 1]).x == np.array([10, 20])).all())
+        self.assertTrue((lazy.filter([0, 1], lazy=True).x ==
+                         np.array([10, 20])).all())
+        lazy.rm_field('category')
+        self.assertFalse(hasattr(lazy, 'category'))
+        # Reversed and stepped slices of slices
+        for (outer, inner) in [(slice(1, 8, 2), slice(None, None, -1)),
+                               (slice(None, None, -1), slice(1, None, 2)),
+                               (slice(None, None, -2), slice(None, None, -1)),
+                               (slice(0, 8, 3), slice(1, 3))]:
+            expected = self.dm.x[outer][inner]
+            eager = self.dm.filter(outer).filter(inner)
+            lazy = self.dm.filter(outer, lazy=True).filter(inner, lazy=True)
+            self.assertTrue((eager.x == expected).all())
+            self.assertTrue((lazy.x == expected).all())
+            self.assertEquals(len(lazy), len(expected))
+
+    def test_save_load_append(self):
+        import tempfile
+        samples = np.empty(8, dtype=object)
+        samples[:] = [np.arange(i) for i in range(8)]
+        self.dm.add_field('samples', samples)
+        self.dm.add_field('name', np.array([u'a', u'b\xe4'] * 4))
+        self.dm.add_field('valid', np.ma.array(np.arange(8),
+                                               mask = [0, 1] * 4))
+        (handle, path) = tempfile.mkstemp(suffix = '.hdf5')
+        os.close(handle)
+        try:
+            for compression in [None, 'gzip']:
+                self.dm.save(path, compression = compression)
+                loaded = datamat.load(path)
+                self.assertEquals(list(loaded.image_size), [10, 10])
+                self.check_fields(loaded, self.dm)
+                datamat.append(path, self.dm)
+                loaded = datamat.load(path)
+                self.assertEquals(len(loaded), 16)
+                self.check_fields(loaded[8:], self.dm)
+            # Chunks do not depend on the length of the first save
+            self.dm.filter(np.arange(8) < 2).save(path, chunk_size = 100)
+            datamat.append(path, self.dm)
+            import h5py
+            f = h5py.File(path, 'r')
+            try:
+                self.assertEquals(f['Datamat/x'].chunks, (100,))
+                masks = f['Datamat'][datamat._MASK_GROUP]
+                self.assertEquals(masks['valid'].chunks, (100,))
+            finally:
+                f.close()
+            # Appending requires the same fields
+            self.dm.rm_field('x')
+            self.assertRaises(ValueError, datamat.append, path, self.dm)
+        finally:
+            os.remove(path)
+
+    def test_load_where(self):
+        import tempfile
+        (handle, path) = tempfile.mkstemp(suffix = '.hdf5')
+        os.close(handle)
+        try:
+            self.dm.save(path, chunk_size = 3)
+            loaded = datamat.load(path, fields = ['x'], 
+                                  where = {'category': [1, 3]})
+            self.assertEquals(loaded.fieldnames(), ['x'])
+            self.assertTrue((loaded.x == np.array([1, 3, 4, 6, 7])).all())
+            loaded = datamat.load(path, where = {'category': 3, 
+                                                 'filenumber': [1, 5]})
+            self.assertTrue((loaded.x == np.array([3, 6])).all())
+            self.assertEquals(len(datamat.load(path, 
+                                               where = {'category': 4})), 0)
+            # Chunks whose statistics exclude all values are skipped
+            import h5py
+            f = h5py.File(path, 'r')
+            try:
+                rows = datamat._select_rows(f['Datamat'], {'category': 1})
+            finally:
+                f.close()
+            self.assertEquals([row[:2] for row in rows], [(0, 6)])
+            # Appending keeps the statistics up to date
+            datamat.append(path, self.dm.filter(slice(0, 2)))
+            datamat.append(path, self.dm.filter(self.dm.category == 3))
+            loaded = datamat.load(path, where = {'category': 3})
+            self.assertTrue((loaded.x == np.array([3, 6, 7] * 2)).all())
+            self.assertRaises(ValueError, datamat.load, path, 
+                              fields = ['y'])
+        finally:
+            os.remove(path)
+
+    def test_out_of_core(self):
+        import shutil, tempfile
+        self.dm.add_field('valid', np.ma.array(np.arange(8),
+                                               mask = [0, 1, 1] * 2 + [0, 0]))
+        directory = tempfile.mkdtemp()
+        chunk_size = datamat.CHUNK_SIZE
+        try:
+            self.dm.save_npy(directory, chunk_size = 3)
+            mapped = datamat.load_npy(directory)
+            self.assertTrue(mapped.out_of_core())
+            self.assertFalse(self.dm.out_of_core())
+            self.assertEquals(mapped.fieldnames(), self.dm.fieldnames())
+            self.assertEquals(mapped.image_size, [10, 10])
+            self.assertTrue((mapped.valid.mask == self.dm.valid.mask).all())
+            # Filtering is lazy and does not touch other fields
+            sub = mapped[mapped.category == 2]
+            self.assertTrue('x' in sub._lazy)
+            self.assertTrue((sub.x == np.array([0, 2, 5])).all())
+            datamat.CHUNK_SIZE = 3
+            self.assertEquals(len(list(mapped.iter_chunks())), 3)
+            for ((group, idx), (expected, expected_idx)) in zip(
+                    mapped.by_field('category', return_overall_idx=True),
+                    self.dm.by_field('category', return_overall_idx=True)):
+                self.assertTrue((idx == expected_idx).all())
+                self.assertTrue((group.x == expected.x).all())
+                self.assertTrue((group.valid.mask == 
+                                 expected.valid.mask).all())
+            # Contiguous HDF5 datasets can be mapped as well
+            path = os.path.join(directory, 'dm.hdf5')
+            self.dm.save(path, chunk_size = None)
+            mapped = datamat.load(path, mmap = True)
+            self.assertTrue(mapped.out_of_core())
+            self.assertTrue((mapped.x == self.dm.x).all())
+            self.assertRaises(RuntimeError, datamat.append, path, self.dm)
+        finally:
+            datamat.CHUNK_SIZE = chunk_size
+            shutil.rmtree(directory)
+
+    def test_accumulator_factory(self):
+        acc = datamat.AccumulatorFactory()
+        acc.update({'a':1, 'b':np.float32(2), 's':'x'})
+        acc.update({'a':2, 's':'xyz', 'c':[1, 2]})
+        for i in range(20):
+            acc.update({'a':i + 0.5, 'b':np.float32(i), 's':'z'})
+        dm = acc.get_dm({'p':3})
+        self.assertEquals(len(dm), 22)
+        self.assertEquals(dm.p, 3)
+        self.assertEquals(dm.a.dtype, np.float64)
+        self.assertTrue((dm.a[:3] == np.array([1, 2, 0.5])).all())
+        self.assertEquals(dm.b.dtype, np.float32)
+        self.assertTrue((dm.b.mask == ([False, True] + [False] * 20)).all())
+        self.assertTrue(np.isnan(dm.b.data[1]))
+        self.assertTrue((dm.s[:3] == np.array(['x', 'xyz', 'z'])).all())
+        self.assertEquals(dm.c.shape, (22, 2))
+        self.assertEquals(dm.c.mask[:, 0].sum(), 21)
+        self.assertTrue((dm.c[1] == np.array([1, 2])).all())
+
+    def test_datamat_accumulator(self):
+        other = datamat.VectorFactory({
+                'category':np.array([4, 4]), 
+                'x':np.ma.array([1.5, 2.5], mask = [False, True])}, 
+                {'image_size':[5, 5]})
+        acc = datamat.DatamatAccumulator()
+        for dm in [self.dm, other, self.dm]:
+            acc.update(dm)
+        joined = acc.get_dm()
+        self.dm.x[:] = -1
+        self.assertEquals(len(joined), 18)
+        self.assertEquals(sorted(joined.fieldnames()), ['category', 'x'])
+        self.assertEquals(joined.image_size, [10, 10])
+        self.assertEquals(joined.category.dtype, self.dm.category.dtype)
+        self.assertTrue((joined.category[8:10] == 4).all())
+        self.assertTrue((joined.x[:8] == np.arange(8.0)).all())
+        self.assertTrue((joined.x.mask == (np.arange(18) == 9)).all())
+
+    def check_fields(self, loaded, expected):
+        self.assertEquals(sorted(loaded.fieldnames()),
+                          sorted(expected.fieldnames()))
+        for field in ['category', 'filenumber', 'x', 'name']:
+            self.assertTrue((loaded.field(field) ==
+                             expected.field(field)).all())
+        self.assertEquals(loaded.name.dtype.kind, 'U')
+        self.assertTrue((loaded.valid.mask == expected.valid.mask).all())
+        for (a, b) in zip(loaded.samples, expected.samples):
+            self.assertTrue((a == b).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ from pkgutil import get_data
 from tempfile import NamedTemporaryFile
 
 import numpy as np
-from scipy.io import loadmat
+from scipy.io import loadmat, savemat
 
 from ocupy import fixmat, stimuli, loader
 
@@ -188,6 +188,48 @@ class TestFixmat(unittest.TestCase):
             self.compare_fixmats(fm, fm2)   
             self.assertRaises(ValueError, lambda: fixmat.DirectoryFixmatFactory('.', glob_str = 'xxx*.mat' ))
          
+    def test_directory_factory(self):
+        import shutil, tempfile, warnings
+        directory = tempfile.mkdtemp()
+        cache_dir = os.path.join(directory, 'cache')
+        try:
+            demo = get_data('ocupy.tests', 'fixmat_demo.mat')
+            for name in ['a.mat', 'b.mat', 'c.mat']:
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(demo)
+            fm = fixmat.FixmatFactory(os.path.join(directory, 'a.mat'))
+            for (multiproc, cache) in [(False, None), (True, None), 
+                                       (False, cache_dir), (False, cache_dir)]:
+                fm_all = fixmat.DirectoryFixmatFactory(directory, 
+                            multiproc = multiproc, n_jobs = 2, 
+                            cache_dir = cache)
+                self.assertEquals(len(fm_all), 3 * len(fm))
+                self.assertEquals(fm_all.parameters(), fm.parameters())
+                for field in fm.fieldnames():
+                    self.assertEquals(fm_all.field(field).dtype, 
+                                      fm.field(field).dtype)
+                    self.assertTrue((fm_all.field(field)[len(fm):2*len(fm)] 
+                                     == fm.field(field)).all())
+            # Unchanged files are read from the cache
+            self.assertEquals(len(os.listdir(cache_dir)), 4)
+            parse = fixmat._read_fixmat_file
+            fixmat._read_fixmat_file = None
+            try:
+                fixmat.DirectoryFixmatFactory(directory, cache_dir = cache_dir)
+            finally:
+                fixmat._read_fixmat_file = parse
+            # Fields that are missing in one file are removed
+            with open(os.path.join(directory, 'd.mat'), 'wb') as f:
+                savemat(f, {'fixmat':{'x':fm.x, 'image_size':[1, 2]}})
+            with warnings.catch_warnings(record = True) as w:
+                warnings.simplefilter('always')
+                fm_all = fixmat.DirectoryFixmatFactory(directory,
+                                                       cache_dir = cache_dir)
+            self.assertEquals(fm_all.fieldnames(), ['x'])
+            self.assertEquals(len(w), len(fm.fieldnames()) - 1)
+        finally:
+            shutil.rmtree(directory)
+
     def test_cmp2fixmat(self):
         # This test only works with some scipy versions. 
         with NamedTemporaryFile(mode = 'w', prefix = 'fix_occ_test',
@@ -6,7 +6,7 @@ import unittest
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
 
-from ocupy import fixmat
+from ocupy import fixmat, datamat
 
 
 class TestComputeFDM(unittest.TestCase):
@@ -107,6 +107,99 @@ class TestComputeFDM(unittest.TestCase):
 
     def tearDown(self):
         self.fm = None
+
+
+class TestFDMEngine(unittest.TestCase):
+    def test_reference_implementation(self):
+        """
+        Compares compute_fdm to a direct histogramdd / gaussian_filter
+        implementation, including fixations on and beyond the image border.
+        """
+        y = np.array([0, 10.5, 47.2, 59.999, 60, 60.2, -1, 33, np.nan])
+        x = np.array([0, 70, 12.9, 79.5, 80, 3, 5, -0.1, 4])
+        for (ppd, sf) in [(3, 1), (3, 0.5), (3, 0.37), (20, 1), (20, 0.6)]:
+            fm = datamat.VectorFactory({'x':x, 'y':y},
+                    {'image_size':[60, 80], 'pixels_per_degree':ppd})
+            e_y = np.arange(0, np.round(sf * 60 + 1))
+            e_x = np.arange(0, np.round(sf * 80 + 1))
+            valid = ~np.isnan(y)
+            samples = np.array(zip(sf * y[valid], sf * x[valid]))
+            (hist, _) = np.histogramdd(samples, (e_y, e_x))
+            sigma = 2 * ppd * sf / (2 * (2 * np.log(2)) ** .5)
+            fdm_man = gaussian_filter(hist, sigma, mode='constant')
+            fdm_man = fdm_man / fdm_man.sum()
+            fdm = fixmat.compute_fdm(fm, scale_factor=sf, use_cache=False)
+            self.assertEquals(fdm.shape, fdm_man.shape)
+            self.assertTrue(np.allclose(fdm, fdm_man, rtol=0,
+                                        atol=1e-12 * fdm_man.max()))
+
+    def test_cache(self):
+        fm = datamat.VectorFactory({'x':np.array([10., 20.]),
+                                    'y':np.array([5., 7.])},
+                {'image_size':[30, 40], 'pixels_per_degree':2})
+        fixmat.fdm_cache.clear()
+        fdm = fixmat.compute_fdm(fm)
+        fdm[:] = 0
+        fdm = fixmat.compute_fdm(fm)
+        self.assertEquals(fixmat.fdm_cache.hits, 1)
+        self.assertAlmostEquals(fdm.sum(), 1)
+        fixmat.compute_fdm(fm, fwhm=1)
+        fixmat.compute_fdm(fm.filter([0]))
+        self.assertEquals(fixmat.fdm_cache.hits, 1)
+        self.assertEquals(len(fixmat.fdm_cache), 3)
+
+    def test_out_of_core(self):
+        import tempfile
+        x = np.random.rand(1000) * 40
+        y = np.random.rand(1000) * 30
+        params = {'image_size':[30, 40], 'pixels_per_degree':2}
+        fm = datamat.VectorFactory({'x':x, 'y':y}, params)
+        mapped = np.memmap(tempfile.TemporaryFile(), dtype = float,
+                           shape = (2, 1000))
+        mapped[:] = [x, y]
+        chunk_size = datamat.CHUNK_SIZE
+        datamat.CHUNK_SIZE = 64
+        try:
+            fm_mapped = datamat.VectorFactory({'x':mapped[0], 'y':mapped[1]},
+                                              params)
+            self.assertTrue(fm_mapped.out_of_core())
+            self.assertEquals(fixmat._fdm_key(fm, 2, 1), 
+                              fixmat._fdm_key(fm_mapped, 2, 1))
+            self.assertTrue(np.allclose(
+                fixmat.compute_fdm(fm, use_cache=False),
+                fixmat.compute_fdm(fm_mapped, use_cache=False)))
+        finally:
+            datamat.CHUNK_SIZE = chunk_size
+
+    def test_fdm_stack(self):
+        fm = datamat.VectorFactory({
+                'x':np.array([1., 5, 20, 39.9, 40, 12, 33, 7]),
+                'y':np.array([0., 4, 29, 11, 30, 8, 2, 17]),
+                'category':np.array([1, 1, 2, 1, 2, 2, 1, 1]),
+                'filenumber':np.array([3, 1, 1, 3, 1, 1, 3, 1])},
+                {'image_size':[30, 40], 'pixels_per_degree':2})
+        for sf in [1, 0.5]:
+            (fdms, keys) = fixmat.compute_fdm_stack(fm, scale_factor=sf)
+            self.assertEquals(fdms.dtype, np.float32)
+            self.assertEquals(keys, [(1, 1), (1, 3), (2, 1)])
+            for (fdm, (cat, img)) in zip(fdms, keys):
+                ref = fixmat.compute_fdm(
+                        fm[(fm.category == cat) & (fm.filenumber == img)],
+                        scale_factor=sf, use_cache=False)
+                self.assertTrue(np.allclose(fdm, ref, rtol=1e-5, atol=0))
+        (fdms, keys) = fixmat.compute_fdm_stack(fm, by=['filenumber'])
+        self.assertEquals(fdms.shape, (2, 30, 40))
+        self.assertTrue((keys == np.array([1, 3])).all())
+        # Maps are histogrammed and smoothed in chunks
+        chunk_size = fixmat.STACK_CHUNK_SIZE
+        fixmat.STACK_CHUNK_SIZE = 2 * 30 * 40
+        try:
+            (chunked, _) = fixmat.compute_fdm_stack(fm)
+        finally:
+            fixmat.STACK_CHUNK_SIZE = chunk_size
+        self.assertTrue(np.allclose(chunked, 
+                                    fixmat.compute_fdm_stack(fm)[0]))
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import numpy as np
 from ocupy import measures
-from ocupy import fixmat
+from ocupy import fixmat, datamat
 import scipy
 
 class TestMeasures(unittest.TestCase):
@@ -29,6 +29,99 @@ class TestMeasures(unittest.TestCase):
         scores  =  measures.prediction_scores(fdm, fm) 
         self.assertEquals(len(scores), 3)
 
+    def test_batch_prediction_scores(self):
+        fm = datamat.VectorFactory({'x':np.random.rand(100) * 500 + 1,
+                                    'y':np.random.rand(100) * 100 + 1},
+                {'pixels_per_degree':10, 'image_size':[100,500]})
+        predictions = np.random.random((5, 20, 100))
+        measures.set_scores([measures.roc_model, 
+                             measures.kldiv_model, 
+                             measures.nss_model,
+                             measures.correlation_model,
+                             measures.funky_test_measure])
+        ctr_loc = (np.random.randint(0, 100, 300),
+                   np.random.randint(0, 500, 300))
+        scores = measures.batch_prediction_scores(predictions, fm,
+                ctr_loc = ctr_loc, arg1 = 1., arg2 = 2.)
+        self.assertEquals(scores.shape, (5, 5))
+        for (prediction, batch) in zip(predictions, scores):
+            single = measures.prediction_scores(prediction, fm,
+                ctr_loc = ctr_loc, arg1 = 1., arg2 = 2.)
+            for (s, b) in zip(single, batch):
+                self.assertAlmostEqual(s, b)
+        # Intermediates can be passed in for batches as well
+        intermediates = {'ctr_idx' : (ctr_loc[0] // 5, ctr_loc[1] // 5),
+                         'fix_idx' : (np.random.randint(0, 20, 50),
+                                      np.random.randint(0, 100, 50)),
+                         'fdm' : np.random.random((20, 100))}
+        scores = measures.batch_prediction_scores(predictions, fm,
+                arg1 = 1., arg2 = 2., **intermediates)
+        for (prediction, batch) in zip(predictions, scores):
+            single = measures.prediction_scores(prediction, fm,
+                arg1 = 1., arg2 = 2., **intermediates)
+            for (s, b) in zip(single, batch):
+                self.assertAlmostEqual(s, b)
+
+    def test_seeded_controls(self):
+        fm = datamat.VectorFactory({'x':np.random.rand(100) * 500 + 1,
+                                    'y':np.random.rand(100) * 100 + 1},
+                {'pixels_per_degree':10, 'image_size':[100,500]})
+        prediction = np.random.random((20, 100))
+        measures.set_scores([measures.roc_model])
+        first = measures.prediction_scores(prediction, fm,
+                                           rng = np.random.RandomState(5))
+        second = measures.prediction_scores(prediction, fm,
+                                            rng = np.random.RandomState(5))
+        self.assertEquals(first, second)
+        self.assertEquals(first[0], measures.roc_model(prediction, fm,
+                                            rng = np.random.RandomState(5)))
+        batch = measures.batch_prediction_scores(prediction, fm,
+                                            rng = np.random.RandomState(5))
+        self.assertAlmostEqual(first[0], batch[0, 0])
+
+    def test_ctr_idx(self):
+        fm = datamat.VectorFactory({'x':np.random.rand(100) * 500 + 1,
+                                    'y':np.random.rand(100) * 100 + 1},
+                {'pixels_per_degree':10, 'image_size':[100,500]})
+        prediction = np.random.random((100, 500))
+        ctr_idx = (np.random.randint(0, 100, 300),
+                   np.random.randint(0, 500, 300))
+        measures.set_scores([measures.roc_model])
+        self.assertAlmostEqual(
+            measures.prediction_scores(prediction, fm, ctr_idx = ctr_idx)[0],
+            measures.roc_model(prediction, fm, ctr_loc = ctr_idx))
+        # Arguments that no measure takes are ignored, e.g. the control
+        # fixations bounds.intersubject_scores passes as controls
+        controls = (np.random.rand(300) * 100, np.random.rand(300) * 500)
+        scores = measures.prediction_scores(prediction, fm,
+                                            controls = controls)
+        self.assertTrue(0 <= scores[0] <= 1)
+
+    def test_register_measure(self):
+        fm = datamat.VectorFactory({'x':np.random.rand(100) * 500 + 1,
+                                    'y':np.random.rand(100) * 100 + 1},
+                {'pixels_per_degree':10, 'image_size':[100,500]})
+        calls = []
+        def fdm_max(context, prediction):
+            calls.append(prediction.shape)
+            return context.get('fdm', prediction).max()
+        def measure1(prediction, fm, fdm_max=None):
+            return fdm_max
+        def measure2(prediction, fm, fdm_max=None, fdm=None):
+            return fdm.max()
+        measures.register_intermediate('fdm_max', fdm_max)
+        measures.register_measure(measure1, ['fdm_max'])
+        measures.register_measure(measure2, ['fdm_max', 'fdm'])
+        self.assertRaises(ValueError, measures.register_measure, measure1,
+                          ['unknown'])
+        measures.set_scores([measure1, measure2, measures.kldiv_model])
+        prediction = np.random.random((20, 100))
+        scores = measures.prediction_scores(prediction, fm)
+        self.assertEquals(calls, [(20, 100)])
+        self.assertEquals(scores[0], scores[1])
+        self.assertAlmostEqual(scores[2],
+                               measures.kldiv_model(prediction, fm))
+
     def test_kldiv(self):
         arr = scipy.random.random((21,13))
         fm = fixmat.TestFixmatFactory(categories = [1,2,3], 
@@ -87,12 +180,6 @@ class TestMeasures(unittest.TestCase):
         self.assertTrue(nss < 0)
     
     def test_emd(self):
-       try: 
-           import opencv
-       except ImportError:
-           print "Skipping EMD test - no opencv available"
-           return 
-       opencv # pyflakes
        fm = fixmat.TestFixmatFactory(categories = [1,2,3], 
            filenumbers = [1,2,3,4,5,6],
            subjectindices = [1, 2, 3, 4, 5, 6],
@@ -102,7 +189,38 @@ class TestMeasures(unittest.TestCase):
        e = measures.emd_model(arr, fm)
        self.assertTrue(e > 0)
        e = measures.emd(fdm, fdm)
-       self.assertEquals(e, 0) 
+       self.assertAlmostEqual(e, 0)
+
+    def test_emd_point_masses(self):
+       p = np.zeros((16, 16))
+       q = np.zeros((16, 16))
+       p[2, 3] = 1
+       q[2, 9] = 1
+       self.assertAlmostEqual(measures.emd(p, q), 6)
+       self.assertAlmostEqual(measures.emd(p, q, mode = 'sinkhorn'), 6)
+       # Only the smaller weight is moved
+       q[5, 3] = 1
+       self.assertAlmostEqual(measures.emd(p, q), 3)
+       # Signatures sum blocks of pixels
+       (pos, weights) = measures.emd_signature(np.ones((10, 7)), 4)
+       self.assertEquals(weights.sum(), 70)
+       self.assertEquals(len(weights), 16)
+       self.assertEquals(tuple(pos[0]), (0.5, 0))
+       # Sinkhorn approximates exact EMDs from above, also for sparse and
+       # almost identical maps
+       rng = np.random.RandomState(0)
+       p = np.zeros((60, 60))
+       p[rng.randint(0, 60, 4), rng.randint(0, 60, 4)] = 1
+       q = p.copy()
+       q[rng.randint(0, 60, 2), rng.randint(0, 60, 2)] = 0.05
+       r = rng.random_sample((60, 60)) ** 8
+       for (a, b) in [(p, q), (p, r), (r, q)]:
+           (a, b) = (a / a.sum(), b / b.sum())
+           for signature_size in [6, 16]:
+               exact = measures.emd(a, b, signature_size = signature_size)
+               approx = measures.emd(a, b, signature_size = signature_size,
+                                     mode = 'sinkhorn')
+               self.assertTrue(exact - 1e-6 <= approx <= 1.02 * exact)
 
         
     def test_fast_roc(self):
@@ -147,6 +265,32 @@ class TestMeasures(unittest.TestCase):
         controls = np.random.standard_normal(1000)
         self.assertAlmostEqual(measures.exact_roc(actuals, controls)[0] + measures.exact_roc(controls, actuals)[0],1)
 
+    def test_rank_roc(self):
+        # ties count half
+        self.assertEquals(measures.rank_roc([1, 2, 2], [2, 0])[0], 
+                          (1 + 1.5 + 1.5) / 6.0)
+        # faster_roc works for few actuals
+        self.assertEquals(measures.faster_roc(np.array([1.]), 
+                                              np.array([0.]))[0], 1)
+        # batches of roc analyses
+        actuals = np.round(np.random.standard_normal((4, 200)) + 1, 1)
+        controls = np.round(np.random.standard_normal((4, 100)), 1)
+        (auc, tpr, fpr) = measures.rank_roc(actuals, controls)
+        for k in range(4):
+            (auc_k, tpr_k, fpr_k) = measures.exact_roc(actuals[k], controls[k])
+            self.assertAlmostEqual(auc[k], auc_k)
+            self.assertTrue((tpr[k] == tpr_k).all())
+            self.assertTrue((fpr[k] == fpr_k).all())
+        auc = measures.rank_roc(actuals, controls[0])[0]
+        for k in range(4):
+            self.assertAlmostEqual(auc[k],
+                    measures.exact_roc(actuals[k], controls[0])[0])
+        # only the aucs
+        self.assertTrue((measures.rank_roc(actuals, controls[0], 
+                                           curves=False) == auc).all())
+        self.assertEquals(measures.rank_roc(actuals[0], controls[0], 
+                                            curves=False), auc[0])
+
     def skip_intersubject_auc(self):
         points = zip(range(1,16),range(1,16))
         fm = fixmat.TestFactory(points = points, 
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import unittest
+import warnings
+import numpy as np
+
+from ocupy import datamat, simulator
+
+
+def trajectories(num_trajectories = 200, seed = 0):
+    """
+    Random walks with 3 to 14 fixations each.
+    """
+    rand = np.random.RandomState(seed)
+    (x, y, fix) = ([], [], [])
+    for _ in range(num_trajectories):
+        num_fix = rand.randint(3, 15)
+        x.extend(np.cumsum(rand.randn(num_fix) * 6) + 64)
+        y.extend(np.cumsum(rand.randn(num_fix) * 4) + 48)
+        fix.extend(range(1, num_fix + 1))
+    return datamat.VectorFactory({'x':np.array(x), 'y':np.array(y), 
+                                  'fix':np.array(fix)},
+                                 {'pixels_per_degree':10, 
+                                  'image_size':[96, 128]})
+
+
+class TestFixGen(unittest.TestCase):
+    def setUp(self):
+        self.gen = simulator.FixGen(trajectories(), seed = 0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.gen.initializeData(max_length = 20)
+
+    def test_sample_many(self):
+        fm = self.gen.sample_many(500)
+        starts = np.nonzero(fm.fix == 1)[0]
+        self.assertEquals(len(starts), 500)
+        self.assertTrue((fm.x[starts] == 0).all() and 
+                        (fm.y[starts] == 0).all())
+        sizes = np.diff(np.append(starts, len(fm.fix)))
+        self.assertTrue((sizes >= 3).all() and (sizes <= 14).all())
+        self.assertTrue((fm.fix == np.concatenate(
+                            [np.arange(1, s + 1) for s in sizes])).all())
+        # Saccade lengths are bin centers of the length histograms
+        lengths = np.hypot(np.diff(fm.x), np.diff(fm.y))[fm.fix[1:] > 1]
+        self.assertTrue(np.allclose(lengths % 1, 0.5))
+
+    def test_sample(self):
+        coordinates = self.gen.sample()
+        self.assertEquals(coordinates[0], [0, 0])
+        self.assertTrue(3 <= len(coordinates) <= 14)
+
+    def test_seed(self):
+        first = simulator.FixGen(self.gen.fm, seed = 3)
+        second = simulator.FixGen(self.gen.fm, seed = 3)
+        for gen in [first, second]:
+            (gen.full_H1, gen.probability_cumsum) = (self.gen.full_H1, 
+                                                     self.gen.probability_cumsum)
+            (gen.firstLenAng_cumsum, gen.firstLenAng_shape) = (
+                self.gen.firstLenAng_cumsum, self.gen.firstLenAng_shape)
+            (gen.trajLen_cumsum, gen.trajLen_borders) = (
+                self.gen.trajLen_cumsum, self.gen.trajLen_borders)
+            gen.pixels_per_degree = self.gen.pixels_per_degree
+            gen._prepare_sampling()
+        self.assertTrue((first.sample_many(50).x == 
+                         second.sample_many(50).x).all())
+
+    def test_generate_multiproc(self):
+        results = []
+        for n_jobs in [1, 2]:
+            self.gen.rng = simulator.random_state(4)
+            results.append(self.gen.generate(200, multiproc = True, 
+                                             n_jobs = n_jobs))
+        (single, parallel) = results
+        # Trajectory lengths are drawn before the work is split
+        self.assertTrue((single.fix == parallel.fix).all())
+        starts = np.nonzero(parallel.fix == 1)[0]
+        self.assertTrue((parallel.sample[starts] == np.arange(200)).all())
+        self.assertTrue((parallel.x[starts] == 0).all())
+        self.assertEquals(list(np.unique(parallel.SUBJECTINDEX)), [0, 1])
+        self.assertTrue((parallel.SUBJECTINDEX[starts][:100] == 0).all())
+        self.assertFalse((single.x == parallel.x).all())
+
+    def test_save_load(self):
+        import os, tempfile
+        (handle, path) = tempfile.mkstemp(suffix = '.hdf5')
+        os.close(handle)
+        try:
+            self.gen.nosamples = []
+            self.gen.save(path)
+            loaded = simulator.load(path, seed = 5)
+            self.assertTrue(isinstance(loaded._dist_table.prob, np.memmap))
+            self.assertEquals(len(loaded.full_H1), len(self.gen.full_H1))
+            self.gen.rng = simulator.random_state(5)
+            (expected, result) = (self.gen.sample_many(100), 
+                                  loaded.sample_many(100))
+            for field in ['x', 'y', 'fix', 'sample']:
+                self.assertTrue((expected.field(field) == 
+                                 result.field(field)).all())
+            self.assertEquals(result.pixels_per_degree, 1)
+        finally:
+            os.remove(path)
+
+    def test_chunks(self):
+        import os, tempfile
+        from ocupy import fixmat
+        self.gen.rng = simulator.random_state(6)
+        chunks = list(self.gen.sample_chunks(25, chunk_size = 10))
+        self.assertEquals([len(np.unique(c.sample)) for c in chunks], 
+                          [10, 10, 5])
+        (handle, path) = tempfile.mkstemp(suffix = '.hdf5')
+        os.close(handle)
+        try:
+            self.gen.rng = simulator.random_state(6)
+            num_fix = self.gen.save_samples(path, 25, chunk_size = 10)
+            fm = fixmat.load(path)
+            self.assertEquals(num_fix, len(fm))
+            for field in ['sample', 'x']:
+                self.assertTrue((fm.field(field) == np.concatenate(
+                    [c.field(field) for c in chunks])).all())
+        finally:
+            os.remove(path)
+
+
+class TestAnglendiff(unittest.TestCase):
+    def test_chunks(self):
+        fm = trajectories(20)
+        for roll in [1, 2, 3]:
+            expected = simulator.anglendiff(fm, roll, return_abs = True)
+            for chunk_size in [1, 7, 50]:
+                chunked = simulator.anglendiff(fm, roll, return_abs = True,
+                                               chunk_size = chunk_size)
+                for (values, expected_values) in zip(chunked, expected):
+                    for (a, b) in zip(values, expected_values):
+                        np.testing.assert_array_equal(a, b)
+
+
+class TestAliasTable(unittest.TestCase):
+    def test_draw(self):
+        weights = [np.array([0, 1, 2, 3, 0, 4.0]), np.array([]), 
+                   np.array([5.0]), np.array([1, 1, 0, 2.0])]
+        table = simulator.AliasTable(weights)
+        rng = simulator.random_state(0)
+        for dist in [0, 2, 3]:
+            draws = table.draw(rng, np.ones(100000, dtype=int) * dist)
+            counts = np.bincount(draws, minlength = len(weights[dist]))
+            expected = weights[dist] / weights[dist].sum()
+            self.assertTrue((counts[expected == 0] == 0).all())
+            self.assertTrue(np.allclose(counts / 100000.0, expected, 
+                                        atol = 0.01))
+        (prob, alias) = simulator.alias_table(weights[0])
+        # The table reproduces the distribution exactly
+        mass = prob / len(prob)
+        mass = mass + np.bincount(alias, (1 - prob) / len(prob), 
+                                  minlength = len(prob))
+        self.assertTrue(np.allclose(mass, weights[0] / weights[0].sum()))
+
+
+if __name__ == '__main__':
+    unittest.main()
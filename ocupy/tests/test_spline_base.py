@@ -7,6 +7,20 @@ from ocupy import measures, spline_base as sb
 from scipy.stats.kde import gaussian_kde
 from scikits.learn import linear_model
 
+class TestSpcol(unittest.TestCase):
+
+    def test_spcol(self):
+        x = np.concatenate((np.arange(1, 31), [-1, 3.5, 7, 40])).astype(float)
+        for order in [0, 1, 3, 5]:
+            for knots in [sb.augknt(np.linspace(0, 31, 8), order),
+                          sb.augknt([0, 3, 3, 7, 20, 30], order)]:
+                colmat = sb.spcol(x, knots, order)
+                self.assertEquals(colmat.shape,
+                                  (len(x), len(knots) - order - 1))
+                for i in range(colmat.shape[1]):
+                    self.assertTrue((colmat[:, i] == 
+                                     sb.spline(x, knots, order, i)).all())
+
 class Test1DSplines(unittest.TestCase):
 
     def skip_cosine_fit(self):
@@ -32,6 +46,51 @@ class Test2DSplines(unittest.TestCase):
             y = model.predict(splines.T)
             self.assertTrue( np.corrcoef(X+noise, y.reshape(X.shape))[0,1]**2 > 0.7)
 
+    def test_kron_bayesian_ridge(self):
+        np.random.seed(1)
+        (width, height) = (30, 20)
+        setx, sety, _ = sb.spline_factors2d(width, height, 6, 5, 3)
+        basis, _ = sb.spline_base2d(width, height, 6, 5, 3)
+        target = np.random.random((height, width))
+        target[target < 0.3] = 0
+        for mask in [None, target > 0]:
+            coef, intercept = sb.kron_bayesian_ridge(sety, setx, target, 
+                                                     mask)
+            prediction = np.dot(np.dot(sety, coef), setx.T) + intercept
+            model = linear_model.BayesianRidge()
+            if mask is None:
+                model.fit(basis.T, target.flatten())
+            else:
+                model.fit(basis[:, mask.flatten()].T, target[mask])
+            expected = model.predict(basis.T).reshape((height, width))
+            self.assertTrue(np.allclose(prediction, expected))
+
+class TestSplineModel(unittest.TestCase):
+
+    def test_evaluate(self):
+        np.random.seed(2)
+        samples = np.column_stack((np.random.randn(1000) * 8 + 25, 
+                                   np.random.randn(1000) * 5 + 15))
+        (fit, _, _, model) = sb.fit2d(samples, np.arange(51), np.arange(31),
+                nr_knots_x = 8, nr_knots_y = 6, spline_order = 3, 
+                return_model = True)
+        self.assertTrue(np.allclose(
+            model.evaluate([np.arange(30), np.arange(50)]), fit))
+        (y, x) = (np.random.randint(0, 30, 20), np.random.randint(0, 50, 20))
+        self.assertTrue(np.allclose(
+            model.evaluate([y, x], grid = False), fit[y, x]))
+        self.assertEquals(model.evaluate([np.linspace(-0.5, 29.5, 60), 
+                                          np.linspace(-0.5, 49.5, 100)]).shape,
+                          (60, 100))
+        samples = np.column_stack((np.random.randn(1000) * 3 + 10, 
+                                   np.random.randn(1000) * 3 + 8,
+                                   np.random.randn(1000) * 2 + 6))
+        (fit, _, model) = sb.fit3d(samples, np.arange(21), np.arange(17), 
+                np.arange(13), nr_knots_x = 5, nr_knots_y = 4, 
+                nr_knots_z = 4, return_model = True)
+        self.assertTrue(np.allclose(model.evaluate(
+            [np.arange(20), np.arange(16), np.arange(12)]), fit))
+
 class TestCompareMethods(object):
 
     def setUp(self):
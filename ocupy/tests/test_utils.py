@@ -44,6 +44,51 @@ class TestUtils(unittest.TestCase):
             else:
                 self.assertTrue(np.isnan(m[c]).all())
 
+class TestMemoize(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def basis(length, marginal = None):
+            self.calls.append(length)
+            return np.ones((length, 10)), (np.arange(length), 'knots')
+        self.basis = basis
+
+    def test_array_keys(self):
+        basis = utils.Memoize(self.basis)
+        marginal = np.arange(5.0)
+        first = basis(10, marginal = marginal)
+        self.assertTrue(first is basis(10, marginal = marginal.copy()))
+        basis(10, marginal = marginal + 1)
+        basis(10, marginal = marginal.astype(int))
+        self.assertEquals(self.calls, [10, 10, 10])
+        stats = basis.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (1, 3))
+        self.assertEquals(stats['bytes'], 3 * (10 * 10 * 8 + 10 * 8))
+
+    def test_byte_budget(self):
+        basis = utils.Memoize(max_bytes = 3 * 880)(self.basis)
+        for length in [10, 10, 11, 12, 10, 12]:
+            basis(length)
+        self.assertEquals(self.calls, [10, 11, 12, 10])
+        self.assertEquals(len(basis.memory), 2)
+        self.assertTrue(basis.stats()["bytes"] <= 3 * 880)
+
+    def test_disk_tier(self):
+        import shutil, tempfile
+        cache_dir = tempfile.mkdtemp()
+        try:
+            basis = utils.Memoize(self.basis, cache_dir = cache_dir)
+            expected = basis(10)
+            other = utils.Memoize(self.basis, cache_dir = cache_dir)
+            result = other(10)
+            self.assertEquals(self.calls, [10])
+            self.assertEquals(other.stats()['disk_hits'], 1)
+            self.assertTrue(isinstance(result[0], np.memmap))
+            self.assertTrue((result[0] == expected[0]).all())
+            self.assertTrue((result[1][0] == expected[1][0]).all())
+            self.assertEquals(result[1][1], 'knots')
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
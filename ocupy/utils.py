@@ -4,7 +4,10 @@
 from numpy import asarray, ma
 import numpy as np
 import cPickle
+import hashlib
 import os
+import tempfile
+from collections import OrderedDict
 
 have_image_library=True
 try:
@@ -317,19 +320,252 @@ def factorise_strings (string_list, boundary_char=None):
 
     return (new_list, cmn)
 
-class Memoize:
+class Memoize(object):
     """
-    Memoize with mutable arguments
+    Memoize with mutable arguments.
+
+    Arguments are identified by a digest of their content, ndarrays are
+    hashed without pickling them. Results are kept in an LRU cache that
+    holds at most max_size results and at most max_bytes bytes of arrays.
+    If cache_dir is set, results that consist of arrays (or tuples / lists
+    of arrays) are additionally stored as .npy files in cache_dir and are
+    memory-mapped when they are requested again, e.g. by another process.
+
+    The decorator can be used with and without arguments:
+
+        >>> @Memoize
+        ... def f(x): return x
+        >>> @Memoize(max_bytes = 2**20, cache_dir = None)
+        ... def g(x): return x
+
+    Hits, misses, disk hits and the number of cached bytes are available
+    via the stats() method.
     """
-    def __init__(self, function):
+    def __init__(self, function = None, max_size = None, 
+                 max_bytes = 2**30, cache_dir = None):
         self.function = function
-        self.memory = {}
+        self.cache = LRUCache(max_size, max_bytes = max_bytes)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+        if function is not None:
+            self.__name__ = function.__name__
+            self.__doc__ = function.__doc__
+            self.__module__ = function.__module__
+
+    @property
+    def memory(self):
+        return self.cache.memory
 
     def __call__(self, *args, **kwargs):
-        hash_str = cPickle.dumps(args) + cPickle.dumps(kwargs)
-        if not hash_str in self.memory:
-            self.memory[hash_str] = self.function(*args, **kwargs)
-        return self.memory[hash_str]
+        if self.function is None:
+            # Used as @Memoize(...), args[0] is the decorated function
+            self.__init__(args[0], self.cache.max_size, self.cache.max_bytes,
+                          self.cache_dir)
+            return self
+        key = self.key(args, kwargs)
+        result = self.cache.get(key, _missing)
+        if result is not _missing:
+            return result
+        result = None
+        if self.cache_dir is not None:
+            result = load_result(self.cache_dir, key)
+            if result is not None:
+                self.disk_hits += 1
+        if result is None:
+            result = self.function(*args, **kwargs)
+            if self.cache_dir is not None:
+                save_result(self.cache_dir, key, result)
+        self.cache[key] = result
+        return result
+
+    def key(self, args, kwargs):
+        """
+        Returns the hex digest that identifies a call with args and kwargs.
+        """
+        digest = hashlib.sha1()
+        digest.update('%s.%s' % (getattr(self.function, '__module__', ''),
+                                 getattr(self.function, '__name__', '')))
+        _update_digest(digest, args)
+        _update_digest(digest, sorted(kwargs.items()))
+        return digest.hexdigest()
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of hits, misses, disk hits, 
+        cached results and cached bytes.
+        """
+        return {'hits':self.cache.hits, 'misses':self.cache.misses,
+                'disk_hits':self.disk_hits, 'entries':len(self.cache), 
+                'bytes':self.cache.nbytes}
+
+    def clear(self):
+        """
+        Empties the in-memory cache, files in cache_dir are kept.
+        """
+        self.cache.clear()
+        self.disk_hits = 0
+
+_missing = object()
+
+def _update_digest(digest, obj):
+    """
+    Adds the content of obj to a hashlib digest. ndarrays are hashed by
+    dtype, shape and data, containers recursively, everything else by 
+    pickling it.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            digest.update(cPickle.dumps(obj, 2))
+            return
+        obj = np.ascontiguousarray(obj)
+        digest.update('ndarray%s%r' % (obj.dtype.str, obj.shape))
+        digest.update(obj.view(np.uint8).ravel())
+    elif isinstance(obj, (tuple, list)):
+        digest.update('%s%d' % (type(obj).__name__, len(obj)))
+        for item in obj:
+            _update_digest(digest, item)
+    elif isinstance(obj, dict):
+        _update_digest(digest, sorted(obj.items()))
+    else:
+        digest.update(cPickle.dumps(obj, 2))
+
+def nbytes(obj):
+    """
+    Returns the number of bytes held by the ndarrays in obj (which may be 
+    an ndarray or a tuple / list containing ndarrays).
+    """
+    if isinstance(obj, np.ndarray):
+        if isinstance(obj, np.memmap):
+            return 0
+        return obj.nbytes
+    elif isinstance(obj, (tuple, list)):
+        return sum(nbytes(item) for item in obj)
+    return 0
+
+class _DiskArray(object):
+    """
+    Placeholder for the i-th array of a result that is stored on disk.
+    """
+    def __init__(self, number):
+        self.number = number
+
+def _split_arrays(obj, arrays):
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        arrays.append(obj)
+        return _DiskArray(len(arrays) - 1)
+    elif isinstance(obj, (tuple, list)):
+        return type(obj)(_split_arrays(item, arrays) for item in obj)
+    return obj
+
+def _join_arrays(obj, arrays):
+    if isinstance(obj, _DiskArray):
+        return arrays[obj.number]
+    elif isinstance(obj, (tuple, list)):
+        return type(obj)(_join_arrays(item, arrays) for item in obj)
+    return obj
+
+def save_result(cache_dir, key, result):
+    """
+    Stores result in cache_dir under key. Arrays are stored as .npy files,
+    the remaining structure of result is pickled. Files are written under a
+    temporary name and renamed, so that concurrent readers never see 
+    partially written files.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    arrays = []
+    skeleton = _split_arrays(result, arrays)
+    for i, array in enumerate(arrays):
+        _atomic_write(os.path.join(cache_dir, '%s-%d.npy' % (key, i)),
+                      lambda f: np.save(f, array))
+    # The skeleton is written last, its presence marks a complete entry.
+    _atomic_write(os.path.join(cache_dir, key + '.pkl'),
+                  lambda f: cPickle.dump((len(arrays), skeleton), f, 2))
+
+def load_result(cache_dir, key):
+    """
+    Loads a result stored with save_result, arrays are memory-mapped 
+    read-only. Returns None if no result is stored under key.
+    """
+    try:
+        with open(os.path.join(cache_dir, key + '.pkl'), 'rb') as f:
+            (nr_arrays, skeleton) = cPickle.load(f)
+        arrays = [np.load(os.path.join(cache_dir, '%s-%d.npy' % (key, i)), 
+                          mmap_mode = 'r') for i in range(nr_arrays)]
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return None
+    return _join_arrays(skeleton, arrays)
+
+def _atomic_write(filename, write):
+    (handle, tmp_name) = tempfile.mkstemp(dir = os.path.dirname(filename),
+                                          suffix = '.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+        os.rename(tmp_name, filename)
+    except:
+        os.remove(tmp_name)
+        raise
+
+class LRUCache(object):
+    """
+    Dictionary like cache that holds at most max_size entries and at most
+    max_bytes bytes of ndarrays (None means unlimited). If it is full, the 
+    entries that were least recently used are discarded.
+    """
+    def __init__(self, max_size=16, max_bytes=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.memory
+
+    def __len__(self):
+        return len(self.memory)
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key and marks it as recently used.
+        """
+        try:
+            value = self.memory.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.memory[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.memory:
+            self._discard(key)
+        size = nbytes(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        self.memory[key] = value
+        self.sizes[key] = size
+        self.nbytes += size
+        while ((self.max_size is not None and 
+                len(self.memory) > max(self.max_size, 0)) or
+               (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            self._discard(next(iter(self.memory)))
+
+    def _discard(self, key):
+        del self.memory[key]
+        self.nbytes -= self.sizes.pop(key)
+
+    def clear(self):
+        self.memory.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
 
 #def pad_vector0(data,center, window = [-7, 7]):
 #	"""